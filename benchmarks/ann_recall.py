@@ -0,0 +1,128 @@
+"""
+Recall@k vs. latency of the IVF index against exact search.
+
+Usage:
+    python -m benchmarks.ann_recall                      # synthetic clustered corpus
+    python -m benchmarks.ann_recall --n 50000 --k 5
+    python -m benchmarks.ann_recall --db embeddings.db   # real embeddings, queries are perturbed articles
+
+For every `n_probe` it reports the mean recall of the exact top-k and the mean
+query latency, next to the latency of the exact matmul scan.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import argparse
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+
+from data_prep.ann import IVFIndex, read_vectors
+from inference.corpus import Corpus, top_k
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Data                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def synthetic_vectors(n: int, dim: int, n_topics: int = 200, seed: int = 0) -> np.ndarray:
+    """
+    Random vectors grouped around `n_topics` directions, roughly like news embeddings.
+    """
+    rng: np.random.Generator = np.random.default_rng(seed)
+    topics: np.ndarray = rng.normal(size=(n_topics, dim)).astype(np.float32)
+
+    return topics[rng.integers(0, n_topics, n)] + 3.0 * rng.normal(size=(n, dim)).astype(np.float32)
+
+def as_corpus(ids: np.ndarray, vectors: np.ndarray) -> Corpus:
+    """
+    Wraps vectors in a `Corpus` the way `sql3_as_pd` rows would be.
+    """
+    return Corpus(pd.DataFrame({"rowid": ids, "source": "bench", "embedding": list(vectors)}))
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Benchmark                                                                    #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def run(corpus: Corpus, index: IVFIndex, queries: np.ndarray, k: int, probes: list[int]) -> list[dict]:
+    """
+    Measures exact search and IVF search for every `n_probe` in `probes`.
+
+    Returns:
+        list[dict]: One {"n_probe", "recall", "ms"} record per setting, exact search has n_probe None.
+    """
+    everything: np.ndarray = np.arange(len(corpus))
+    exact: list[set] = []
+
+    t: float = time.perf_counter()
+    for query in queries:
+        exact.append(set(top_k(corpus.score(query), everything, k).tolist()))
+    results: list[dict] = [{"n_probe": None, "recall": 1.0, "ms": 1000 * (time.perf_counter() - t) / len(queries)}]
+
+    for n_probe in probes:
+        recall: float = 0.0
+
+        t = time.perf_counter()
+        for query, truth in zip(queries, exact):
+            candidates: np.ndarray = corpus.positions(index.probe(query, n_probe))
+            found = top_k(corpus.score(query, candidates), candidates, k)
+            recall += len(truth.intersection(found.tolist())) / max(len(truth), 1)
+        ms: float = 1000 * (time.perf_counter() - t) / len(queries)
+
+        results.append({"n_probe": n_probe, "recall": recall / len(queries), "ms": ms})
+
+    return results
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Main                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall@k vs. latency of the IVF index.")
+    parser.add_argument("--db", default=None, help="use the embeddings of this database instead of synthetic ones")
+    parser.add_argument("--n", type=int, default=20000, help="number of synthetic articles")
+    parser.add_argument("--dim", type=int, default=1024, help="dimension of the synthetic embeddings")
+    parser.add_argument("--k", type=int, default=5, help="top-k to measure recall at")
+    parser.add_argument("--queries", type=int, default=100, help="number of queries")
+    parser.add_argument("--lists", type=int, default=None, help="number of inverted lists (default sqrt(n))")
+    args = parser.parse_args()
+
+    rng: np.random.Generator = np.random.default_rng(1)
+
+    if args.db:
+        conn = sqlite3.connect(args.db)
+        ids, vectors = read_vectors(conn)
+        conn.close()
+
+        queries: np.ndarray = vectors[rng.integers(0, len(vectors), args.queries)]
+        queries = queries + 0.5 * queries.std() * rng.normal(size=queries.shape).astype(np.float32)
+    else:
+        # Queries come from the same topics but are not articles of the corpus
+        vectors = synthetic_vectors(args.n + args.queries, args.dim)
+        vectors, queries = vectors[:args.n], vectors[args.n:]
+        ids = np.arange(1, len(vectors) + 1, dtype=np.int64)
+
+    t: float = time.perf_counter()
+    index: IVFIndex = IVFIndex.build(ids, vectors, args.lists)
+    print(f"Built {index.n_lists} lists over {len(index)} vectors in {time.perf_counter() - t:.2f}s")
+
+    corpus: Corpus = as_corpus(ids, vectors)
+    probes: list[int] = sorted({p for p in [1, 2, 4, 8, 16, 32, 64] if p <= index.n_lists})
+
+    print(f"{'n_probe':>8} {'recall@' + str(args.k):>10} {'ms/query':>10}")
+    for result in run(corpus, index, queries, args.k, probes):
+        name: str = "exact" if result["n_probe"] is None else str(result["n_probe"])
+        print(f"{name:>8} {result['recall']:>10.3f} {result['ms']:>10.3f}")
@@ -0,0 +1,79 @@
+"""
+Offline benchmark of RSS scraping against the local stand-in feed servers.
+
+Usage:
+    python -m benchmarks.bench_scrape
+    python -m benchmarks.bench_scrape --feeds 111 --hosts 8 --latency 0.3 --baseline
+
+Reports the wall-clock time of `parse_rss` (async, pooled fetching), then of a
+second, conditional poll with the feed state of the first one (all 304s), and,
+with --baseline, of calling `feedparser.parse(url)` on every feed one after another.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import argparse
+import time
+import feedparser
+from datetime import datetime, timedelta
+
+from benchmarks.feed_server import feed_servers, fake_feeds
+from data_prep.scrape import parse_rss, parse_entries
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Benchmark                                                                    #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def sequential_baseline(feeds: list[tuple[str, str]]) -> list[tuple[str, str, str]]:
+    """
+    One blocking `feedparser.parse(url)` per feed, the way a single scraping process used to work.
+    """
+    threshold: datetime = datetime.now() - timedelta(hours=48)
+    links: list[tuple[str, str, str]] = []
+
+    for name, url in feeds:
+        links.extend(parse_entries(name, feedparser.parse(url), threshold))
+
+    return links
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Main                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark RSS scraping against local feed servers.")
+    parser.add_argument("--feeds", type=int, default=111, help="number of feeds")
+    parser.add_argument("--hosts", type=int, default=8, help="number of distinct hosts")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds each server waits before answering")
+    parser.add_argument("--per-host", type=int, default=4, help="connection limit per host")
+    parser.add_argument("--baseline", action="store_true", help="also time sequential feedparser.parse(url)")
+    args = parser.parse_args()
+
+    with feed_servers(args.hosts, args.latency) as hosts:
+        feeds: list[tuple[str, str]] = fake_feeds(hosts, args.feeds)
+
+        t: float = time.perf_counter()
+        links = parse_rss(feeds, per_host=args.per_host)
+        print(f"parse_rss: {len(links)} links from {len(feeds)} feeds in {time.perf_counter() - t:.2f}s")
+
+        state: dict = {}
+        parse_rss(feeds, per_host=args.per_host, state=state)
+
+        t = time.perf_counter()
+        links = parse_rss(feeds, per_host=args.per_host, state=state)
+        print(f"conditional re-poll: {len(links)} new links from {len(feeds)} feeds in {time.perf_counter() - t:.2f}s")
+
+        if args.baseline:
+            t = time.perf_counter()
+            links = sequential_baseline(feeds)
+            print(f"sequential: {len(links)} links from {len(feeds)} feeds in {time.perf_counter() - t:.2f}s")
@@ -0,0 +1,228 @@
+"""
+Local stand-in for the RSS feeds of feeds.txt, so the scraper can be benchmarked offline.
+
+Every server answers `/feed/<i>.xml` with a synthetic RSS document whose entries
+were published in the last few hours, after sleeping `latency` seconds to mimic
+a remote host. Answers carry an ETag and a Last-Modified date and conditional
+requests that match get a 304. Several servers (one per port) stand in for several publishers,
+which is what the per-host connection limit of the fetcher keys on.
+
+Usage:
+    with feed_servers(n_hosts=8, latency=0.2) as hosts:
+        feeds = fake_feeds(hosts, n_feeds=111)
+
+The same servers can stand in for the article pages instead (`make_article_handler`),
+for the newspaper download and parsing path:
+
+    with feed_servers(1, handler=make_article_handler()) as hosts:
+        links = fake_article_links(hosts, n_articles=200)
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Feeds                                                                        #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def rss_document(feed_id: int, n_entries: int = 30, now: datetime = None) -> bytes:
+    """
+    A synthetic RSS 2.0 document with `n_entries` items published over the hours before `now`.
+    """
+    now = now or datetime.now(timezone.utc)
+    items: list[str] = []
+
+    for i in range(n_entries):
+        published: str = format_datetime(now - timedelta(minutes=37 * i))
+        items.append(f"""    <item>
+      <title>Story {i} of feed {feed_id}</title>
+      <link>http://news.invalid/{feed_id}/story-{i}.html</link>
+      <guid>http://news.invalid/{feed_id}/story-{i}.html</guid>
+      <pubDate>{published}</pubDate>
+      <description>Synthetic entry {i} of feed {feed_id}.</description>
+    </item>""")
+
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+  <channel>
+    <title>Feed {feed_id}</title>
+    <link>http://news.invalid/{feed_id}</link>
+    <description>Synthetic feed</description>
+{chr(10).join(items)}
+  </channel>
+</rss>
+""".encode("utf-8")
+
+def make_handler(latency: float, n_entries: int) -> type:
+    """
+    Builds a request handler class that serves the synthetic feeds with the given latency.
+    """
+    # Documents are fixed for the lifetime of the server so validators stay meaningful
+    published: datetime = datetime.now(timezone.utc)
+    last_modified: str = format_datetime(published, usegmt=True)
+
+    class FeedHandler(BaseHTTPRequestHandler):
+        protocol_version: str = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            time.sleep(latency)
+
+            try:
+                feed_id: int = int(self.path.rsplit("/", 1)[-1].split(".")[0])
+            except ValueError:
+                self.send_error(404)
+                return
+
+            etag: str = f'"feed-{feed_id}-{n_entries}"'
+
+            # Conditional GET, like most real publishers support
+            if self.headers.get("If-None-Match") == etag or self.headers.get("If-Modified-Since") == last_modified:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            body: bytes = rss_document(feed_id, n_entries, published)
+
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Content-Type", "application/rss+xml; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    return FeedHandler
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Articles                                                                     #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def article_text(article_id: int, n_words: int = 600) -> str:
+    """
+    Deterministic filler text of an article, from a small vocabulary so that topics repeat.
+    """
+    words: list[str] = [f"word{(article_id * 7919 + i * i) % 997}" for i in range(n_words)]
+
+    return ". ".join(" ".join(words[i:i + 12]).capitalize() for i in range(0, n_words, 12)) + "."
+
+def article_document(article_id: int, n_words: int = 600) -> bytes:
+    """
+    A synthetic article page with a headline, an author and `n_words` words of body in paragraphs.
+    """
+    sentences: list[str] = article_text(article_id, n_words).rstrip(".").split(". ")
+    paragraphs: str = "\n".join(f"    <p>{'. '.join(sentences[i:i + 4])}.</p>" for i in range(0, len(sentences), 4))
+
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+  <title>Story {article_id}</title>
+  <meta name="author" content="Reporter {article_id % 13}">
+  <meta property="og:title" content="Story {article_id}">
+</head>
+<body>
+  <article>
+    <h1>Story {article_id}</h1>
+{paragraphs}
+  </article>
+</body>
+</html>
+""".encode("utf-8")
+
+def make_article_handler(latency: float = 0.0, n_words: int = 600) -> type:
+    """
+    Builds a request handler class that serves `/article/<i>.html` pages.
+    """
+    class ArticleHandler(BaseHTTPRequestHandler):
+        protocol_version: str = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            time.sleep(latency)
+
+            try:
+                article_id: int = int(self.path.rsplit("/", 1)[-1].split(".")[0])
+            except ValueError:
+                self.send_error(404)
+                return
+
+            body: bytes = article_document(article_id, n_words)
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    return ArticleHandler
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Servers                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+@contextmanager
+def feed_servers(n_hosts: int = 8, latency: float = 0.2, n_entries: int = 30, handler: type = None):
+    """
+    Starts `n_hosts` feed servers on free localhost ports, in background threads.
+
+    Args:
+        n_hosts: Number of servers, i.e. of distinct hosts (int).
+        latency: Seconds every request waits before being answered (float).
+        n_entries: Number of entries per feed (int).
+        handler: A request handler class to use instead of the default one (type).
+
+    Yields:
+        list[str]: The base URL of every server.
+    """
+    handler = handler or make_handler(latency, n_entries)
+    servers: list[ThreadingHTTPServer] = [ThreadingHTTPServer(("127.0.0.1", 0), handler) for _ in range(n_hosts)]
+
+    for server in servers:
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        yield [f"http://127.0.0.1:{server.server_address[1]}" for server in servers]
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+def fake_feeds(hosts: list[str], n_feeds: int = 111) -> list[tuple[str, str]]:
+    """
+    (name, url) pairs in the format of `get_feeds`, spread round-robin over the hosts.
+    """
+    return [(f"Fake {i}", f"{hosts[i % len(hosts)]}/feed/{i}.xml") for i in range(n_feeds)]
+
+def fake_article_links(hosts: list[str], n_articles: int = 200) -> list[tuple[str, str, str]]:
+    """
+    (feed name, url, publication date) links in the format of `scrape`, pointing at article servers.
+    """
+    now: str = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+    return [(f"Fake {i % 10}", f"{hosts[i % len(hosts)]}/article/{i}.html", now) for i in range(n_articles)]
@@ -0,0 +1,151 @@
+"""
+Local stand-in for the Ollama chat API, so the LLM path can be exercised and timed offline.
+
+The server answers `POST /api/chat` like Ollama does: with `"stream": true` (the API
+default) it sends one JSON object per line as tokens are "generated", otherwise a
+single JSON object once the whole reply is done. The reply is `n_tokens` words,
+the first one after `ttft` seconds and the others at `tokens_per_sec`, and the final
+message carries Ollama's `eval_count`/`eval_duration` counters.
+
+Usage:
+    with ollama_server(ttft=0.3, tokens_per_sec=40) as host:
+        client = ollama.Client(host=host)
+        for token in stream_llm(prompt, client=client): ...
+
+or from the command line, to point the app at it with OLLAMA_HOST:
+    python -m benchmarks.ollama_server --port 11435
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import argparse
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Handler                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def make_handler(ttft: float, tokens_per_sec: float, n_tokens: int) -> type:
+    """
+    Builds a request handler class that answers chat requests with the given timings.
+    """
+    class ChatHandler(BaseHTTPRequestHandler):
+        # One response per connection, a streamed body simply ends when the connection closes
+        protocol_version: str = "HTTP/1.0"
+
+        def do_POST(self) -> None:
+            if self.path != "/api/chat":
+                self.send_error(404)
+                return
+
+            request: dict = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            model: str = request.get("model", "")
+            stream: bool = request.get("stream", True)
+            started: float = time.perf_counter()
+
+            words: list[str] = [f"word{i} " for i in range(n_tokens)]
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson" if stream else "application/json")
+            self.end_headers()
+
+            time.sleep(ttft)
+            generating: float = time.perf_counter()
+
+            for i, word in enumerate(words):
+                if i:
+                    time.sleep(1 / tokens_per_sec)
+                if stream:
+                    self.write(self.message(model, word, done=False))
+
+            final: dict = self.message(model, "" if stream else "".join(words), done=True)
+            final.update({
+                "done_reason": "stop",
+                "total_duration": int(1e9 * (time.perf_counter() - started)),
+                "prompt_eval_count": sum(len(m.get("content", "").split()) for m in request.get("messages", [])),
+                "eval_count": n_tokens,
+                "eval_duration": int(1e9 * (time.perf_counter() - generating)),
+            })
+            self.write(final)
+
+        def message(self, model: str, content: str, done: bool) -> dict:
+            return {
+                "model": model,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "message": {"role": "assistant", "content": content},
+                "done": done,
+            }
+
+        def write(self, message: dict) -> None:
+            self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    return ChatHandler
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Server                                                                       #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+@contextmanager
+def ollama_server(ttft: float = 0.3, tokens_per_sec: float = 40.0, n_tokens: int = 60, port: int = 0):
+    """
+    Starts a fake Ollama server on localhost, in a background thread.
+
+    Args:
+        ttft: Seconds before the first token (float).
+        tokens_per_sec: Generation speed after the first token (float).
+        n_tokens: Number of tokens in every reply (int).
+        port: Port to listen on, 0 for a free one (int).
+
+    Yields:
+        str: The base URL of the server, to pass to `ollama.Client(host=...)`.
+    """
+    server: ThreadingHTTPServer = ThreadingHTTPServer(("127.0.0.1", port), make_handler(ttft, tokens_per_sec, n_tokens))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Main                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Ollama chat API for offline runs of the LLM path.")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--ttft", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=40.0)
+    parser.add_argument("--tokens", type=int, default=60, help="tokens per reply")
+    args = parser.parse_args()
+
+    with ollama_server(args.ttft, args.tokens_per_sec, args.tokens, args.port) as host:
+        print(f"Serving the Ollama chat API on {host}, run the app with OLLAMA_HOST={host}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
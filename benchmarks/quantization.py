@@ -0,0 +1,130 @@
+"""
+Memory, latency and recall of the compact embedding modes against the exact float32 scan.
+
+Usage:
+    python -m benchmarks.quantization                      # synthetic clustered corpus
+    python -m benchmarks.quantization --n 100000 --k 5
+    python -m benchmarks.quantization --db embeddings.db   # real embeddings, queries are perturbed articles
+
+For every mode (float16, int8, truncated dimensions and their combinations, each
+with and without full-precision reranking) it reports the in-memory size of the
+matrix that is scanned, the size of one stored embedding BLOB, the mean query
+latency and the recall of the exact top-k. The reranked modes also read the
+`--rerank` best rows of the float32 matrix per query, which the memory column
+leaves out since the query side keeps it memory-mapped.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import argparse
+import sqlite3
+import time
+import numpy as np
+
+from benchmarks.ann_recall import synthetic_vectors, as_corpus
+from data_prep.ann import read_vectors
+from data_prep.codec import encode_embedding
+from inference.corpus import Corpus, top_k
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Benchmark                                                                    #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def modes(dim: int, rerank: int) -> list[tuple[str, int, int]]:
+    """
+    The (kind, dims, rerank) settings measured, dims None means all of them.
+    """
+    settings: list[tuple[str, int, int]] = []
+
+    for kind, dims in [("float16", None), ("int8", None), ("float32", dim // 4), ("int8", dim // 4)]:
+        settings += [(kind, dims, 0), (kind, dims, rerank)]
+
+    return settings
+
+def measure(corpus: Corpus, queries: np.ndarray, k: int, exact: list[set] = None) -> tuple[float, list[set], float]:
+    """
+    Mean latency in ms, the top-k of every query and the mean recall against `exact`.
+    """
+    everything: np.ndarray = np.arange(len(corpus))
+    found: list[set] = []
+
+    t: float = time.perf_counter()
+    for query in queries:
+        found.append(set(top_k(corpus.score(query), everything, k).tolist()))
+    ms: float = 1000 * (time.perf_counter() - t) / len(queries)
+
+    if exact is None:
+        return ms, found, 1.0
+
+    recall: float = np.mean([len(truth & result) / max(len(truth), 1) for truth, result in zip(exact, found)])
+
+    return ms, found, float(recall)
+
+def run(ids: np.ndarray, vectors: np.ndarray, queries: np.ndarray, k: int, rerank: int) -> list[dict]:
+    """
+    Measures the exact scan and every compact mode.
+
+    Returns:
+        list[dict]: One {"mode", "matrix_mb", "blob_bytes", "ms", "speedup", "recall"} record per setting.
+    """
+    baseline: Corpus = as_corpus(ids, vectors)
+    dim: int = baseline.matrix.shape[1]
+
+    ms, exact, _ = measure(baseline, queries, k)
+    results: list[dict] = [{"mode": "float32", "matrix_mb": baseline.matrix.nbytes / 1e6,
+                            "blob_bytes": len(encode_embedding(vectors[0])[0]), "ms": ms, "speedup": 1.0, "recall": 1.0}]
+
+    for kind, dims, n_rerank in modes(dim, rerank):
+        corpus: Corpus = as_corpus(ids, vectors).quantize(kind, dims, n_rerank)
+        ms_mode, _, recall = measure(corpus, queries, k, exact)
+
+        name: str = kind + (f"/{dims}d" if dims else "") + (f" +rerank {n_rerank}" if n_rerank else "")
+        results.append({"mode": name, "matrix_mb": corpus.quantized.nbytes / 1e6,
+                        "blob_bytes": len(encode_embedding(vectors[0], kind, dims)[0]),
+                        "ms": ms_mode, "speedup": ms / ms_mode, "recall": recall})
+
+    return results
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Main                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory, latency and recall of quantized embeddings.")
+    parser.add_argument("--db", default=None, help="use the embeddings of this database instead of synthetic ones")
+    parser.add_argument("--n", type=int, default=20000, help="number of synthetic articles")
+    parser.add_argument("--dim", type=int, default=1024, help="dimension of the synthetic embeddings")
+    parser.add_argument("--k", type=int, default=5, help="top-k to measure recall at")
+    parser.add_argument("--queries", type=int, default=100, help="number of queries")
+    parser.add_argument("--rerank", type=int, default=100, help="candidates rescored at full precision")
+    args = parser.parse_args()
+
+    rng: np.random.Generator = np.random.default_rng(1)
+
+    if args.db:
+        conn = sqlite3.connect(args.db)
+        ids, vectors = read_vectors(conn)
+        conn.close()
+
+        queries: np.ndarray = vectors[rng.integers(0, len(vectors), args.queries)]
+        queries = queries + 0.5 * queries.std() * rng.normal(size=queries.shape).astype(np.float32)
+    else:
+        vectors = synthetic_vectors(args.n + args.queries, args.dim)
+        vectors, queries = vectors[:args.n], vectors[args.n:]
+        ids = np.arange(1, len(vectors) + 1, dtype=np.int64)
+
+    print(f"{len(vectors)} vectors of {vectors.shape[1]} dimensions, {len(queries)} queries, recall@{args.k}")
+    print(f"{'mode':>24} {'matrix MB':>10} {'blob B':>8} {'ms/query':>9} {'speedup':>8} {'recall':>7}")
+    for result in run(ids, vectors, queries, args.k, args.rerank):
+        print(f"{result['mode']:>24} {result['matrix_mb']:>10.1f} {result['blob_bytes']:>8} {result['ms']:>9.3f} "
+              f"{result['speedup']:>8.2f} {result['recall']:>7.3f}")
@@ -0,0 +1,392 @@
+"""
+Offline benchmark suite of the whole pipeline, with machine-readable results.
+
+Usage:
+    python -m benchmarks.suite                                   # every stage, 1k/10k/100k rows
+    python -m benchmarks.suite --sizes 1000 10000 --out new.json
+    python -m benchmarks.suite --compare old.json --tolerance 0.25
+
+Stages:
+    imports   import time and peak RSS of every `main.py` subcommand, each in a fresh interpreter
+    feeds     `parse_rss` against the local feed servers (benchmarks.feed_server)
+    articles  `download_article` (newspaper download and parsing) against local article pages
+    embed     `embed_articles` encode throughput, with a deterministic hashing stand-in for the model
+    write     `DBWriter` insert rate of complete article rows
+    load      `sql3_as_pd` and `load_corpus` (with and without the memory-mapped sidecar), per size
+    search    `get_similar` latency per size, split into embed/search/fetch
+    prompt    `get_news_report_prompt` build time for the top hits
+
+Nothing leaves the machine: feeds and articles come from local HTTP servers and the
+stand-in embedder hashes words into buckets, so the numbers measure this code and not
+the model or the network. Synthetic corpora are seeded and every run builds the same
+rows. Results are written as JSON; with --compare, every timing that got worse than
+the baseline by more than --tolerance is listed and the exit code is 1.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.ann_recall import synthetic_vectors
+from benchmarks.feed_server import feed_servers, fake_feeds, make_article_handler, fake_article_links, article_text
+from data_prep.codec import encode_embedding
+from data_prep.db_writer import DBWriter
+from data_prep.matrix_file import build_matrix_file
+from data_prep.schema import ensure_schema
+from data_prep.scrape import parse_rss
+from data_prep.vec_db import download_article, embed_articles
+from inference.corpus import Corpus
+from inference.prompts import get_news_report_prompt
+from inference.queries import sql3_as_pd, load_corpus, get_similar
+from main import COMMAND_MODULES
+
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STAGES: list[str] = ["imports", "feeds", "articles", "embed", "write", "load", "search", "prompt"]
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Stand-ins                                                                    #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+class HashEmbedder:
+    """
+    Deterministic stand-in for the SentenceTransformer: every word adds one to a bucket
+    picked by its crc32. Same interface as `SentenceTransformer.encode`.
+    """
+    def __init__(self, dim: int = 1024):
+        self.dim: int = dim
+
+    def encode(self, texts, batch_size: int = 32, convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+        single: bool = isinstance(texts, str)
+        texts = [texts] if single else texts
+        vectors: np.ndarray = np.zeros((len(texts), self.dim), dtype=np.float32)
+
+        for i, text in enumerate(texts):
+            buckets: list[int] = [zlib.crc32(word.encode("utf-8")) % self.dim for word in text.lower().split()]
+            np.add.at(vectors[i], buckets, 1.0)
+
+        return vectors[0] if single else vectors
+
+def synthetic_articles(n: int, n_words: int = 200, offset: int = 0) -> list[dict]:
+    """
+    `n` articles in the format of `download_article`, from a pool of 1000 distinct texts.
+    """
+    return [{
+        "url": f"http://news.invalid/article/{offset + i}.html",
+        "text": article_text((offset + i) % 1000, n_words),
+        "source": f"Source {i % 10}",
+        "authors": [f"Reporter {i % 13}"],
+        "title": f"Story {offset + i}",
+        "publication_date": "2024-06-19 12:00:00",
+        "content_hash": str(offset + i),
+    } for i in range(n)]
+
+def build_db(path: str, size: int, dim: int, n_words: int = 200) -> None:
+    """
+    A database of `size` articles with clustered synthetic embeddings, written like the ingest path does.
+    """
+    conn: sqlite3.Connection = sqlite3.connect(path)
+    ensure_schema(conn)
+    conn.close()
+
+    vectors: np.ndarray = synthetic_vectors(size, dim)
+
+    with DBWriter(path, batch_size=1000) as writer:
+        for article, vector in zip(synthetic_articles(size, n_words), vectors):
+            blob, dtype, dim_ = encode_embedding(vector)
+            writer.put((article["url"], article["text"], article["source"], ", ".join(article["authors"]), article["title"],
+                        article["publication_date"], blob, dtype, dim_, article["content_hash"], None, None))
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Stages                                                                       #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def percentiles(seconds: list[float]) -> dict:
+    ms: np.ndarray = 1000 * np.asarray(seconds)
+
+    return {"p50_ms": round(float(np.percentile(ms, 50)), 4), "p99_ms": round(float(np.percentile(ms, 99)), 4),
+            "mean_ms": round(float(ms.mean()), 4)}
+
+# Run in a fresh interpreter: prints the seconds to import `main` plus the command's modules, and the peak RSS
+_IMPORT_PROBE: str = ("import resource, time; t = time.perf_counter(); import main; main.import_command({command!r}); "
+                      "print(time.perf_counter() - t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+
+def bench_imports(repeats: int = 3) -> list[dict]:
+    results: list[dict] = []
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    rss_unit: int = 1024 * 1024 if sys.platform == "darwin" else 1024
+
+    for command in COMMAND_MODULES:
+        runs: list[tuple[float, int]] = []
+        for _ in range(repeats):
+            out: str = subprocess.run([sys.executable, "-c", _IMPORT_PROBE.format(command=command)], cwd=ROOT,
+                                      capture_output=True, text=True, check=True).stdout.split()
+            runs.append((float(out[0]), int(out[1])))
+
+        seconds, rss = min(runs)
+        results.append({"stage": "imports", "command": command, "seconds": seconds, "max_rss_mb": round(rss / rss_unit, 1)})
+
+    return results
+
+def bench_feeds(n_feeds: int) -> dict:
+    with feed_servers(n_hosts=4, latency=0.0) as hosts:
+        feeds: list[tuple[str, str]] = fake_feeds(hosts, n_feeds)
+
+        t: float = time.perf_counter()
+        links: list = parse_rss(feeds)
+        seconds: float = time.perf_counter() - t
+
+    return {"stage": "feeds", "feeds": n_feeds, "links": len(links), "seconds": seconds, "links_per_sec": len(links) / seconds}
+
+def bench_articles(n_articles: int) -> dict:
+    with feed_servers(n_hosts=1, handler=make_article_handler()) as hosts:
+        links: list[tuple[str, str, str]] = fake_article_links(hosts, n_articles)
+
+        t: float = time.perf_counter()
+        parsed: int = sum(download_article(link) is not None for link in links)
+        seconds: float = time.perf_counter() - t
+
+    return {"stage": "articles", "articles": n_articles, "parsed": parsed, "seconds": seconds,
+            "articles_per_sec": n_articles / seconds}
+
+class _NullWriter:
+    # Swallows the rows, so the embed stage measures encoding alone
+    def put(self, row: tuple, sql: str = None) -> None:
+        pass
+
+def bench_embed(n_articles: int, dim: int, batch_size: int = 32) -> dict:
+    articles: list[dict] = synthetic_articles(n_articles)
+
+    t: float = time.perf_counter()
+    embed_articles(articles, HashEmbedder(dim), _NullWriter(), batch_size)
+    seconds: float = time.perf_counter() - t
+
+    return {"stage": "embed", "articles": n_articles, "seconds": seconds, "articles_per_sec": n_articles / seconds}
+
+def bench_write(n_rows: int, dim: int, directory: str) -> dict:
+    path: str = os.path.join(directory, "write.db")
+
+    t: float = time.perf_counter()
+    build_db(path, n_rows, dim)
+    seconds: float = time.perf_counter() - t
+
+    return {"stage": "write", "rows": n_rows, "seconds": seconds, "rows_per_sec": n_rows / seconds}
+
+def bench_load(path: str, size: int) -> list[dict]:
+    results: list[dict] = []
+
+    t: float = time.perf_counter()
+    sql3_as_pd(path)
+    results.append({"stage": "load", "size": size, "loader": "sql3_as_pd", "seconds": time.perf_counter() - t})
+
+    t = time.perf_counter()
+    load_corpus(path)
+    results.append({"stage": "load", "size": size, "loader": "load_corpus", "seconds": time.perf_counter() - t})
+
+    build_matrix_file(path)
+    t = time.perf_counter()
+    load_corpus(path)
+    results.append({"stage": "load", "size": size, "loader": "load_corpus_mapped", "seconds": time.perf_counter() - t})
+
+    return results
+
+def bench_search(corpus: Corpus, path: str, size: int, dim: int, n_queries: int) -> tuple[dict, list[pd.DataFrame]]:
+    embedder: HashEmbedder = HashEmbedder(dim)
+    rng: np.random.Generator = np.random.default_rng(2)
+    queries: list[str] = [" ".join(article_text(int(i), 30).split()[:20]) for i in rng.integers(0, 1000, n_queries)]
+
+    totals: list[float] = []
+    stages: dict = {"embed": [], "search": [], "fetch": []}
+    hits: list[pd.DataFrame] = []
+
+    for query in queries:
+        timings: dict = {}
+        t: float = time.perf_counter()
+        hits.append(get_similar(query, corpus, embedder, top_n=5, threshold=-1.0, sql_path=path, timings=timings))
+        totals.append(time.perf_counter() - t)
+
+        for stage in stages:
+            stages[stage].append(timings.get(stage, 0.0))
+
+    result: dict = {"stage": "search", "size": size, "queries": n_queries, **percentiles(totals)}
+    for stage, seconds in stages.items():
+        result[f"{stage}_p50_ms"] = percentiles(seconds)["p50_ms"]
+
+    return result, hits
+
+def bench_prompt(hits: list[pd.DataFrame], size: int) -> dict:
+    seconds: list[float] = []
+
+    for similar in hits:
+        t: float = time.perf_counter()
+        get_news_report_prompt(similar, "What happened?", "medium")
+        seconds.append(time.perf_counter() - t)
+
+    return {"stage": "prompt", "size": size, "prompts": len(hits), **percentiles(seconds)}
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Suite                                                                        #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def run_suite(stages: list[str], sizes: list[int], dim: int = 1024, n_queries: int = 50, n_feeds: int = 111,
+              n_articles: int = 200) -> list[dict]:
+    """
+    Runs the selected stages and returns one result record per measurement.
+
+    Args:
+        stages: Stages to run, from `STAGES` (list[str]).
+        sizes: Corpus sizes for the load, search and prompt stages (list[int]).
+        dim: Dimension of the embeddings (int).
+        n_queries: Queries per size for the search and prompt stages (int).
+        n_feeds: Feeds for the feeds stage (int).
+        n_articles: Articles for the articles, embed and write stages (int).
+
+    Returns:
+        list[dict]: The results, every record has a "stage" and the sized ones a "size".
+    """
+    results: list[dict] = []
+
+    def record(result: dict) -> None:
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as directory:
+        if "imports" in stages:
+            for result in bench_imports():
+                record(result)
+        if "feeds" in stages:
+            record(bench_feeds(n_feeds))
+        if "articles" in stages:
+            record(bench_articles(n_articles))
+        if "embed" in stages:
+            record(bench_embed(n_articles, dim))
+        if "write" in stages:
+            record(bench_write(10 * n_articles, dim, directory))
+
+        for size in sizes if {"load", "search", "prompt"} & set(stages) else []:
+            path: str = os.path.join(directory, f"corpus_{size}.db")
+            build_db(path, size, dim)
+
+            if "load" in stages:
+                for result in bench_load(path, size):
+                    record(result)
+
+            if "search" in stages or "prompt" in stages:
+                corpus: Corpus = load_corpus(path)
+                result, hits = bench_search(corpus, path, size, dim, n_queries)
+
+                if "search" in stages:
+                    record(result)
+                if "prompt" in stages:
+                    record(bench_prompt(hits, size))
+
+            for name in os.listdir(directory):
+                if name.startswith(f"corpus_{size}.") or name.startswith(f"corpus_{size}-"):
+                    os.remove(os.path.join(directory, name))
+
+    return results
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """
+    Timings of `results` that are worse than the same measurement of `baseline` by more than `tolerance`.
+
+    Returns:
+        list[str]: One line per regression.
+    """
+    def key(result: dict) -> tuple:
+        return tuple((name, value) for name, value in sorted(result.items()) if isinstance(value, str) or name == "size")
+
+    previous: dict = {key(result): result for result in baseline}
+    regressions: list[str] = []
+
+    for result in results:
+        old: dict = previous.get(key(result))
+        if old is None:
+            continue
+
+        for metric, value in result.items():
+            if metric not in old or not isinstance(value, (int, float)) or not old[metric]:
+                continue
+
+            # Rates should not drop, durations should not grow
+            if metric.endswith("_per_sec"):
+                change: float = old[metric] / value - 1 if value else float("inf")
+            elif metric.endswith("_ms") or metric == "seconds":
+                change = value / old[metric] - 1
+            else:
+                continue
+
+            if change > tolerance:
+                regressions.append(f"{result['stage']} {dict(key(result))}: {metric} {old[metric]:.4g} -> {value:.4g} "
+                                   f"({change:+.0%} worse)")
+
+    return regressions
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Main                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark suite of the ingest and query pipeline.")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES, help="stages to run")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 100000], help="corpus sizes")
+    parser.add_argument("--dim", type=int, default=1024, help="dimension of the embeddings")
+    parser.add_argument("--queries", type=int, default=50, help="queries per corpus size")
+    parser.add_argument("--feeds", type=int, default=111, help="feeds for the feeds stage")
+    parser.add_argument("--articles", type=int, default=200, help="articles for the articles, embed and write stages")
+    parser.add_argument("--out", default="bench_results.json", help="where to write the JSON results")
+    parser.add_argument("--compare", default=None, help="results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before a timing is a regression")
+    args = parser.parse_args()
+
+    report: dict = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "args": vars(args),
+        "results": run_suite(args.stages, args.sizes, args.dim, args.queries, args.feeds, args.articles),
+    }
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(report['results'])} results to {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions: list[str] = compare(report["results"], json.load(f)["results"], args.tolerance)
+
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        print(f"{len(regressions)} regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+
+        sys.exit(1 if regressions else 0)
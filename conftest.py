@@ -0,0 +1,37 @@
+"""
+Shared pytest fixtures. Being at the root of the repository, this file also puts
+the root on `sys.path`, so the tests import `data_prep` and `inference` as the
+entry points do.
+"""
+import zlib
+
+import numpy as np
+import pytest
+
+class WordEmbedder:
+    """
+    Deterministic stand-in for the SentenceTransformer: every word adds one to a bucket
+    picked by its crc32, so texts that share words are close.
+    """
+    def __init__(self, dim: int = 64):
+        self.dim: int = dim
+
+    def encode(self, texts, batch_size: int = 32, convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+        single: bool = isinstance(texts, str)
+        texts = [texts] if single else texts
+        vectors: np.ndarray = np.zeros((len(texts), self.dim), dtype=np.float32)
+
+        for i, text in enumerate(texts):
+            np.add.at(vectors[i], [zlib.crc32(word.encode("utf-8")) % self.dim for word in text.lower().split()], 1.0)
+
+        return vectors[0] if single else vectors
+
+@pytest.fixture
+def embedder() -> WordEmbedder:
+    return WordEmbedder()
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # The modules read and write 'embeddings.db' (and its sidecars) in the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,372 @@
+"""
+Optional approximate nearest-neighbour index (IVF) over the 'embeddings' table.
+
+The normalised embeddings are clustered with spherical k-means; every article is
+filed under its closest centroid ("inverted list"). A query is compared with
+the centroids only, and the exact cosine scan in `get_similar` then touches the
+articles of the `n_probe` closest lists instead of the whole corpus. `n_probe`
+is the recall vs. latency knob: 1 is fastest, `n_lists` is exact search.
+
+The index only keeps the centroids and the rowids of each list, and is saved
+next to the database ('embeddings.db' -> 'embeddings.ivf.npz'). Once it has been
+built with `python -m data_prep.ann`, `store_vectors` and `clean_database` keep it
+in sync by adding and removing the rows that changed. It is rebuilt when the
+table was rewritten (`table_generation`) or holds embeddings of another dimension.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import argparse
+import os
+import sqlite3
+import numpy as np
+from datetime import datetime
+from typing import Optional, Tuple
+
+from data_prep.codec import decode_embedding
+from data_prep.schema import DB_PATH, table_generation
+
+EPS: float = 1e-8
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Helpers                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def index_path(db_path: str = DB_PATH) -> str:
+    """
+    Path of the index file that belongs to a database ('embeddings.db' -> 'embeddings.ivf.npz').
+    """
+    return os.path.splitext(db_path)[0] + ".ivf.npz"
+
+def normalized(vectors: np.ndarray) -> np.ndarray:
+    """
+    Returns a float32, row-normalised copy of `vectors`.
+    """
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), EPS)
+
+    return vectors
+
+def read_vectors(conn: sqlite3.Connection, rowids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reads (rowid, embedding) pairs from the 'embeddings' table, all of them or only `rowids`.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The int64 rowids and the normalised float32 embeddings.
+    """
+    query: str = "SELECT rowid, embedding, embedding_dtype FROM embeddings WHERE embedding IS NOT NULL"
+
+    if rowids is None:
+        rows = conn.execute(query).fetchall()
+    else:
+        rows = []
+        rowids = [int(r) for r in rowids]
+        # Stay under sqlite's limit on the number of bound parameters
+        for i in range(0, len(rowids), 900):
+            chunk = rowids[i:i + 900]
+            rows += conn.execute(f"{query} AND rowid IN ({', '.join('?' * len(chunk))})", chunk).fetchall()
+
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 0), dtype=np.float32)
+
+    ids: np.ndarray = np.array([row[0] for row in rows], dtype=np.int64)
+    vectors: np.ndarray = normalized(np.vstack([decode_embedding(row[1], row[2]) for row in rows]))
+
+    return ids, vectors
+
+def stored_dim(conn: sqlite3.Connection) -> int:
+    """
+    Dimension of the embeddings in the 'embeddings' table, read off the newest one (0 without any).
+    A migration to fewer --dims rewrites every row, so all rows share it.
+    """
+    row = conn.execute("SELECT embedding, embedding_dtype FROM embeddings WHERE embedding IS NOT NULL "
+                       "ORDER BY rowid DESC LIMIT 1").fetchone()
+
+    return 0 if row is None else len(decode_embedding(row[0], row[1]))
+
+def spherical_kmeans(vectors: np.ndarray, n_clusters: int, n_iter: int = 20, seed: int = 0) -> np.ndarray:
+    """
+    Clusters normalised vectors by cosine similarity.
+
+    Args:
+        vectors: Row-normalised float32 vectors (np.ndarray).
+        n_clusters: Number of centroids (int).
+        n_iter: Number of Lloyd iterations (int).
+        seed: Seed of the random initialisation (int).
+
+    Returns:
+        np.ndarray: The normalised centroids, shape (n_clusters, dim).
+    """
+    rng: np.random.Generator = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+
+    centroids: np.ndarray = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignment: np.ndarray = np.argmax(vectors @ centroids.T, axis=1)
+
+        sums: np.ndarray = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts: np.ndarray = np.bincount(assignment, minlength=n_clusters)
+
+        # Re-seed empty clusters with random points so every list gets used
+        empty: np.ndarray = np.flatnonzero(counts == 0)
+        sums[empty] = vectors[rng.choice(len(vectors), len(empty))]
+
+        centroids = normalized(sums)
+
+    return centroids
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Index                                                                        #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+class IVFIndex:
+    """
+    Inverted-file index: k-means centroids plus the rowids filed under each of them.
+
+    Attributes:
+        centroids: Normalised centroids, shape (n_lists, dim) (np.ndarray).
+        lists: The int64 rowids of every list (list[np.ndarray]).
+        trained_on: Number of rows the centroids were trained on (int).
+        generation: Generation of the 'embeddings' table the rowids refer to (int).
+    """
+    def __init__(self, centroids: np.ndarray, lists: Optional[list] = None, trained_on: int = 0, generation: int = 0):
+        self.centroids: np.ndarray = centroids
+        self.lists: list = lists if lists is not None else [np.zeros(0, dtype=np.int64) for _ in range(len(centroids))]
+        self.trained_on: int = trained_on
+        self.generation: int = generation
+
+    def __len__(self) -> int:
+        return sum(len(ids) for ids in self.lists)
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def dim(self) -> int:
+        return self.centroids.shape[1]
+
+    @classmethod
+    def build(cls, ids: np.ndarray, vectors: np.ndarray, n_lists: Optional[int] = None, seed: int = 0) -> "IVFIndex":
+        """
+        Trains the centroids on `vectors` and files every row.
+
+        Args:
+            ids: The rowids of the vectors (np.ndarray).
+            vectors: Row-normalised float32 embeddings (np.ndarray).
+            n_lists: Number of lists, defaults to sqrt(n) (int).
+            seed: Seed of the k-means initialisation (int).
+
+        Returns:
+            IVFIndex: The populated index.
+        """
+        if len(vectors) == 0:
+            raise ValueError("Cannot build an index without vectors")
+
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(len(vectors))))
+
+        # A sample of ~256 points per list is plenty to place the centroids
+        rng: np.random.Generator = np.random.default_rng(seed)
+        sample: np.ndarray = vectors
+        if len(vectors) > 256 * n_lists:
+            sample = vectors[rng.choice(len(vectors), 256 * n_lists, replace=False)]
+
+        index: IVFIndex = cls(spherical_kmeans(sample, n_lists, seed=seed), trained_on=len(vectors))
+        index.add(ids, vectors)
+
+        return index
+
+    def assign(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Index of the closest centroid of every (normalised) vector.
+        """
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def add(self, ids: np.ndarray, vectors: np.ndarray) -> None:
+        """
+        Files new rows under their closest centroid (rows already in the index are moved).
+        """
+        if len(ids) == 0:
+            return
+
+        ids = np.asarray(ids, dtype=np.int64)
+        self.remove(ids)
+
+        assignment: np.ndarray = self.assign(vectors)
+        for list_id in np.unique(assignment):
+            self.lists[list_id] = np.concatenate([self.lists[list_id], ids[assignment == list_id]])
+
+    def remove(self, ids: np.ndarray) -> None:
+        """
+        Drops rows from the index, ids that are not in it are ignored.
+        """
+        if len(ids) == 0:
+            return
+
+        for list_id, members in enumerate(self.lists):
+            if len(members):
+                self.lists[list_id] = members[~np.isin(members, ids)]
+
+    def ids(self) -> np.ndarray:
+        """
+        All the rowids in the index.
+        """
+        return np.concatenate(self.lists) if self.lists else np.zeros(0, dtype=np.int64)
+
+    def probe(self, query: np.ndarray, n_probe: int = 8) -> np.ndarray:
+        """
+        Rowids of the `n_probe` lists whose centroids are closest to `query`.
+
+        Args:
+            query: The query embedding (np.ndarray).
+            n_probe: Number of lists to visit, higher is slower but closer to exact search (int).
+
+        Returns:
+            np.ndarray: The candidate rowids.
+        """
+        n_probe = max(1, min(n_probe, self.n_lists))
+        # Embeddings stored truncated are compared on their leading dimensions
+        sims: np.ndarray = self.centroids @ normalized(np.asarray(query).reshape(-1)[:self.centroids.shape[1]])[0]
+        closest: np.ndarray = np.argpartition(-sims, n_probe - 1)[:n_probe]
+
+        return np.concatenate([self.lists[list_id] for list_id in closest])
+
+    def save(self, path: str) -> None:
+        """
+        Writes the index to `path` (atomically, through a temporary file).
+        """
+        offsets: np.ndarray = np.cumsum([0] + [len(ids) for ids in self.lists])
+
+        tmp_path: str = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, centroids=self.centroids, ids=self.ids(), offsets=offsets, trained_on=self.trained_on,
+                     generation=self.generation)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        """
+        Reads an index written by `save`.
+        """
+        with np.load(path) as f:
+            ids, offsets = f["ids"], f["offsets"]
+            lists: list = [ids[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+            # Indexes saved before generations were recorded belong to generation 0
+            generation: int = int(f["generation"]) if "generation" in f.files else 0
+
+            return cls(f["centroids"], lists, int(f["trained_on"]), generation)
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Build / Sync                                                                 #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def build_index(db_path: str = DB_PATH, n_lists: Optional[int] = None) -> IVFIndex:
+    """
+    Builds the index from every embedding of the database and saves it next to it.
+
+    Args:
+        db_path: Path to the sqlite database (str).
+        n_lists: Number of lists, defaults to sqrt(n) (int).
+
+    Returns:
+        IVFIndex: The new index.
+    """
+    t: datetime = datetime.now()
+
+    conn: sqlite3.Connection = sqlite3.connect(db_path)
+    ids, vectors = read_vectors(conn)
+    generation: int = table_generation(conn)
+    conn.close()
+
+    index: IVFIndex = IVFIndex.build(ids, vectors, n_lists)
+    index.generation = generation
+    index.save(index_path(db_path))
+
+    print(f"Built index of {len(index)} articles in {index.n_lists} lists in {datetime.now() - t}")
+
+    return index
+
+def load_index(db_path: str = DB_PATH) -> Optional[IVFIndex]:
+    """
+    Loads the index that belongs to a database, or returns None if it was never built.
+    """
+    path: str = index_path(db_path)
+
+    return IVFIndex.load(path) if os.path.exists(path) else None
+
+def sync_index(db_path: str = DB_PATH, rebuild_growth: float = 4.0) -> Optional[IVFIndex]:
+    """
+    Brings a previously built index up to date with the database: rows that are new are
+    filed under their closest centroid and rows that were deleted (or replaced) are dropped.
+    Once the table has grown `rebuild_growth` times past what the centroids were trained on,
+    the index is rebuilt instead, and so it is (with as many lists) when the table was
+    rewritten since or its embeddings changed dimension. Does nothing if no index was built.
+
+    Args:
+        db_path: Path to the sqlite database (str).
+        rebuild_growth: Growth factor that triggers retraining the centroids (float).
+
+    Returns:
+        Optional[IVFIndex]: The updated index, or None.
+    """
+    index: Optional[IVFIndex] = load_index(db_path)
+    if index is None:
+        return None
+
+    conn: sqlite3.Connection = sqlite3.connect(db_path)
+    db_ids: np.ndarray = np.array([row[0] for row in conn.execute("SELECT rowid FROM embeddings WHERE embedding IS NOT NULL")], dtype=np.int64)
+
+    if len(db_ids) > rebuild_growth * max(index.trained_on, 1):
+        conn.close()
+        return build_index(db_path)
+
+    # The rowids of a rewritten table, or vectors of another dimension, cannot be patched in
+    if index.generation != table_generation(conn) or (len(db_ids) and stored_dim(conn) != index.dim):
+        conn.close()
+        return build_index(db_path, index.n_lists)
+
+    indexed: np.ndarray = index.ids()
+    added: np.ndarray = np.setdiff1d(db_ids, indexed)
+    removed: np.ndarray = np.setdiff1d(indexed, db_ids)
+
+    index.remove(removed)
+    if len(added):
+        index.add(*read_vectors(conn, added))
+    conn.close()
+
+    if len(added) or len(removed):
+        index.save(index_path(db_path))
+
+    return index
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Main                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the IVF index that sits next to embeddings.db.")
+    parser.add_argument("--db", default=DB_PATH, help="path to the sqlite database")
+    parser.add_argument("--lists", type=int, default=None, help="number of inverted lists (default sqrt(n))")
+    args = parser.parse_args()
+
+    build_index(args.db, args.lists)
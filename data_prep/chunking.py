@@ -0,0 +1,66 @@
+"""
+Splitting of long articles into overlapping passages.
+
+The embedding model only sees the first `max_seq_length` tokens of a text, so a
+long article embedded whole is represented by its opening only. In chunked mode
+(`store_vectors(..., chunk_words=...)`) every article is cut into windows of
+`chunk_words` words that overlap by `overlap` words; each window is embedded and
+stored in the 'passages' table, and the query side scores passages instead of
+whole articles.
+"""
+from typing import List, Tuple
+
+# ~256 tokens per passage, well inside the sequence length of the embedding model
+CHUNK_WORDS: int = 200
+CHUNK_OVERLAP: int = 50
+
+def chunk_text(text: str, chunk_words: int = CHUNK_WORDS, overlap: int = CHUNK_OVERLAP) -> List[Tuple[int, int, str]]:
+    """
+    Splits a text into overlapping windows of words.
+
+    Args:
+        text: The article text (str).
+        chunk_words: Number of words per passage (int).
+        overlap: Number of words shared by consecutive passages (int).
+
+    Returns:
+        List[Tuple[int, int, str]]: (start, end, text) of every passage, where start and end are
+        word offsets into the text. A text shorter than `chunk_words` is a single passage.
+    """
+    if overlap >= chunk_words:
+        raise ValueError(f"The overlap ({overlap}) must be smaller than the passage length ({chunk_words})")
+
+    words: List[str] = text.split()
+    stride: int = chunk_words - overlap
+    passages: List[Tuple[int, int, str]] = []
+
+    for start in range(0, max(len(words) - overlap, 1), stride):
+        end: int = min(start + chunk_words, len(words))
+        passages.append((start, end, " ".join(words[start:end])))
+
+    return passages
+
+def merge_passages(passages: List[Tuple[int, int, str]]) -> List[str]:
+    """
+    Joins passages of one article that overlap or touch back into continuous text.
+
+    Args:
+        passages: (start, end, text) of the passages to merge, in any order.
+
+    Returns:
+        List[str]: The merged passages, in document order.
+    """
+    merged: List[Tuple[int, int, List[str]]] = []
+
+    for start, end, text in sorted(passages):
+        words: List[str] = text.split()
+
+        if merged and start <= merged[-1][1]:
+            last_start, last_end, last_words = merged[-1]
+            # Only the words past the end of the previous passage are new
+            last_words.extend(words[last_end - start:])
+            merged[-1] = (last_start, max(last_end, end), last_words)
+        else:
+            merged.append((start, end, words))
+
+    return [" ".join(words) for _, _, words in merged]
@@ -0,0 +1,144 @@
+"""
+Binary (de)serialisation of embedding vectors.
+
+Embeddings are stored in SQLite as raw little-endian float BLOBs together with
+the dtype and the dimension they were written with, so that readers can turn
+them back into vectors with a zero-copy `numpy.frombuffer` instead of parsing a
+stringified Python list.
+
+Besides float32 and float16, an embedding can be stored as "int8": one float32
+scale (the largest absolute value / 127) followed by the values rounded to int8,
+a quarter of the float32 size. Any of them can also keep only the first `dims`
+values of the vector; the readers normalise the rows, so the truncated vectors
+are scored by the cosine of their leading dimensions.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import json
+import numpy as np
+from typing import Optional, Tuple, Union
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Formats                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+DEFAULT_DTYPE: str = "float32"
+
+# Explicit little-endian dtypes so a database written on one machine can be
+# read on any other
+DTYPES: dict = {
+    "float32": np.dtype("<f4"),
+    "float16": np.dtype("<f2"),
+    "int8": np.dtype("i1"),
+}
+
+# Per-vector scale stored in front of the int8 values
+SCALE_DTYPE: np.dtype = np.dtype("<f4")
+
+def get_dtype(name: Optional[str]) -> np.dtype:
+    """
+    Maps a stored dtype name to its numpy dtype.
+
+    Args:
+        name: The dtype name stored next to the embedding (str). Missing values (None/NaN) mean the default (float32).
+
+    Returns:
+        np.dtype: The matching little-endian numpy dtype.
+    """
+    if not isinstance(name, str):
+        name = DEFAULT_DTYPE
+
+    if name not in DTYPES:
+        raise ValueError(f"Unsupported embedding dtype '{name}', expected one of {list(DTYPES)}")
+
+    return DTYPES[name]
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Encode / Decode                                                              #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Scales every row into [-127, 127] and rounds it to int8.
+
+    Args:
+        vectors: Float vectors, shape (n, dim) (np.ndarray).
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The int8 codes, shape (n, dim), and the float32 scale of every row,
+        such that `codes * scales[:, None]` approximates the vectors.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales: np.ndarray = np.abs(vectors).max(axis=-1) / 127.0
+    scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+
+    codes: np.ndarray = np.clip(np.rint(vectors / scales[..., None]), -127, 127).astype(np.int8)
+
+    return codes, scales
+
+def encode_embedding(vector, dtype: str = DEFAULT_DTYPE, dims: Optional[int] = None) -> Tuple[bytes, str, int]:
+    """
+    Turns an embedding (numpy array, torch tensor or list of floats) into a binary BLOB.
+
+    Args:
+        vector: The embedding to encode. Torch tensors are moved to the cpu first.
+        dtype: The storage dtype, "float32" (default), "float16" or "int8" (str).
+        dims: Only keep the first `dims` values (int).
+
+    Returns:
+        Tuple[bytes, str, int]: The BLOB, the dtype name and the dimension of the vector.
+    """
+    if hasattr(vector, "detach"):
+        vector = vector.detach().cpu().numpy()
+
+    array: np.ndarray = np.asarray(vector).reshape(-1)[:dims]
+
+    if get_dtype(dtype) == DTYPES["int8"]:
+        codes, scale = quantize_int8(array)
+        return scale.astype(SCALE_DTYPE).tobytes() + codes.tobytes(), dtype, codes.shape[0]
+
+    array = np.ascontiguousarray(array, dtype=get_dtype(dtype))
+
+    return array.tobytes(), dtype, array.shape[0]
+
+def decode_embedding(blob: Union[bytes, memoryview, str], dtype: Optional[str] = DEFAULT_DTYPE, dim: Optional[int] = None) -> np.ndarray:
+    """
+    Turns a stored embedding back into a numpy vector.
+
+    BLOBs are decoded with `numpy.frombuffer`, so the returned array is a read-only
+    view on the bytes handed back by sqlite (no copy), except for int8 BLOBs which
+    are scaled back to a float32 copy. Rows that have not been
+    migrated yet still hold the legacy '[0.1, 0.2, ...]' text, which is parsed as
+    JSON into a float32 vector.
+
+    Args:
+        blob: The stored embedding (bytes or legacy str).
+        dtype: The dtype name stored with the embedding (str).
+        dim: The dimension stored with the embedding, checked if given (int).
+
+    Returns:
+        np.ndarray: The embedding as a 1-d array.
+    """
+    if isinstance(blob, str):
+        vector: np.ndarray = np.asarray(json.loads(blob), dtype=DTYPES[DEFAULT_DTYPE])
+    elif get_dtype(dtype) == DTYPES["int8"]:
+        scale: np.ndarray = np.frombuffer(blob, dtype=SCALE_DTYPE, count=1)
+        vector: np.ndarray = np.frombuffer(blob, dtype=DTYPES["int8"], offset=SCALE_DTYPE.itemsize) * scale
+    else:
+        vector: np.ndarray = np.frombuffer(blob, dtype=get_dtype(dtype))
+
+    if dim is not None and vector.shape[0] != dim:
+        raise ValueError(f"Embedding has {vector.shape[0]} values but {dim} were recorded")
+
+    return vector
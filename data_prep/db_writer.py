@@ -0,0 +1,212 @@
+"""
+Single writer for the ingest path.
+
+Instead of every article opening its own connection, inserting one row and
+committing (an fsync per row), rows are handed to one writer thread over a
+bounded queue and written with `executemany` in batched transactions. The
+database runs in WAL mode, so readers (queries, the service) are never
+blocked by the writer and a commit only appends to the log.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import queue
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
+
+from data_prep.schema import ensure_schema, DB_PATH
+from data_prep.metrics import observe, count
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Connection                                                                   #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+PRAGMAS: list[str] = [
+    "PRAGMA journal_mode = WAL",      # readers and the writer do not block each other
+    "PRAGMA synchronous = NORMAL",    # fsync at checkpoints rather than on every commit (safe with WAL)
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536",     # 64 MB page cache
+    "PRAGMA mmap_size = 268435456",   # read through a 256 MB memory map
+    "PRAGMA busy_timeout = 5000",     # wait on a lock instead of failing straight away
+    "PRAGMA recursive_triggers = ON", # INSERT OR REPLACE fires the delete trigger that keeps the full-text index in sync
+]
+
+def connect(path: str = DB_PATH) -> sqlite3.Connection:
+    """
+    Opens the database with the WAL and performance pragmas the ingest path relies on.
+    """
+    conn: sqlite3.Connection = sqlite3.connect(path)
+
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+
+    return conn
+
+INSERT_ARTICLE: str = '''INSERT OR REPLACE INTO embeddings
+                 (url, text, source, authors, title, publication_date, embedding, embedding_dtype, embedding_dim, content_hash, minhash, bias)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+# A re-embedded article replaces all of its passages
+DELETE_PASSAGES: str = "DELETE FROM passages WHERE url = ?"
+
+INSERT_DUPLICATE: str = "INSERT OR REPLACE INTO duplicates (url, canonical_url, source, similarity) VALUES (?, ?, ?, ?)"
+
+# Rebuilt from the duplicates table, so it stays right whatever order rows come in
+UPDATE_ALT_URLS: str = '''UPDATE embeddings
+                 SET alt_urls = (SELECT json_group_array(url) FROM duplicates WHERE canonical_url = embeddings.url)
+                 WHERE url = ?'''
+
+INSERT_PASSAGE: str = '''INSERT INTO passages
+                 (url, position, start, end, text, embedding, embedding_dtype, embedding_dim)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Writer                                                                       #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+class DBWriter:
+    """
+    Writes rows to the database from a single background thread.
+
+    Rows are queued with `put` and written with `executemany` once `batch_size` of
+    them are waiting or `flush_interval` seconds have passed, one transaction per
+    batch. Rows go through the writer's `sql` unless `put` is given another
+    statement; they are written in the order they were queued. `close` (or leaving
+    the `with` block) flushes what is left. `on_commit` is called from the writer
+    thread after every committed batch, so it must return quickly.
+
+    Attributes:
+        rows: Number of rows written (int).
+        commit_times: Duration of every commit, in seconds (list[float]).
+    """
+    def __init__(self, path: str = DB_PATH, sql: str = INSERT_ARTICLE, batch_size: int = 256,
+                 flush_interval: float = 1.0, max_queued: int = 4096, on_commit: Optional[Callable[[], None]] = None):
+        self.path: str = path
+        self.sql: str = sql
+        self.batch_size: int = batch_size
+        self.flush_interval: float = flush_interval
+        self.on_commit: Optional[Callable[[], None]] = on_commit
+
+        self.rows: int = 0
+        self.commit_times: list[float] = []
+        self.error: Optional[BaseException] = None
+
+        self._queue: queue.Queue = queue.Queue(max_queued)
+        self._started: float = time.perf_counter()
+        self._finished: Optional[float] = None
+        self._thread: threading.Thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> "DBWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def put(self, row: tuple, sql: Optional[str] = None) -> None:
+        """
+        Queues a row for `sql` (defaults to the writer's statement), blocking if the writer is `max_queued` rows behind.
+        """
+        if self.error is not None:
+            raise RuntimeError("The database writer stopped") from self.error
+
+        self._queue.put((sql or self.sql, row))
+
+    def close(self) -> None:
+        """
+        Writes the remaining rows and stops the writer thread.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+        if self.error is not None:
+            raise RuntimeError("The database writer stopped") from self.error
+
+    def _write(self, conn: sqlite3.Connection, batch: list[tuple]) -> None:
+        t: float = time.perf_counter()
+
+        # One executemany per run of rows for the same statement, all in one transaction
+        with conn:
+            start: int = 0
+            for end in range(1, len(batch) + 1):
+                if end == len(batch) or batch[end][0] != batch[start][0]:
+                    conn.executemany(batch[start][0], [row for _, row in batch[start:end]])
+                    start = end
+
+        self.commit_times.append(time.perf_counter() - t)
+        self.rows += len(batch)
+
+        observe("db_write", self.commit_times[-1])
+        count("rows_written", len(batch))
+
+        if self.on_commit is not None:
+            self.on_commit()
+
+    def _run(self) -> None:
+        try:
+            conn: sqlite3.Connection = connect(self.path)
+            ensure_schema(conn)
+        except BaseException as e:
+            self.error = e
+            self._drain()
+            return
+
+        batch: list[tuple] = []
+        deadline: float = time.perf_counter() + self.flush_interval
+        done: bool = False
+
+        while not done:
+            try:
+                row = self._queue.get(timeout=max(deadline - time.perf_counter(), 0.0))
+                if row is None:
+                    done = True
+                else:
+                    batch.append(row)
+            except queue.Empty:
+                pass
+
+            if batch and (done or len(batch) >= self.batch_size or time.perf_counter() >= deadline):
+                try:
+                    self._write(conn, batch)
+                except BaseException as e:
+                    self.error = e
+                    self._drain()
+                    break
+                batch = []
+
+            if time.perf_counter() >= deadline:
+                deadline = time.perf_counter() + self.flush_interval
+
+        conn.close()
+        self._finished = time.perf_counter()
+
+    def _drain(self) -> None:
+        # Unblocks producers after a failure, the rows are lost but `put` reports the error
+        while True:
+            if self._queue.get() is None:
+                return
+
+    def report(self) -> str:
+        """
+        Rows/sec and commit latency of the writer, as a printable line.
+        """
+        elapsed: float = (self._finished or time.perf_counter()) - self._started
+        commits: int = len(self.commit_times)
+        mean_ms: float = 1000 * sum(self.commit_times) / commits if commits else 0.0
+        max_ms: float = 1000 * max(self.commit_times) if commits else 0.0
+
+        return (f"Wrote {self.rows} rows in {commits} commits ({self.rows / max(elapsed, 1e-9):.1f} rows/sec), "
+                f"commit latency mean {mean_ms:.1f} ms, max {max_ms:.1f} ms")
@@ -0,0 +1,187 @@
+"""
+Near-duplicate detection of articles with MinHash and locality-sensitive hashing.
+
+Wire stories are syndicated under many of the feeds (CNN, Yahoo, NYT sections...),
+so the same text arrives under several URLs in a single scrape. Before anything is
+embedded, every article gets a MinHash signature of its 5-word shingles; articles
+whose estimated Jaccard similarity with an already stored (or already accepted)
+article is above the threshold are not embedded or stored again. They are recorded
+in the 'duplicates' table instead, and the canonical row lists all of their URLs
+in its `alt_urls` column.
+
+The signatures are kept in the `minhash` column, so later runs are deduplicated
+against everything still in the database.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import re
+import sqlite3
+import zlib
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# MinHash                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+NUM_PERM: int = 128
+SHINGLE_WORDS: int = 5
+
+# 16 bands of 8 rows: pairs above ~0.7 Jaccard collide in at least one band with high probability
+BANDS: int = 16
+DUPLICATE_THRESHOLD: float = 0.7
+
+# Universal hashing (a * x + b) mod p with p > 2^32, one (a, b) per permutation
+_PRIME: int = 4294967311
+_rng: np.random.Generator = np.random.default_rng(1)
+_A: np.ndarray = _rng.integers(1, 2**32, NUM_PERM, dtype=np.uint64)
+_B: np.ndarray = _rng.integers(0, 2**32, NUM_PERM, dtype=np.uint64)
+
+_WORD = re.compile(r"\w+")
+
+def shingles(text: str, size: int = SHINGLE_WORDS) -> np.ndarray:
+    """
+    32-bit hashes of the distinct `size`-word shingles of a text (case and punctuation insensitive).
+    """
+    words: List[str] = _WORD.findall(text.lower())
+    if len(words) < size:
+        words = words + [""] * (size - len(words))
+
+    grams = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+    return np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64, count=len(grams))
+
+def minhash_signature(text: str) -> bytes:
+    """
+    MinHash signature of a text, as `NUM_PERM` little-endian uint32 (what the `minhash` column stores).
+    """
+    hashes: np.ndarray = shingles(text)
+
+    # (shingles, permutations), every product stays below 2^64
+    permuted: np.ndarray = (hashes[:, None] * _A[None, :] + _B[None, :]) % np.uint64(_PRIME)
+
+    return permuted.min(axis=0).astype("<u4").tobytes()
+
+def decode_signature(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype="<u4")
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    Estimated Jaccard similarity of the shingles of two texts.
+    """
+    return float(np.mean(a == b))
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# LSH                                                                          #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+class LSHIndex:
+    """
+    Banded LSH over MinHash signatures: two signatures are candidates if all the rows
+    of any band match, and candidates are confirmed with the estimated similarity.
+
+    Args:
+        bands: Number of bands, `NUM_PERM` must be a multiple of it (int).
+        threshold: Minimum estimated Jaccard similarity of a duplicate (float).
+    """
+    def __init__(self, bands: int = BANDS, threshold: float = DUPLICATE_THRESHOLD):
+        self.bands: int = bands
+        self.rows: int = NUM_PERM // bands
+        self.threshold: float = threshold
+
+        self.signatures: Dict[str, np.ndarray] = {}
+        self._buckets: List[Dict[bytes, List[str]]] = [{} for _ in range(bands)]
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def _keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def add(self, key: str, signature: np.ndarray) -> None:
+        self.signatures[key] = signature
+
+        for band, bucket in zip(self._buckets, self._keys(signature)):
+            band.setdefault(bucket, []).append(key)
+
+    def query(self, signature: np.ndarray, exclude: Optional[str] = None) -> Optional[Tuple[str, float]]:
+        """
+        The most similar indexed key above the threshold, with its similarity, or None.
+        `exclude` is never returned (the stored version of the article being checked).
+        """
+        candidates = set()
+        for band, bucket in zip(self._buckets, self._keys(signature)):
+            candidates.update(band.get(bucket, ()))
+        candidates.discard(exclude)
+
+        best: Optional[Tuple[str, float]] = None
+        for key in candidates:
+            score: float = similarity(signature, self.signatures[key])
+            if score >= self.threshold and (best is None or score > best[1]):
+                best = (key, score)
+
+        return best
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Dedup                                                                        #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def load_lsh_index(conn: sqlite3.Connection, threshold: float = DUPLICATE_THRESHOLD) -> LSHIndex:
+    """
+    LSH index of the signatures of every stored article (rows stored before signatures existed are skipped).
+    """
+    index: LSHIndex = LSHIndex(threshold=threshold)
+
+    for url, blob in conn.execute("SELECT url, minhash FROM embeddings WHERE minhash IS NOT NULL"):
+        index.add(url, decode_signature(blob))
+
+    return index
+
+def find_duplicates(articles: List[dict], index: LSHIndex) -> Tuple[List[dict], List[Tuple[str, str, str, float]]]:
+    """
+    Splits freshly downloaded articles into the ones to embed and near-duplicates.
+
+    An article is a duplicate if its text is close to a stored article or to one
+    accepted earlier in the list; accepted articles are added to `index`. A refreshed
+    article is never a duplicate of its own stored version (the same URL).
+
+    Args:
+        articles: Articles as returned by `download_article`, with their "minhash" signature (List[dict]).
+        index: Signatures of the stored articles (LSHIndex).
+
+    Returns:
+        Tuple[List[dict], List[tuple]]: The articles to keep, and (url, canonical url, source, similarity)
+        for every duplicate.
+    """
+    keep: List[dict] = []
+    duplicates: List[Tuple[str, str, str, float]] = []
+
+    for article in articles:
+        if article.get("minhash") is None:
+            keep.append(article)
+            continue
+
+        signature: np.ndarray = decode_signature(article["minhash"])
+        match: Optional[Tuple[str, float]] = index.query(signature, exclude=article["url"])
+
+        if match is None:
+            index.add(article["url"], signature)
+            keep.append(article)
+        else:
+            duplicates.append((article["url"], match[0], article["source"], match[1]))
+
+    return keep, duplicates
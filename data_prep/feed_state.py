@@ -0,0 +1,155 @@
+"""
+Persistent per-feed state for conditional polling.
+
+For every feed URL it remembers the ETag and Last-Modified validators of the
+last answer, a hash of the last body, the IDs of the entries already seen and
+the time of the last fetch. The scraper sends the validators back as
+If-None-Match / If-Modified-Since so unchanged feeds answer 304 with no body,
+skips parsing a body identical to the previous one (for servers that ignore
+validators), and only emits entries it has not seen before. Entries whose article
+could not be stored are handed back (`settle_entries`) and offered again.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import hashlib
+import json
+import os
+from datetime import datetime
+from typing import Optional
+
+STATE_PATH: str = "data_prep/feed_state.json"
+
+# A feed document rarely lists more entries than this, older IDs can be forgotten
+MAX_SEEN: int = 500
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Load / Save                                                                  #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def load_state(path: str = STATE_PATH) -> dict:
+    """
+    Reads the state of every feed, keyed by feed URL (empty if there is no state file yet).
+    """
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable feed state '{path}': {e}")
+        return {}
+
+def save_state(state: dict, path: str = STATE_PATH) -> None:
+    """
+    Writes the state atomically, so an interrupted run never leaves a truncated file.
+    """
+    tmp_path: str = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Per-feed helpers                                                             #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def conditional_headers(feed_state: Optional[dict]) -> dict:
+    """
+    If-None-Match / If-Modified-Since headers for the next request of a feed.
+    """
+    headers: dict = {}
+
+    if feed_state:
+        if feed_state.get("etag"):
+            headers["If-None-Match"] = feed_state["etag"]
+        if feed_state.get("last_modified"):
+            headers["If-Modified-Since"] = feed_state["last_modified"]
+
+    return headers
+
+def body_hash(body: bytes) -> str:
+    """
+    Fingerprint of a feed body, to notice an unchanged feed served without validators.
+    """
+    return hashlib.sha1(body).hexdigest()
+
+def update_feed_state(feed_state: Optional[dict], headers: dict, body: Optional[bytes] = None,
+                      entry_ids: Optional[list[str]] = None) -> dict:
+    """
+    Records the outcome of one fetch of a feed.
+
+    Args:
+        feed_state: The previous state of the feed, if any (dict).
+        headers: The lower-cased response headers (dict).
+        body: The body of a 200 answer, None for a 304 (bytes).
+        entry_ids: IDs of the entries of the parsed body (list[str]).
+
+    Returns:
+        dict: The new state of the feed.
+    """
+    new_state: dict = dict(feed_state or {})
+    new_state["last_fetch"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # A 304 may repeat the validators, a 200 always replaces them
+    if body is not None or "etag" in headers:
+        new_state["etag"] = headers.get("etag")
+    if body is not None or "last-modified" in headers:
+        new_state["last_modified"] = headers.get("last-modified")
+
+    if body is not None:
+        new_state["hash"] = body_hash(body)
+
+    if entry_ids is not None:
+        # Newest IDs first: those are the ones the next poll will list again
+        seen: list[str] = list(dict.fromkeys(entry_ids + new_state.get("seen", [])))
+        new_state["seen"] = seen[:MAX_SEEN]
+
+    return new_state
+
+def settle_entries(state: dict, failed_links) -> int:
+    """
+    Closes a poll once its links went through ingestion. `feed_links` marks every new entry
+    as seen and lists it under "pending"; the entries whose link could not be stored are
+    taken out of "seen" again, and the validators and hash of their feeds are dropped so
+    the next poll reads those feeds in full and offers the entries again. Call it before
+    `save_state`.
+
+    Args:
+        state: The state of every feed, updated in place (dict).
+        failed_links: Links that were not stored, e.g. because the download failed (iterable of str).
+
+    Returns:
+        int: The number of entries left to retry.
+    """
+    failed: set[str] = set(failed_links)
+    retried: int = 0
+
+    for feed_state in state.values():
+        pending: dict = feed_state.pop("pending", {})
+        retry: set[str] = {entry for link, entry in pending.items() if link in failed}
+        if not retry:
+            continue
+
+        feed_state["seen"] = [entry for entry in feed_state.get("seen", []) if entry not in retry]
+        for key in ("etag", "last_modified", "hash"):
+            feed_state.pop(key, None)
+        retried += len(retry)
+
+    return retried
+
+def entry_id(entry) -> str:
+    """
+    Stable identifier of a feed entry: its id/guid, falling back to its link.
+    """
+    return entry.get("id") or entry.get("link", "")
@@ -0,0 +1,176 @@
+"""
+Asynchronous HTTP fetching for the scraper.
+
+All requests of a run share one pooled `aiohttp` session: connections are kept
+alive and reused, the number of connections per host is capped so that one
+publisher with many feeds (NYT, CNN, ...) is not hammered, and every request has
+a timeout and is retried with exponential backoff on network errors and on 429
+or 5xx answers. Only the bytes are downloaded here, parsing is left to the caller.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import asyncio
+import random
+import aiohttp
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
+
+from data_prep.metrics import span, count, error
+
+DEFAULT_HEADERS: dict = {
+    "User-Agent": "Filtered_Embeddings/1.0",
+    "Accept": "application/rss+xml, application/atom+xml, application/xml, text/xml, */*",
+}
+
+# Statuses worth another try, anything else is final
+RETRY_STATUSES: set[int] = {429, 500, 502, 503, 504}
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Response                                                                     #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+@dataclass
+class FetchResult:
+    """
+    Outcome of fetching one URL.
+
+    Attributes:
+        url: The URL that was asked for (str).
+        status: The final HTTP status, None if no answer was received (Optional[int]).
+        body: The response body, None on failure (Optional[bytes]).
+        headers: The response headers, lower-cased names (dict).
+        error: The last error, if the fetch failed (Optional[str]).
+    """
+    url: str
+    status: Optional[int] = None
+    body: Optional[bytes] = None
+    headers: dict = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status is not None and 200 <= self.status < 300 and self.body is not None
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Fetching                                                                     #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+async def fetch_one(session: aiohttp.ClientSession, url: str, retries: int = 2, backoff: float = 0.5,
+                    headers: Optional[dict] = None) -> FetchResult:
+    """
+    Fetches a single URL, retrying network errors, timeouts, 429 and 5xx answers.
+
+    Args:
+        session: The shared session (aiohttp.ClientSession).
+        url: The URL to fetch (str).
+        retries: Number of extra attempts after the first one (int).
+        backoff: Delay before the first retry in seconds, doubled on every retry (float).
+        headers: Extra headers of this request, e.g. If-None-Match (dict).
+
+    Returns:
+        FetchResult: The final answer or the last error.
+    """
+    result: FetchResult = FetchResult(url)
+
+    for attempt in range(retries + 1):
+        if attempt:
+            count("fetch_retries")
+            # Jitter so that retries against the same host do not line up
+            await asyncio.sleep(backoff * 2 ** (attempt - 1) * (0.5 + random.random()))
+
+        try:
+            # One span per attempt, the backoff is not part of it
+            with span("fetch"):
+                async with session.get(url, headers=headers) as response:
+                    result.status = response.status
+                    result.headers = {name.lower(): value for name, value in response.headers.items()}
+                    count("fetch_responses", status=str(response.status))
+
+                    if response.status in RETRY_STATUSES:
+                        result.error = f"HTTP {response.status}"
+                        continue
+
+                    result.body = await response.read()
+                    result.error = None if response.status < 400 else f"HTTP {response.status}"
+                    count("fetch_bytes", len(result.body))
+                    return result
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            result.error = f"{type(e).__name__}: {e}"
+            error("fetch", e, url=url)
+
+    return result
+
+def client_session(per_host: int = 4, max_connections: int = 64, timeout: float = 15.0,
+                   headers: Optional[dict] = None) -> aiohttp.ClientSession:
+    """
+    The pooled session the requests of one run share, to be opened with `async with` inside the event loop.
+
+    Args:
+        per_host: Maximum number of simultaneous connections to one host (int).
+        max_connections: Maximum number of connections overall (int).
+        timeout: Time allowed to connect and between two reads of one attempt, in seconds (float).
+            Waiting for a free pooled connection does not count against it.
+        headers: Headers sent with every request, on top of `DEFAULT_HEADERS` (dict).
+    """
+    connector: aiohttp.TCPConnector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=per_host, ttl_dns_cache=300)
+    client_timeout: aiohttp.ClientTimeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+
+    return aiohttp.ClientSession(connector=connector, timeout=client_timeout, headers={**DEFAULT_HEADERS, **(headers or {})})
+
+async def fetch_all(urls: list[str], per_host: int = 4, max_connections: int = 64, timeout: float = 15.0,
+                    retries: int = 2, backoff: float = 0.5, headers: Optional[dict] = None,
+                    request_headers: Optional[list[dict]] = None) -> list[FetchResult]:
+    """
+    Fetches every URL concurrently over one pooled session.
+
+    Args:
+        urls: The URLs to fetch (list[str]).
+        per_host: Maximum number of simultaneous connections to one host (int).
+        max_connections: Maximum number of connections overall (int).
+        timeout: Time allowed to connect and between two reads of one attempt, in seconds (float).
+            Waiting for a free pooled connection does not count against it.
+        retries: Number of extra attempts per URL (int).
+        backoff: Delay before the first retry in seconds (float).
+        headers: Headers sent with every request, on top of `DEFAULT_HEADERS` (dict).
+        request_headers: Extra headers per URL, in the order of `urls` (list[dict]).
+
+    Returns:
+        list[FetchResult]: One result per URL, in the order of `urls`.
+    """
+    request_headers = request_headers or [None] * len(urls)
+
+    async with client_session(per_host, max_connections, timeout, headers) as session:
+        return await asyncio.gather(*[fetch_one(session, url, retries, backoff, extra) for url, extra in zip(urls, request_headers)])
+
+async def fetch_iter(urls: list[str], per_host: int = 4, max_connections: int = 64, timeout: float = 15.0,
+                     retries: int = 2, backoff: float = 0.5, headers: Optional[dict] = None,
+                     request_headers: Optional[list[dict]] = None) -> AsyncIterator[tuple[int, FetchResult]]:
+    """
+    Same as `fetch_all`, but yields (position in `urls`, result) as soon as every fetch is done,
+    so the caller can work on the first answers while the slow hosts are still being waited for.
+    """
+    request_headers = request_headers or [None] * len(urls)
+
+    async with client_session(per_host, max_connections, timeout, headers) as session:
+        async def numbered(i: int, url: str, extra: Optional[dict]) -> tuple[int, FetchResult]:
+            return i, await fetch_one(session, url, retries, backoff, extra)
+
+        for done in asyncio.as_completed([numbered(i, url, extra) for i, (url, extra) in enumerate(zip(urls, request_headers))]):
+            yield await done
+
+def fetch_urls(urls: list[str], **kwargs) -> list[FetchResult]:
+    """
+    Synchronous wrapper around `fetch_all`, takes the same keyword arguments.
+    """
+    return asyncio.run(fetch_all(urls, **kwargs))
@@ -0,0 +1,211 @@
+"""
+Memory-mapped sidecar of the embedding matrix, for instant query-side startup.
+
+Next to 'embeddings.db' it keeps:
+    * 'embeddings.vectors.<generation>.f32': the row-normalised float32 embeddings, raw and
+      row-major, opened with `numpy.memmap` so queries start in milliseconds and every
+      process on the machine shares the same pages through the OS page cache.
+    * 'embeddings.vectors.npz': a small manifest with the sqlite rowid of every matrix row
+      (-1 once the row was deleted), the dimension and the name of the matrix file.
+
+New rows are appended to the matrix file before the manifest is replaced, and deleted rows
+are only tombstoned in the manifest, so a reader always sees a consistent pair. Once too
+many rows are tombstoned the matrix is rewritten under a new generation. Build it with
+`python -m data_prep.matrix_file`; `store_vectors` and `clean_database` keep it in sync.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import argparse
+import os
+import sqlite3
+import numpy as np
+from datetime import datetime
+from typing import Optional, Tuple
+
+from data_prep.ann import read_vectors, stored_dim
+from data_prep.schema import DB_PATH
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Paths / Manifest                                                             #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def manifest_path(db_path: str = DB_PATH) -> str:
+    """
+    Path of the manifest that belongs to a database ('embeddings.db' -> 'embeddings.vectors.npz').
+    """
+    return os.path.splitext(db_path)[0] + ".vectors.npz"
+
+def read_manifest(db_path: str = DB_PATH) -> Optional[dict]:
+    """
+    Reads the manifest, or returns None if the sidecar was never built.
+
+    Returns:
+        Optional[dict]: {"ids": rowid per matrix row, "dim": int, "generation": int, "matrix": path of the matrix file}.
+    """
+    path: str = manifest_path(db_path)
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as f:
+        generation: int = int(f["generation"])
+        return {
+            "ids": f["ids"],
+            "dim": int(f["dim"]),
+            "generation": generation,
+            "matrix": os.path.splitext(db_path)[0] + f".vectors.{generation}.f32",
+        }
+
+def write_manifest(db_path: str, ids: np.ndarray, dim: int, generation: int) -> None:
+    """
+    Replaces the manifest atomically.
+    """
+    path: str = manifest_path(db_path)
+    tmp_path: str = path + ".tmp"
+
+    with open(tmp_path, "wb") as f:
+        np.savez(f, ids=np.asarray(ids, dtype=np.int64), dim=dim, generation=generation)
+    os.replace(tmp_path, path)
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Build / Sync                                                                 #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def build_matrix_file(db_path: str = DB_PATH) -> int:
+    """
+    Writes the whole embedding matrix of the database under a new generation.
+
+    Args:
+        db_path: Path to the sqlite database (str).
+
+    Returns:
+        int: The number of rows written.
+    """
+    t: datetime = datetime.now()
+    previous: Optional[dict] = read_manifest(db_path)
+    generation: int = previous["generation"] + 1 if previous else 0
+
+    conn: sqlite3.Connection = sqlite3.connect(db_path)
+    ids, vectors = read_vectors(conn)
+    conn.close()
+
+    matrix_path: str = os.path.splitext(db_path)[0] + f".vectors.{generation}.f32"
+    np.ascontiguousarray(vectors, dtype="<f4").tofile(matrix_path)
+    write_manifest(db_path, ids, vectors.shape[1] if vectors.size else 0, generation)
+
+    # Readers that still map the old file keep it alive until they close it
+    if previous and os.path.exists(previous["matrix"]):
+        os.remove(previous["matrix"])
+
+    print(f"Wrote {len(ids)} vectors to {matrix_path} in {datetime.now() - t}")
+
+    return len(ids)
+
+def sync_matrix_file(db_path: str = DB_PATH, compact_ratio: float = 0.25) -> Optional[int]:
+    """
+    Brings a previously built sidecar up to date with the database: new rows are appended
+    and deleted (or replaced) rows are tombstoned. Once more than `compact_ratio` of the rows
+    are tombstones, or the stored embeddings no longer have the manifest's dimension, the
+    matrix is rewritten. Does nothing if the sidecar was never built.
+
+    Args:
+        db_path: Path to the sqlite database (str).
+        compact_ratio: Fraction of dead rows that triggers a rewrite (float).
+
+    Returns:
+        Optional[int]: The number of live rows, or None without a sidecar.
+    """
+    manifest: Optional[dict] = read_manifest(db_path)
+    if manifest is None:
+        return None
+
+    conn: sqlite3.Connection = sqlite3.connect(db_path)
+    db_ids: np.ndarray = np.array([row[0] for row in conn.execute("SELECT rowid FROM embeddings WHERE embedding IS NOT NULL")], dtype=np.int64)
+
+    ids: np.ndarray = manifest["ids"].copy()
+    live: np.ndarray = ids[ids >= 0]
+    added: np.ndarray = np.setdiff1d(db_ids, live)
+    removed: np.ndarray = np.setdiff1d(live, db_ids)
+
+    # Vectors of another dimension (a migration to fewer --dims) cannot share the matrix file
+    if len(db_ids) and stored_dim(conn) != manifest["dim"]:
+        conn.close()
+        return build_matrix_file(db_path)
+
+    if not len(added) and not len(removed):
+        conn.close()
+        return len(live)
+
+    ids[np.isin(ids, removed)] = -1
+    dead: int = int((ids < 0).sum())
+
+    if dead > compact_ratio * max(len(ids), 1):
+        conn.close()
+        return build_matrix_file(db_path)
+
+    new_ids, vectors = read_vectors(conn, added)
+    conn.close()
+
+    # Rows go to the matrix file first, so the manifest never lists rows that are not there.
+    # Anything past the rows the manifest knows about is a leftover of an interrupted sync.
+    if len(new_ids):
+        with open(manifest["matrix"], "r+b") as f:
+            f.truncate(len(ids) * manifest["dim"] * 4)
+            f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(vectors, dtype="<f4").tobytes())
+
+    write_manifest(db_path, np.concatenate([ids, new_ids]), manifest["dim"], manifest["generation"])
+
+    return len(ids) - dead + len(new_ids)
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Open                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def open_matrix(db_path: str = DB_PATH) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Maps the sidecar read-only.
+
+    Returns:
+        Optional[Tuple[np.ndarray, np.ndarray]]: The rowid of every row (-1 for deleted rows) and the
+        memory-mapped (n, dim) float32 matrix, or None if the sidecar was never built.
+    """
+    manifest: Optional[dict] = read_manifest(db_path)
+    if manifest is None:
+        return None
+
+    ids: np.ndarray = manifest["ids"]
+
+    if not len(ids) or manifest["dim"] == 0:
+        return ids, np.zeros((len(ids), manifest["dim"]), dtype=np.float32)
+
+    matrix: np.ndarray = np.memmap(manifest["matrix"], dtype="<f4", mode="r", shape=(len(ids), manifest["dim"]))
+
+    return ids, matrix
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Main                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the memory-mapped embedding matrix that sits next to embeddings.db.")
+    parser.add_argument("--db", default=DB_PATH, help="path to the sqlite database")
+    args = parser.parse_args()
+
+    build_matrix_file(args.db)
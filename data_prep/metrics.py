@@ -0,0 +1,370 @@
+"""
+Lightweight instrumentation of the scrape, ingest and query paths.
+
+Stages are timed with spans and outcomes are counted:
+
+    with span("download"):
+        ...
+    count("fetch_bytes", len(body))
+    error("download", e)      # counted by exception type and logged
+
+The spans are fetch, feed_parse, download, parse, encode, bias, db_write, the
+retrieval stages (query_embed, query_search, query_fetch), llm and llm_ttft. The counters
+are fetch_responses by status, fetch_retries, fetch_bytes, articles_downloaded,
+article_bytes, articles_duplicate, articles_encoded, rows_written, llm_tokens and
+errors by stage and exception type.
+
+Nothing is recorded until metrics are configured. Until then every hook returns
+after one attribute check, and `span` hands back a shared no-op context manager,
+so the hooks can stay in the hot loops. Metrics are enabled either in code:
+
+    configure(json_log="metrics.jsonl", prometheus="metrics.prom")
+
+or by setting NEWS_METRICS_LOG and/or NEWS_METRICS_PROM before any entry point is
+started. The JSON log gets one line per finished span and per error, as they
+happen. The Prometheus text file (counters as `news_<name>_total`, spans as the
+`news_span_seconds` summary) is written at exit, or on demand with
+`write_prometheus`. The query service also serves it on GET /metrics.
+
+Download workers run in other processes: they send their metrics back with every
+article (`drain`) and the parent folds them in (`merge`).
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import atexit
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+LOG_ENV: str = "NEWS_METRICS_LOG"
+PROMETHEUS_ENV: str = "NEWS_METRICS_PROM"
+PREFIX: str = "news"
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Spans                                                                        #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+class _NullSpan:
+    """
+    What `span` returns while metrics are disabled.
+    """
+    __slots__ = ()
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        return False
+
+NULL_SPAN: _NullSpan = _NullSpan()
+
+class Span:
+    """
+    Times the `with` block and records it under `name`, whether or not it raised.
+    """
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics: "Metrics", name: str, labels: dict):
+        self.metrics: Metrics = metrics
+        self.name: str = name
+        self.labels: dict = labels
+        self.start: float = 0.0
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Registry                                                                     #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def _key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted(labels.items())))
+
+class Metrics:
+    """
+    Counters and span timings of one process.
+
+    Attributes:
+        enabled: Whether anything is recorded (bool).
+        counters: Value of every (name, labels) counter (dict).
+        timers: [count, total seconds, max seconds] of every (name, labels) span (dict).
+    """
+    def __init__(self):
+        self.enabled: bool = False
+        self.counters: dict = {}
+        self.timers: dict = {}
+
+        self.json_log: Optional[str] = None
+        self.prometheus: Optional[str] = None
+
+        self._lock: threading.Lock = threading.Lock()
+        self._log = None
+        self._exit_hook: bool = False
+
+    def configure(self, json_log: Optional[str] = None, prometheus: Optional[str] = None) -> None:
+        """
+        Enables metrics. Calling it again switches the outputs; with neither output
+        the metrics are only kept in memory (e.g. for the /metrics endpoint).
+
+        Args:
+            json_log: File the span and error events are appended to, one JSON object per line (str).
+            prometheus: File the Prometheus text exposition is written to at exit (str).
+        """
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+
+            self._log = open(json_log, "a", encoding="utf-8") if json_log else None
+            self.json_log = json_log
+            self.prometheus = prometheus
+            self.enabled = True
+
+        if not self._exit_hook:
+            atexit.register(self.close)
+            self._exit_hook = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def worker_config(self) -> dict:
+        """
+        Keyword arguments of `configure` for a worker process: the workers log their
+        own events but the parent writes the Prometheus file.
+        """
+        return {"json_log": self.json_log} if self.enabled else {}
+
+    def init_worker(self, config: dict) -> None:
+        """
+        Pool initializer: starts the worker with empty metrics (a forked worker
+        inherits the parent's) and the outputs of `worker_config`.
+        """
+        self.reset()
+
+        if config:
+            self.configure(**config)
+        else:
+            self.disable()
+
+    def close(self) -> None:
+        """
+        Writes the Prometheus file, if one is configured, and closes the JSON log.
+        """
+        if self.enabled and self.prometheus:
+            self.write_prometheus()
+
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    # ------------------------------------------------------------------------ #
+    # Hooks
+    # ------------------------------------------------------------------------ #
+    def span(self, name: str, **labels):
+        """
+        Context manager timing its block as `name`, a shared no-op while disabled.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+
+        return Span(self, name, labels)
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        """
+        Adds `value` to the counter `name`.
+        """
+        if not self.enabled:
+            return
+
+        key: tuple = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """
+        Records a duration measured elsewhere as one span `name`.
+        """
+        if not self.enabled:
+            return
+
+        key: tuple = _key(name, labels)
+        with self._lock:
+            timer: Optional[list] = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+        if self._log is not None:
+            self.event("span", name, seconds=round(seconds, 6), **labels)
+
+    def error(self, stage: str, exc: BaseException, **labels) -> None:
+        """
+        Counts a failure of `stage` by exception type and logs its message.
+        """
+        if not self.enabled:
+            return
+
+        self.count("errors", stage=stage, type=type(exc).__name__)
+
+        if self._log is not None:
+            self.event("error", stage, type=type(exc).__name__, message=str(exc)[:500], **labels)
+
+    def event(self, kind: str, name: str, **fields) -> None:
+        """
+        Appends one event to the JSON log.
+        """
+        if self._log is None:
+            return
+
+        line: str = json.dumps({"ts": round(time.time(), 6), "pid": os.getpid(), "kind": kind, "name": name, **fields}, default=str)
+        with self._lock:
+            if self._log is not None:
+                self._log.write(line + "\n")
+                self._log.flush()
+
+    # ------------------------------------------------------------------------ #
+    # Processes
+    # ------------------------------------------------------------------------ #
+    def snapshot(self) -> dict:
+        """
+        Copy of the counters and timers, picklable.
+        """
+        with self._lock:
+            return {"counters": dict(self.counters), "timers": {key: list(timer) for key, timer in self.timers.items()}}
+
+    def drain(self) -> Optional[dict]:
+        """
+        Snapshot of what was recorded since the last drain, then resets; None while disabled.
+        """
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            drained: dict = {"counters": self.counters, "timers": self.timers}
+            self.counters, self.timers = {}, {}
+
+        return drained
+
+    def merge(self, snapshot: Optional[dict]) -> None:
+        """
+        Adds the metrics drained from another process.
+        """
+        if not snapshot or not self.enabled:
+            return
+
+        with self._lock:
+            for key, value in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+            for key, (n, total, longest) in snapshot["timers"].items():
+                timer: Optional[list] = self.timers.get(key)
+                if timer is None:
+                    self.timers[key] = [n, total, longest]
+                else:
+                    timer[0] += n
+                    timer[1] += total
+                    timer[2] = max(timer[2], longest)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters, self.timers = {}, {}
+
+    # ------------------------------------------------------------------------ #
+    # Output
+    # ------------------------------------------------------------------------ #
+    def prometheus_text(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        data: dict = self.snapshot()
+        lines: list[str] = []
+
+        families: dict = {}
+        for (name, labels), value in sorted(data["counters"].items()):
+            families.setdefault(name, []).append((labels, value))
+
+        for name, samples in families.items():
+            metric: str = f"{PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines += [f"{metric}{_labels(labels)} {_number(value)}" for labels, value in samples]
+
+        if data["timers"]:
+            metric = f"{PREFIX}_span_seconds"
+            timers: list = sorted(data["timers"].items())
+
+            lines.append(f"# TYPE {metric} summary")
+            for (name, labels), (n, total, _) in timers:
+                tags: str = _labels((("span", name),) + labels)
+                lines += [f"{metric}_count{tags} {n}", f"{metric}_sum{tags} {_number(total)}"]
+
+            lines.append(f"# TYPE {metric}_max gauge")
+            lines += [f"{metric}_max{_labels((('span', name),) + labels)} {_number(longest)}"
+                      for (name, labels), (_, _, longest) in timers]
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: Optional[str] = None) -> None:
+        """
+        Writes `prometheus_text` to `path` (defaults to the configured file), atomically.
+        """
+        path = path or self.prometheus
+        if not path:
+            return
+
+        tmp: str = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp, path)
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else f"{value:.6f}"
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Process Registry                                                             #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+METRICS: Metrics = Metrics()
+
+span = METRICS.span
+count = METRICS.count
+observe = METRICS.observe
+error = METRICS.error
+configure = METRICS.configure
+
+def init_worker(config: dict) -> None:
+    # Pool initializer, a plain function so that spawned workers can unpickle it
+    METRICS.init_worker(config)
+
+if os.environ.get(LOG_ENV) or os.environ.get(PROMETHEUS_ENV):
+    configure(os.environ.get(LOG_ENV) or None, os.environ.get(PROMETHEUS_ENV) or None)
@@ -0,0 +1,170 @@
+"""
+One-shot migration of an existing 'embeddings.db' from stringified embeddings
+('[0.123, ...]' TEXT) to binary BLOBs with a stored dtype and dimension. Publication
+dates are rewritten as '%Y-%m-%d %H:%M:%S' on the way, which retention relies on
+(dates that cannot be parsed are cleared).
+
+Usage:
+    python -m data_prep.migrate                          # float32, embeddings.db
+    python -m data_prep.migrate --db other.db --dtype float16
+    python -m data_prep.migrate --dtype int8 --dims 256      # a quarter of the values, a byte each
+
+The table is rebuilt in a single transaction, so an interrupted run leaves the
+database untouched. Rows keep their rowids, and the matrix sidecar and the IVF
+index, if they were built, are rebuilt from the new embeddings. Running it on an
+already migrated database is a no-op unless a different --dtype (or a smaller
+--dims) is asked for. Truncating is one-way: the dropped dimensions are gone.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import argparse
+import os
+import sqlite3
+from datetime import datetime
+from typing import Optional
+
+from data_prep.ann import IVFIndex, build_index, load_index
+from data_prep.codec import encode_embedding, decode_embedding, DTYPES, DEFAULT_DTYPE
+from data_prep.matrix_file import read_manifest, build_matrix_file
+from data_prep.schema import EMBEDDINGS_TABLE, bump_table_generation, ensure_schema, table_columns, normalize_date, DB_PATH
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Migration                                                                    #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+EMBEDDING_COLUMNS: list[str] = ["embedding", "embedding_dtype", "embedding_dim"]
+
+# Shape of a normalised publication_date ('%Y-%m-%d %H:%M:%S')
+DATE_GLOB: str = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9] [0-9][0-9]:[0-9][0-9]:[0-9][0-9]"
+
+def needs_migration(conn: sqlite3.Connection, dtype: str = DEFAULT_DTYPE, dims: Optional[int] = None) -> bool:
+    """
+    Checks whether any row still holds a text embedding, was written with another dtype
+    (or more than `dims` values) or has a publication date that is not normalised.
+    """
+    if "embedding_dtype" not in table_columns(conn):
+        return True
+
+    row = conn.execute('''SELECT 1 FROM embeddings
+                          WHERE (embedding IS NOT NULL
+                                 AND (typeof(embedding) != 'blob' OR embedding_dtype IS NOT ? OR embedding_dim > ?))
+                             OR publication_date NOT GLOB ?
+                          LIMIT 1''', (dtype, dims or 2**31, DATE_GLOB)).fetchone()
+
+    return row is not None
+
+def migrate_db(path: str = DB_PATH, dtype: str = DEFAULT_DTYPE, dims: Optional[int] = None) -> int:
+    """
+    Rewrites every embedding of the 'embeddings' table as a `dtype` BLOB.
+
+    Args:
+        path: Path to the sqlite database (str).
+        dtype: The storage dtype, "float32", "float16" or "int8" (str).
+        dims: Also truncate the embeddings to their first `dims` values (int).
+
+    Returns:
+        int: The number of rows that were converted.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported embedding dtype '{dtype}', expected one of {list(DTYPES)}")
+
+    t: datetime = datetime.now()
+    size_before: int = os.path.getsize(path)
+
+    conn: sqlite3.Connection = sqlite3.connect(path)
+
+    if not table_columns(conn):
+        conn.close()
+        raise ValueError(f"'{path}' has no embeddings table to migrate")
+
+    ensure_schema(conn)
+
+    if not needs_migration(conn, dtype, dims):
+        conn.close()
+        print(f"'{path}' is already stored as {dtype}, nothing to do")
+        return 0
+
+    copied: list[str] = [column for column in table_columns(conn) if column not in EMBEDDING_COLUMNS]
+    columns: str = ", ".join(copied)
+    placeholders: str = ", ".join("?" for _ in range(len(copied) + 3))
+    converted: int = 0
+
+    # The rebuild gives the new table a BLOB declared type, which a simple UPDATE cannot
+    with conn:
+        conn.execute("DROP TABLE IF EXISTS embeddings_migrated")
+        conn.execute(EMBEDDINGS_TABLE.format(name="embeddings_migrated"))
+
+        # Rowids are kept: the full-text index, the matrix sidecar and the IVF index all refer to rows by rowid
+        rows = conn.execute(f"SELECT rowid, {columns}, embedding, embedding_dtype FROM embeddings")
+        insert: str = f"INSERT INTO embeddings_migrated (rowid, {columns}, embedding, embedding_dtype, embedding_dim) VALUES (?, {placeholders})"
+
+        date_column: int = copied.index("publication_date") + 1
+
+        batch: list[tuple] = []
+        for row in rows:
+            stored, stored_dtype = row[-2], row[-1]
+
+            if stored is None:
+                blob, dim = None, None
+            else:
+                blob, _, dim = encode_embedding(decode_embedding(stored, stored_dtype), dtype, dims)
+                converted += 1
+
+            values: list = list(row[:-2])
+            # A date that cannot be parsed is cleared, as `store_vectors` does; kept, it would never match DATE_GLOB
+            values[date_column] = normalize_date(values[date_column])
+
+            batch.append((*values, blob, dtype if blob is not None else None, dim))
+
+            if len(batch) >= 1000:
+                conn.executemany(insert, batch)
+                batch = []
+
+        conn.executemany(insert, batch)
+
+        conn.execute("DROP TABLE embeddings")
+        conn.execute("ALTER TABLE embeddings_migrated RENAME TO embeddings")
+        bump_table_generation(conn)
+
+    # The indexes went with the old table
+    ensure_schema(conn)
+    conn.execute("VACUUM")
+    conn.close()
+
+    # The sidecar and the index hold the old vectors, they are rebuilt from the new ones
+    if read_manifest(path) is not None:
+        build_matrix_file(path)
+
+    index: Optional[IVFIndex] = load_index(path)
+    if index is not None:
+        build_index(path, index.n_lists)
+
+    size_after: int = os.path.getsize(path)
+    print(f"Migrated {converted} embeddings to {dtype} in {datetime.now() - t} "
+          f"({size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB)")
+
+    return converted
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Main                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert text embeddings in embeddings.db to binary BLOBs.")
+    parser.add_argument("--db", default=DB_PATH, help="path to the sqlite database")
+    parser.add_argument("--dtype", default=DEFAULT_DTYPE, choices=list(DTYPES), help="storage dtype of the embeddings")
+    parser.add_argument("--dims", type=int, default=None, help="keep only the first DIMS values of every embedding")
+    args = parser.parse_args()
+
+    migrate_db(args.db, args.dtype, args.dims)
@@ -0,0 +1,451 @@
+"""
+Streaming ingest: feed fetch -> article download and parsing -> embedding -> database.
+
+`scrape` has to finish every feed before `store_vectors` downloads the first
+article, and every article is downloaded before the first one is embedded. Here
+the stages run at the same time and hand their work over bounded queues:
+
+    feeds      one thread running the asyncio fetcher; every feed is parsed as soon as
+               it answers and its new links are queued (`link_queue`)
+    download   `num_workers` processes download and parse articles, with at most two
+               links per worker in flight; parsed articles are queued (`article_queue`)
+    embed      the calling thread deduplicates the articles and embeds them in batches
+               of `batch_size`, or whatever arrived within `max_wait` seconds
+    write      the `DBWriter` thread commits the rows at least every second
+    sync       a thread files the committed rows in the ANN index and the matrix sidecar,
+               if they were built, at most every `sync_interval` seconds
+
+A stage that gets ahead blocks on the full queue of the next one, so the memory
+used does not grow with the number of links: only the queues, the writer's
+backlog and the set of links already seen are held. Rows are committed and
+indexed while the feeds are still being fetched, and the service's hot reload
+picks them up.
+
+Download and parsing stay together in the worker processes: parsing is CPU
+bound, and splitting it into its own stage would send every page between
+processes a second time.
+
+Usage:
+    python -m data_prep.pipeline [--num-feeds 10] [--bias] [--workers 4]
+    python main.py ingest --stream
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import argparse
+import asyncio
+import multiprocessing
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+from typing import Optional, TYPE_CHECKING
+
+import feedparser
+
+from data_prep.codec import DEFAULT_DTYPE
+from data_prep.chunking import CHUNK_OVERLAP
+from data_prep.db_writer import DBWriter, connect, INSERT_DUPLICATE, UPDATE_ALT_URLS
+from data_prep.dedup import LSHIndex, load_lsh_index, find_duplicates, DUPLICATE_THRESHOLD
+from data_prep.fetch import fetch_iter
+from data_prep.feed_state import load_state, save_state, settle_entries, conditional_headers, STATE_PATH
+from data_prep.metrics import METRICS, init_worker, count, error
+from data_prep.scrape import get_feeds, feed_links
+from data_prep.schema import DB_PATH
+from data_prep.vec_db import create_db, stored_hashes, embed_articles, download_in_worker, KNOWN_DUPLICATE
+from data_prep.ann import sync_index
+from data_prep.matrix_file import sync_matrix_file
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+LINK_QUEUE: int = 1024
+ARTICLE_QUEUE: int = 256
+
+# What `queue.get` returns in the embed stage when nothing arrived in time
+_TIMEOUT = object()
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    # Blocks while the queue is full (the backpressure), gives up once the pipeline is stopping
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Pipeline                                                                     #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+class IngestPipeline:
+    """
+    Streams feeds to stored embeddings, every stage in its own thread or processes.
+
+    Takes the options of `store_vectors`, plus:
+
+    Args:
+        per_host: Simultaneous connections to one feed host (int).
+        max_wait: Seconds the first article of a batch waits for the batch to fill before
+            the partial batch is embedded (float).
+        link_queue: Links waiting to be downloaded, at most (int).
+        article_queue: Parsed articles waiting to be embedded, at most (int).
+        sync_interval: Seconds between two syncs of the ANN index and the matrix sidecar
+            while rows are being committed (float).
+
+    Attributes:
+        stats: Number of feeds fetched, links queued, links skipped (already stored), articles
+            downloaded, failed, unchanged (refresh), near-duplicates and stored (dict).
+        failed: The links whose article could not be downloaded (list[str]).
+    """
+    def __init__(self, embedding_model: "SentenceTransformer", embedding_dtype: str = DEFAULT_DTYPE, batch_size: int = 32,
+                 num_workers: int = 4, refresh: bool = False, chunk_words: Optional[int] = None,
+                 chunk_overlap: int = CHUNK_OVERLAP, dedup: bool = True, dedup_threshold: float = DUPLICATE_THRESHOLD,
+                 embedding_dims: Optional[int] = None, bias_classifier=None, per_host: int = 4, max_wait: float = 2.0,
+                 link_queue: int = LINK_QUEUE, article_queue: int = ARTICLE_QUEUE, sync_interval: float = 5.0):
+        self.embedding_model = embedding_model
+        self.embedding_dtype: str = embedding_dtype
+        self.batch_size: int = batch_size
+        self.num_workers: int = num_workers
+        self.refresh: bool = refresh
+        self.chunk_words: Optional[int] = chunk_words
+        self.chunk_overlap: int = chunk_overlap
+        self.dedup: bool = dedup
+        self.dedup_threshold: float = dedup_threshold
+        self.embedding_dims: Optional[int] = embedding_dims
+        self.bias_classifier = bias_classifier
+        self.per_host: int = per_host
+        self.max_wait: float = max_wait
+        self.sync_interval: float = sync_interval
+
+        self.links: queue.Queue = queue.Queue(link_queue)
+        self.articles: queue.Queue = queue.Queue(article_queue)
+
+        self.stats: dict = {"feeds": 0, "links": 0, "skipped": 0, "downloaded": 0, "failed": 0, "unchanged": 0,
+                            "duplicates": 0, "stored": 0}
+        self.failed: list[str] = []
+        self.error: Optional[BaseException] = None
+
+        self._stop: threading.Event = threading.Event()
+        self._committed: threading.Event = threading.Event()
+        self._written: threading.Event = threading.Event()
+        self._seen: set[str] = set()
+        self._known: dict = {}
+
+    def run(self, feeds: list[tuple[str, str]], state: Optional[dict] = None) -> dict:
+        """
+        Ingests the new articles of `feeds` and returns `stats` once everything is written.
+
+        Args:
+            feeds: (name, URL) of the feeds to read (list[tuple[str, str]]).
+            state: Per-feed state (see `data_prep.feed_state`), updated in place; None fetches everything (dict).
+        """
+        create_db()
+
+        index: Optional[LSHIndex] = None
+        if self.dedup:
+            conn = connect(DB_PATH)
+            index = load_lsh_index(conn, self.dedup_threshold)
+            conn.close()
+
+        threads: list[threading.Thread] = [
+            threading.Thread(target=self._guard, args=(self._feed_stage, feeds, state), name="ingest-feeds", daemon=True),
+            threading.Thread(target=self._guard, args=(self._download_stage,), name="ingest-downloads", daemon=True),
+        ]
+        sync: threading.Thread = threading.Thread(target=self._sync_stage, name="ingest-sync", daemon=True)
+        for thread in threads + [sync]:
+            thread.start()
+
+        try:
+            # One writer thread, batched transactions: the encoder never waits on an fsync
+            with DBWriter(DB_PATH, on_commit=self._committed.set) as writer:
+                self._embed_stage(writer, index)
+            print(writer.report())
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            self._written.set()
+            for thread in threads + [sync]:
+                thread.join()
+
+        if self.error is not None:
+            raise RuntimeError("The ingest pipeline stopped") from self.error
+
+        return self.stats
+
+    def _guard(self, stage, *args) -> None:
+        # A failed stage stops the others instead of leaving them blocked on its queue
+        try:
+            stage(*args)
+        except BaseException as e:
+            self.error = e
+            self._stop.set()
+
+    # ------------------------------------------------------------------------ #
+    # Feeds
+    # ------------------------------------------------------------------------ #
+    def _feed_stage(self, feeds: list[tuple[str, str]], state: Optional[dict]) -> None:
+        asyncio.run(self._fetch_feeds(feeds, state))
+        _put(self.links, None, self._stop)
+
+    async def _fetch_feeds(self, feeds: list[tuple[str, str]], state: Optional[dict]) -> None:
+        time_threshold: datetime = datetime.now() - timedelta(hours=48)
+        request_headers: list[dict] = [conditional_headers(state.get(url)) if state is not None else {} for _, url in feeds]
+
+        async for i, result in fetch_iter([url for _, url in feeds], per_host=self.per_host,
+                                          headers={"User-Agent": feedparser.USER_AGENT}, request_headers=request_headers):
+            name, url = feeds[i]
+
+            # Parsing and queueing happen off the event loop, the other feeds keep downloading meanwhile
+            links: list = await asyncio.to_thread(feed_links, name, url, result, time_threshold, state) or []
+            self.stats["feeds"] += 1
+
+            if not await asyncio.to_thread(self._queue_links, links):
+                return
+
+    def _queue_links(self, links: list[tuple[str, str, str]]) -> bool:
+        # The same article is often listed by several feeds
+        links = [link for link in links if link[1] not in self._seen]
+        self._seen.update(link[1] for link in links)
+
+        known: dict = stored_hashes([link[1] for link in links]) if links else {}
+        if self.refresh:
+            # Stored articles are re-checked, known near-duplicates are not
+            self._known.update(known)
+            duplicates: set[str] = {url for url, content_hash in known.items() if content_hash == KNOWN_DUPLICATE}
+            self.stats["skipped"] += len(duplicates)
+            links = [link for link in links if link[1] not in duplicates]
+        else:
+            self.stats["skipped"] += len(known)
+            links = [link for link in links if link[1] not in known]
+
+        for link in links:
+            if not _put(self.links, link, self._stop):
+                return False
+            self.stats["links"] += 1
+
+        return True
+
+    # ------------------------------------------------------------------------ #
+    # Downloads
+    # ------------------------------------------------------------------------ #
+    def _download_stage(self) -> None:
+        # Workers are started while the other stages' threads run, forking then could copy a held lock
+        pool: ProcessPoolExecutor = ProcessPoolExecutor(self.num_workers, mp_context=multiprocessing.get_context("spawn"),
+                                                        initializer=init_worker, initargs=(METRICS.worker_config(),))
+        pending: dict[Future, str] = {}
+        links_done: bool = False
+
+        try:
+            while (pending or not links_done) and not self._stop.is_set():
+                # Two links in flight per worker keep them busy without pulling the whole queue in
+                while not links_done and len(pending) < 2 * self.num_workers:
+                    try:
+                        link = self.links.get(timeout=0.05 if pending else 0.5)
+                    except queue.Empty:
+                        break
+
+                    if link is None:
+                        links_done = True
+                    else:
+                        pending[pool.submit(download_in_worker, link)] = link[1]
+
+                if not pending:
+                    continue
+
+                finished, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    url: str = pending.pop(future)
+                    article, metrics = future.result()
+                    METRICS.merge(metrics)
+
+                    if article is None:
+                        self.stats["failed"] += 1
+                        self.failed.append(url)
+                        continue
+
+                    self.stats["downloaded"] += 1
+                    if not _put(self.articles, article, self._stop):
+                        return
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        _put(self.articles, None, self._stop)
+
+    # ------------------------------------------------------------------------ #
+    # Embedding
+    # ------------------------------------------------------------------------ #
+    def _embed_stage(self, writer: DBWriter, index: Optional[LSHIndex]) -> None:
+        batch: list[dict] = []
+        duplicates: list[tuple] = []
+        deadline: float = 0.0
+        finished: bool = False
+
+        while not finished:
+            if self._stop.is_set():
+                return
+
+            # Wakes up regularly to notice a stop, and at the deadline of a partial batch
+            waiting: bool = bool(batch or duplicates)
+            timeout: float = min(max(deadline - time.perf_counter(), 0.0), 0.5) if waiting else 0.5
+
+            try:
+                article = self.articles.get(timeout=timeout)
+            except queue.Empty:
+                article = _TIMEOUT
+
+            if article is None:
+                finished = True
+            elif article is not _TIMEOUT and self._accept(article, index, batch, duplicates) and not waiting:
+                deadline = time.perf_counter() + self.max_wait
+
+            if (batch or duplicates) and (finished or len(batch) >= self.batch_size or time.perf_counter() >= deadline):
+                self._store(batch, duplicates, writer)
+                batch, duplicates = [], []
+
+    def _accept(self, article: dict, index: Optional[LSHIndex], batch: list[dict], duplicates: list[tuple]) -> bool:
+        # Files the article under the batch to embed or the near-duplicates, False if it is dropped
+        if self.refresh and self._known.get(article["url"]) == article["content_hash"]:
+            self.stats["unchanged"] += 1
+            return False
+
+        if index is None:
+            batch.append(article)
+            return True
+
+        # Syndicated copies of the same story are recorded against the first one instead of being embedded again
+        keep, found = find_duplicates([article], index)
+        batch.extend(keep)
+        duplicates.extend(found)
+
+        return True
+
+    def _store(self, batch: list[dict], duplicates: list[tuple], writer: DBWriter) -> None:
+        embed_articles(batch, self.embedding_model, writer, self.batch_size, self.embedding_dtype, self.chunk_words,
+                       self.chunk_overlap, self.embedding_dims, self.bias_classifier)
+
+        # After the canonical rows, which may be in this very batch
+        for url, canonical_url, source, score in duplicates:
+            writer.put((url, canonical_url, source, score), INSERT_DUPLICATE)
+        # A refreshed canonical row was replaced whole and lost its list of URLs too
+        for canonical_url in {duplicate[1] for duplicate in duplicates} | ({article["url"] for article in batch} if self.refresh else set()):
+            writer.put((canonical_url,), UPDATE_ALT_URLS)
+
+        count("articles_duplicate", len(duplicates))
+        self.stats["stored"] += len(batch)
+        self.stats["duplicates"] += len(duplicates)
+
+        print(f"Stored {self.stats['stored']} articles ({self.stats['duplicates']} near-duplicates), "
+              f"{self.links.qsize()} links and {self.articles.qsize()} articles queued")
+
+    # ------------------------------------------------------------------------ #
+    # Sync
+    # ------------------------------------------------------------------------ #
+    def _sync_stage(self) -> None:
+        # The service only sees rows that are in the sidecar, so committed rows are filed as they come.
+        # The last commits are left to `stream_ingest`, which syncs once the writer is done.
+        last: float = time.perf_counter()
+
+        while not self._written.wait(0.5):
+            if not self._committed.is_set() or time.perf_counter() - last < self.sync_interval:
+                continue
+
+            self._committed.clear()
+            try:
+                sync_index(DB_PATH)
+                sync_matrix_file(DB_PATH)
+            except Exception as e:
+                # A failed sync only delays the new rows until the next one
+                error("sync", e)
+                print(f"Error syncing the index: {e}")
+            last = time.perf_counter()
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Stream Ingest                                                                #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def stream_ingest(embedding_model: "SentenceTransformer", num_feeds: Optional[int] = None,
+                  state_path: Optional[str] = STATE_PATH, **options) -> dict:
+    """
+    Scrapes the feeds and stores their new articles in one streaming pass, the
+    counterpart of `scrape` followed by `store_vectors`.
+
+    Args:
+        embedding_model: The loaded Sentence Transformer model (SentenceTransformer).
+        num_feeds: Only read this many randomly chosen feeds (int).
+        state_path: File holding the per-feed state, so that only new entries are read.
+            None reads everything (Optional[str]).
+        **options: Options of `IngestPipeline`.
+
+    Returns:
+        dict: The pipeline's `stats`.
+    """
+    start_time: datetime = datetime.now()
+
+    feeds: list[tuple[str, str]] = get_feeds()
+    if num_feeds:
+        random.shuffle(feeds)
+        feeds = feeds[:num_feeds]
+
+    state: Optional[dict] = load_state(state_path) if state_path else None
+
+    pipeline: IngestPipeline = IngestPipeline(embedding_model, **options)
+    stats: dict = pipeline.run(feeds, state)
+
+    # Only now that the run's links are written, and with the failed ones handed back for the next poll
+    if state_path:
+        settle_entries(state, pipeline.failed)
+        save_state(state, state_path)
+
+    # Files the new rows in the ANN index and the memory-mapped matrix, if they were built
+    sync_index(DB_PATH)
+    sync_matrix_file(DB_PATH)
+
+    seconds: float = max((datetime.now() - start_time).total_seconds(), 1e-9)
+    print(f"Read {stats['feeds']} feeds and stored {stats['stored']} of {stats['links']} new links in {datetime.now() - start_time} "
+          f"({stats['stored'] / seconds:.1f} articles/sec); {stats['skipped']} already stored, {stats['failed']} failed, "
+          f"{stats['duplicates']} near-duplicates")
+
+    return stats
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Main                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrape the feeds and store their new articles in one streaming pass.")
+    parser.add_argument("--num-feeds", type=int, default=None, help="only read this many randomly chosen feeds")
+    parser.add_argument("--model", default="Alibaba-NLP_gte-large-en-v1.5", help="SentenceTransformer name or path")
+    parser.add_argument("--bias", action="store_true", help="score and store the bias of every new article")
+    parser.add_argument("--workers", type=int, default=4, help="download processes")
+    parser.add_argument("--batch-size", type=int, default=32, help="articles per encode call")
+    parser.add_argument("--max-wait", type=float, default=2.0, help="seconds a partial batch waits before it is embedded")
+    args = parser.parse_args()
+
+    from inference.embedder import load_custom_sentence_transformer
+
+    classifier = None
+    if args.bias:
+        from inference.bias import get_bias_decector
+        classifier = get_bias_decector()
+
+    stream_ingest(load_custom_sentence_transformer(args.model), args.num_feeds, bias_classifier=classifier,
+                  num_workers=args.workers, batch_size=args.batch_size, max_wait=args.max_wait)
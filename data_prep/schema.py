@@ -0,0 +1,169 @@
+"""
+Schema of the 'embeddings' table, shared by the ingest path, the migration
+command and the query side so that they all agree on the columns.
+"""
+import sqlite3
+from datetime import datetime, timezone
+from typing import Optional
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Tables                                                                       #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+DB_PATH: str = "embeddings.db"
+
+# publication_date is always stored in this format, so dates compare as strings
+DATE_FORMAT: str = "%Y-%m-%d %H:%M:%S"
+
+EMBEDDINGS_TABLE: str = '''CREATE TABLE IF NOT EXISTS {name}
+                 (url TEXT PRIMARY KEY,
+                  text TEXT,
+                  source TEXT,
+                  authors TEXT,
+                  title TEXT,
+                  publication_date TEXT,
+                  bias REAL,
+                  embedding BLOB,
+                  embedding_dtype TEXT,
+                  embedding_dim INTEGER,
+                  content_hash TEXT,
+                  minhash BLOB,
+                  alt_urls TEXT)'''
+
+# Passages of long articles, embedded separately when articles are stored in chunked mode.
+# start/end are word offsets into the article text, so overlapping passages can be merged back.
+PASSAGES_TABLE: str = '''CREATE TABLE IF NOT EXISTS passages
+                 (id INTEGER PRIMARY KEY,
+                  url TEXT NOT NULL,
+                  position INTEGER,
+                  start INTEGER,
+                  end INTEGER,
+                  text TEXT,
+                  embedding BLOB,
+                  embedding_dtype TEXT,
+                  embedding_dim INTEGER)'''
+
+# Near-duplicates that were not stored, with the article they duplicate (see data_prep.dedup)
+DUPLICATES_TABLE: str = '''CREATE TABLE IF NOT EXISTS duplicates
+                 (url TEXT PRIMARY KEY,
+                  canonical_url TEXT NOT NULL,
+                  source TEXT,
+                  similarity REAL)'''
+
+# Full-text index over title and text for keyword and hybrid retrieval. It is an external
+# content table (the text is not stored twice) kept in sync by triggers on 'embeddings'.
+FTS_TABLE: str = '''CREATE VIRTUAL TABLE IF NOT EXISTS embeddings_fts
+                 USING fts5(title, text, content='embeddings', content_rowid='rowid', tokenize='porter unicode61')'''
+
+# INSERT OR REPLACE only fires the delete trigger with `PRAGMA recursive_triggers = ON`, which `connect` sets
+FTS_TRIGGERS: list[str] = [
+    '''CREATE TRIGGER IF NOT EXISTS embeddings_fts_insert AFTER INSERT ON embeddings BEGIN
+           INSERT INTO embeddings_fts (rowid, title, text) VALUES (new.rowid, new.title, new.text);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS embeddings_fts_delete AFTER DELETE ON embeddings BEGIN
+           INSERT INTO embeddings_fts (embeddings_fts, rowid, title, text) VALUES ('delete', old.rowid, old.title, old.text);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS embeddings_fts_update AFTER UPDATE OF title, text ON embeddings BEGIN
+           INSERT INTO embeddings_fts (embeddings_fts, rowid, title, text) VALUES ('delete', old.rowid, old.title, old.text);
+           INSERT INTO embeddings_fts (rowid, title, text) VALUES (new.rowid, new.title, new.text);
+       END''',
+]
+
+# Columns that were added after the first version of the table, with their types
+ADDED_COLUMNS: list[tuple[str, str]] = [
+    ("embedding_dtype", "TEXT"),
+    ("embedding_dim", "INTEGER"),
+    ("content_hash", "TEXT"),
+    ("minhash", "BLOB"),
+    ("alt_urls", "TEXT"),
+]
+
+def table_columns(conn: sqlite3.Connection, table: str = "embeddings") -> list[str]:
+    """
+    Returns the column names of a table, in order (empty if the table does not exist).
+    """
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+def ensure_schema(conn: sqlite3.Connection) -> None:
+    """
+    Creates the 'embeddings', 'passages' and 'duplicates' tables and the full-text index if needed and adds any column an older database is missing.
+
+    Legacy databases keep their TEXT embeddings until `python -m data_prep.migrate`
+    is run, but new rows can be written to them straight away.
+
+    Args:
+        conn: An open connection to the database (sqlite3.Connection).
+
+    Returns:
+        None
+    """
+    conn.execute(EMBEDDINGS_TABLE.format(name="embeddings"))
+
+    existing: list[str] = table_columns(conn)
+    for column, column_type in ADDED_COLUMNS:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE embeddings ADD COLUMN {column} {column_type}")
+
+    # Retention deletes by date range
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_publication_date ON embeddings (publication_date)")
+
+    conn.execute(PASSAGES_TABLE)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_passages_url ON passages (url)")
+
+    conn.execute(DUPLICATES_TABLE)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_duplicates_canonical_url ON duplicates (canonical_url)")
+
+    # Missing triggers mean a new full-text index, or a table rebuilt by the migration: index what is there
+    indexed: bool = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'embeddings_fts_insert'").fetchone() is not None
+    conn.execute(FTS_TABLE)
+    for trigger in FTS_TRIGGERS:
+        conn.execute(trigger)
+    if not indexed:
+        conn.execute("INSERT INTO embeddings_fts (embeddings_fts) VALUES ('rebuild')")
+
+    conn.commit()
+
+def table_generation(conn: sqlite3.Connection) -> int:
+    """
+    Counter bumped every time the 'embeddings' table is rewritten (kept in `PRAGMA user_version`).
+    Indexes built next to the database record it and are rebuilt once it moves on.
+    """
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def bump_table_generation(conn: sqlite3.Connection) -> int:
+    """
+    Marks the 'embeddings' table as rewritten, inside the caller's transaction.
+
+    Returns:
+        int: The new generation.
+    """
+    generation: int = table_generation(conn) + 1
+    conn.execute(f"PRAGMA user_version = {generation}")
+
+    return generation
+
+def normalize_date(value: Optional[str]) -> Optional[str]:
+    """
+    Rewrites a publication date in `DATE_FORMAT` (accepts ISO 8601 variants and bare dates).
+
+    Args:
+        value: The date as scraped (str).
+
+    Returns:
+        Optional[str]: The normalised date, or None if it cannot be parsed.
+    """
+    if not value:
+        return None
+
+    try:
+        parsed: datetime = datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return parsed.strftime(DATE_FORMAT)
@@ -11,10 +11,15 @@ amount of computation.
 #                                                                              #
 # ---------------------------------------------------------------------------- #
 import feedparser
-import multiprocessing
 from datetime import datetime, timedelta
 import random
 
+from typing import Optional
+
+from data_prep.fetch import fetch_urls, FetchResult
+from data_prep.metrics import span
+from data_prep.feed_state import conditional_headers, update_feed_state, body_hash, entry_id
+
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
@@ -49,80 +54,128 @@ def get_feeds() -> list[tuple[str, str]]:
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
-def parse_section(
-    start: int, end: int, feeds: list[tuple[str, str]], link_list: list[tuple[str, str]]) -> None:
+def parse_entries(name: str, d: feedparser.FeedParserDict, time_threshold: datetime) -> list[tuple[str, str, str]]:
   """
-  A helper function used for parallel parsing. It takes a starting index, ending index, list of feeds, and a link list as arguments.
-  It iterates over the assigned chunk of feeds, parses entries for entries published in the last 48 hours, and appends them to the link list.
+  Goes through the entries of a parsed feed and keeps the ones published after `time_threshold`.
 
   Args:
-      start: The starting index of the feed chunk to process (int).
-      end: The ending index (exclusive) of the feed chunk to process (int).
-      feeds: The list of RSS feeds to parse (list[tuple[str, str]]).
-      link_list: list of links...
+      name: Name of the RSS feed (str).
+      d: The feed as parsed by feedparser, or any mapping with its "entries" (feedparser.FeedParserDict).
+      time_threshold: Entries published before this are skipped (datetime).
 
   Returns:
-      None
+      list[tuple[str, str, str]]: A list of (feed name, link, publication date) tuples.
   """
-  links: list[tuple[str, str]] = []
-  current_time: datetime = datetime.now() 
-  time_threshold: datetime = current_time - timedelta(hours=48)  
+  links: list[tuple[str, str, str]] = []
+
+  for entry in d["entries"]:
+    published_time: datetime | None = None  
+
+    try:
+      if "published_parsed" in entry and entry.published_parsed:
+        published_time = datetime(*entry.published_parsed[:6])
+      elif "updated_parsed" in entry and entry.updated_parsed:
+        published_time = datetime(*entry.updated_parsed[:6])
+    except Exception as e:
+      print(f"Error parsing date for {entry.link}: {e}")
+
+    if published_time and published_time > time_threshold:
+      pt_str = published_time.strftime("%Y-%m-%d %H:%M:%S")
+      links.append((name, entry.link, pt_str)) 
+
+  return links
+
+
+def feed_links(name: str, url: str, result: FetchResult, time_threshold: datetime,
+               state: Optional[dict] = None) -> Optional[list[tuple[str, str, str]]]:
+  """
+  The new links of one fetched feed.
+
+  Args:
+      name: The feed name (str).
+      url: The feed URL (str).
+      result: The answer to the feed request (FetchResult).
+      time_threshold: Entries published before this are dropped (datetime).
+      state: Per-feed state keyed by feed URL, updated in place; None to keep every entry. The new entries
+          are marked as seen and listed as pending until `settle_entries` (dict).
+
+  Returns:
+      Optional[list[tuple[str, str, str]]]: (feed name, link, publication date) of every new entry, None if the
+      feed failed or did not change since the last poll.
+  """
+  if state is not None and result.status == 304:
+    state[url] = update_feed_state(state.get(url), result.headers)
+    return None
 
-  for i in range(start, end):
-    feed = feeds[i]
-    name: str = feed[0]  # Name of the RSS feed
-    url: str = feed[1]  # URL of the RSS feed
-    d = feedparser.parse(url)  
+  if not result.ok:
+    print(f"Failed to fetch {name} ({url}): {result.error}")
+    return None
 
-    for entry in d.entries:
-      published_time: datetime | None = None  
+  if state is not None and state.get(url, {}).get("hash") == body_hash(result.body):
+    state[url] = update_feed_state(state.get(url), result.headers, result.body)
+    return None
 
-      try:
-        if "published_parsed" in entry and entry.published_parsed:
-          published_time = datetime(*entry.published_parsed[:6])
-        elif "updated_parsed" in entry and entry.updated_parsed:
-          published_time = datetime(*entry.updated_parsed[:6])
-      except Exception as e:
-        print(f"Error parsing date for {entry.link}: {e}")
+  # The headers let feedparser pick the right character encoding
+  with span("feed_parse"):
+    d = feedparser.parse(result.body, response_headers=result.headers)
 
-      if published_time and published_time > time_threshold:
-        pt_str = published_time.strftime("%Y-%m-%d %H:%M:%S")
-        links.append((name, entry.link, pt_str)) 
+  if state is None:
+    return parse_entries(name, d, time_threshold)
 
-  link_list.extend(links)  
+  seen: set[str] = set(state.get(url, {}).get("seen", []))
+  new_entries: list = [entry for entry in d.entries if entry_id(entry) not in seen]
 
+  state[url] = update_feed_state(state.get(url), result.headers, result.body, [entry_id(entry) for entry in d.entries])
+  # Seen from now on, unless `settle_entries` hands back the ones whose article was not stored
+  state[url]["pending"] = {entry.get("link", ""): entry_id(entry) for entry in new_entries}
 
-def parse_rss(feeds: list[tuple[str, str]]) -> list[tuple[str, str]]:
+  return parse_entries(name, {"entries": new_entries}, time_threshold)
+
+def parse_rss(feeds: list[tuple[str, str]], per_host: int = 4, timeout: float = 15.0, retries: int = 2,
+              state: Optional[dict] = None) -> list[tuple[str, str, str]]:
   """
-  This function takes a list of feeds as input. It creates a specified number of worker processes using multiprocessing.
-  Each process calls the `parse_section` function to process a chunk of feeds concurrently. Finally, it combines the results from all processes and returns a list of scraped links.
+  This function takes a list of feeds as input. All the feeds are downloaded concurrently by the asyncio
+  fetcher in `data_prep.fetch` (one pooled connection set, at most `per_host` connections per host,
+  timeouts and retries with backoff), then feedparser parses the bytes of every feed that answered and
+  the entries published in the last 48 hours are kept.
+
+  When a feed `state` (see `data_prep.feed_state`) is given, requests are conditional: feeds that answer
+  304, or send back the exact body of the last poll, are skipped without parsing, and entries that were
+  already seen are not emitted again. The state is updated in place.
 
   Args:
       feeds: The list of RSS feeds to parse (list[tuple[str, str]]).
+      per_host: Maximum number of simultaneous connections to one host (int).
+      timeout: Connect/read timeout of one attempt, in seconds (float).
+      retries: Number of extra attempts for a feed that failed (int).
+      state: Per-feed state keyed by feed URL, None to fetch everything in full (dict).
 
   Returns:
-      list[tuple[str, str]]: A list of tuples containing the feed name and scraped link.
+      list[tuple[str, str, str]]: A list of tuples containing the feed name, scraped link and publication date.
   """
-  # I've found that 4 is the fastest for my mac - yours might be different
-  num_multiprocessers: int = 4
-  chunk_size: int = len(feeds) // num_multiprocessers + 1
+  current_time: datetime = datetime.now() 
+  time_threshold: datetime = current_time - timedelta(hours=48)  
+
+  request_headers: list[dict] = [conditional_headers(state.get(url)) if state is not None else {} for _, url in feeds]
+  results: list[FetchResult] = fetch_urls([url for _, url in feeds], per_host=per_host, timeout=timeout, retries=retries,
+                                          headers={"User-Agent": feedparser.USER_AGENT}, request_headers=request_headers)
 
-  with multiprocessing.Manager() as manager:
-    link_list: multiprocessing.Manager.list = manager.list()
-    processes: list[multiprocessing.Process] = []
+  links: list[tuple[str, str, str]] = []
+  unchanged: int = 0
 
-    for i in range(num_multiprocessers):
-      start: int = i * chunk_size
-      end: int = min((i + 1) * chunk_size, len(feeds))
+  for (name, url), result in zip(feeds, results):
+    new_links: Optional[list[tuple[str, str, str]]] = feed_links(name, url, result, time_threshold, state)
 
-      p: multiprocessing.Process = multiprocessing.Process(target=parse_section, args=(start, end, feeds, link_list), name=f"Process {i+1}")
-      processes.append(p)
-      p.start()
+    if new_links is None:
+      # Failed feeds were reported by `feed_links`, the others did not change
+      if result.ok or result.status == 304:
+        unchanged += 1
+      continue
 
-    for p in processes:
-      p.join()
+    links.extend(new_links)
 
-    links: list[tuple[str, str]] = list(link_list)
+  if state is not None:
+    print(f"{unchanged} of {len(feeds)} feeds unchanged since the last poll")
 
   return links
 
@@ -133,11 +186,18 @@ def parse_rss(feeds: list[tuple[str, str]]) -> list[tuple[str, str]]:
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
-def scrape(num_feeds = None) -> list[tuple[str, str]]:
+def scrape(num_feeds = None, state: Optional[dict] = None) -> list[tuple[str, str]]:
     """
     The main function of the script. It calls `get_feeds` to retrieve RSS feed information, then calls `parse_rss` to scrape links from those feeds in parallel.
     Finally, it prints the time taken to scrape all the links and returns the scraped links.
 
+    Args:
+        num_feeds: Only scrape this many randomly chosen feeds (int).
+        state: Per-feed ETag/Last-Modified/seen-entries state (`load_state`), so that only new entries
+            are returned. It is updated in place; once the links went through ingestion the caller
+            hands back the ones that were not stored (`settle_entries`) and saves it. None fetches
+            and returns everything (dict).
+
     Returns:
         list[tuple[str, str]]: A list of tuples containing the feed name and scraped link.
     """
@@ -151,7 +211,7 @@ def scrape(num_feeds = None) -> list[tuple[str, str]]:
     else:
       feeds: list[tuple[str, str]] = get_feeds()
 
-    links: list[tuple[str, str]] = parse_rss(feeds)  
+    links: list[tuple[str, str]] = parse_rss(feeds, state=state)
 
     end: datetime = datetime.now() 
 
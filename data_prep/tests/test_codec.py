@@ -0,0 +1,60 @@
+import json
+
+import numpy as np
+import pytest
+
+from data_prep.codec import decode_embedding, encode_embedding, get_dtype
+
+VECTOR: np.ndarray = np.random.default_rng(0).standard_normal(384).astype(np.float32)
+
+def cosine(a: np.ndarray, b: np.ndarray) -> float:
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+def test_float32_round_trip_is_exact():
+    blob, dtype, dim = encode_embedding(VECTOR, "float32")
+
+    assert (dtype, dim, len(blob)) == ("float32", 384, 384 * 4)
+    assert np.array_equal(decode_embedding(blob, dtype, dim), VECTOR)
+
+def test_float16_round_trip_is_close():
+    blob, dtype, dim = encode_embedding(VECTOR, "float16")
+
+    assert (dtype, dim, len(blob)) == ("float16", 384, 384 * 2)
+    assert np.allclose(decode_embedding(blob, dtype, dim), VECTOR, rtol=1e-3, atol=1e-3)
+
+def test_int8_round_trip_is_within_half_a_step():
+    blob, dtype, dim = encode_embedding(VECTOR, "int8")
+    decoded: np.ndarray = decode_embedding(blob, dtype, dim)
+    scale: float = float(np.abs(VECTOR).max()) / 127
+
+    # One float32 scale, then one byte per dimension
+    assert (dtype, dim, len(blob)) == ("int8", 384, 4 + 384)
+    assert np.abs(decoded - VECTOR).max() <= scale / 2 + 1e-6
+    assert cosine(decoded, VECTOR) > 0.999
+
+def test_int8_zero_vector_stays_zero():
+    blob, dtype, dim = encode_embedding(np.zeros(8, dtype=np.float32), "int8")
+
+    assert not decode_embedding(blob, dtype, dim).any()
+
+@pytest.mark.parametrize("dtype", ["float32", "float16", "int8"])
+def test_dims_keeps_the_leading_dimensions(dtype):
+    blob, _, dim = encode_embedding(VECTOR, dtype, dims=128)
+    decoded: np.ndarray = decode_embedding(blob, dtype, dim)
+
+    assert dim == 128
+    assert decoded.shape == (128,)
+    assert cosine(decoded, VECTOR[:128]) > 0.999
+
+def test_dim_mismatch_is_an_error():
+    blob, dtype, _ = encode_embedding(VECTOR, "float16")
+
+    with pytest.raises(ValueError):
+        decode_embedding(blob, dtype, 383)
+
+def test_legacy_json_text_is_decoded():
+    assert np.allclose(decode_embedding(json.dumps([0.5, -1.0, 2.0])), [0.5, -1.0, 2.0])
+
+def test_unknown_dtype_is_an_error():
+    with pytest.raises(ValueError):
+        get_dtype("bfloat16")
@@ -0,0 +1,73 @@
+import sqlite3
+
+import pytest
+
+from data_prep import vec_db
+from data_prep.dedup import LSHIndex, decode_signature, find_duplicates, minhash_signature
+
+STORY: str = " ".join(f"word{i}" for i in range(300))
+
+def article(url: str, text: str) -> dict:
+    # An article as `download_article` returns it
+    return {
+        "url": url,
+        "text": text,
+        "source": "BBC News",
+        "authors": ["A Reporter"],
+        "title": "A story",
+        "publication_date": "2024-06-19 12:00:00",
+        "content_hash": vec_db.content_hash(text),
+        "minhash": minhash_signature(text),
+    }
+
+def ingest(monkeypatch, embedder, articles: list[dict], **options) -> list[str]:
+    # `store_vectors` with the downloads replaced by `articles`, returns the URLs it asked for
+    requested: list[str] = []
+
+    def download_articles(links, num_workers=4):
+        requested.extend(link[1] for link in links)
+        return [a for a in articles if a["url"] in requested]
+
+    monkeypatch.setattr(vec_db, "download_articles", download_articles)
+    links: list[tuple] = [("BBC News", a["url"], a["publication_date"]) for a in articles]
+    vec_db.store_vectors(links, embedder, num_workers=1, **options)
+
+    return requested
+
+def test_copy_under_another_url_is_a_duplicate():
+    index: LSHIndex = LSHIndex()
+    keep, duplicates = find_duplicates([article("http://a/1", STORY), article("http://b/1", STORY)], index)
+
+    assert [a["url"] for a in keep] == ["http://a/1"]
+    assert [(d[0], d[1]) for d in duplicates] == [("http://b/1", "http://a/1")]
+
+def test_query_skips_the_excluded_key():
+    index: LSHIndex = LSHIndex()
+    signature = decode_signature(minhash_signature(STORY))
+    index.add("http://a/1", signature)
+
+    assert index.query(signature)[0] == "http://a/1"
+    assert index.query(signature, exclude="http://a/1") is None
+
+def test_refreshed_article_is_reembedded_not_its_own_duplicate(workdir, monkeypatch, embedder):
+    ingest(monkeypatch, embedder, [article("http://a/1", STORY), article("http://b/1", "something else entirely " * 20)])
+
+    edited: dict = article("http://a/1", STORY + " correction appended")
+    ingest(monkeypatch, embedder, [edited], refresh=True)
+
+    conn: sqlite3.Connection = sqlite3.connect("embeddings.db")
+    stored_hash, alt_urls = conn.execute("SELECT content_hash, alt_urls FROM embeddings WHERE url = 'http://a/1'").fetchone()
+    duplicates: list = conn.execute("SELECT url, canonical_url FROM duplicates").fetchall()
+    conn.close()
+
+    assert stored_hash == edited["content_hash"]
+    assert duplicates == []
+    assert "http://a/1" not in (alt_urls or "")
+
+def test_refresh_does_not_download_known_duplicates_again(workdir, monkeypatch, embedder):
+    original, copy = article("http://a/1", STORY), article("http://b/1", STORY)
+    ingest(monkeypatch, embedder, [original, copy])
+
+    assert vec_db.stored_hashes(["http://a/1", "http://b/1"]) == {"http://a/1": original["content_hash"],
+                                                                 "http://b/1": vec_db.KNOWN_DUPLICATE}
+    assert ingest(monkeypatch, embedder, [original, copy], refresh=True) == ["http://a/1"]
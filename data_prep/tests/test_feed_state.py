@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+from email.utils import format_datetime
+
+from data_prep.feed_state import settle_entries
+from data_prep.fetch import FetchResult
+from data_prep.scrape import feed_links
+
+FEED_URL: str = "http://feeds.invalid/world.xml"
+
+def poll(state: dict) -> list:
+    # One fetch of a feed with two fresh entries, always the same body and ETag
+    published: str = format_datetime(datetime.now().astimezone() - timedelta(hours=1))
+    items: str = "".join(f"<item><guid>id-{n}</guid><link>http://news.invalid/{n}</link><pubDate>{published}</pubDate></item>"
+                         for n in (1, 2))
+    body: bytes = f'<?xml version="1.0"?><rss version="2.0"><channel><title>World</title>{items}</channel></rss>'.encode()
+    result: FetchResult = FetchResult(FEED_URL, 200, body, {"etag": '"v1"', "content-type": "application/rss+xml"})
+
+    links = feed_links("BBC News", FEED_URL, result, datetime.now() - timedelta(hours=48), state)
+    return [link[1] for link in links] if links is not None else None
+
+def test_stored_entries_are_not_offered_again():
+    state: dict = {}
+    assert poll(state) == ["http://news.invalid/1", "http://news.invalid/2"]
+
+    assert settle_entries(state, []) == 0
+    assert "pending" not in state[FEED_URL]
+    # Same body as the last poll: skipped without parsing
+    assert poll(state) is None
+
+def test_failed_entries_are_offered_again():
+    state: dict = {}
+    poll(state)
+
+    assert settle_entries(state, ["http://news.invalid/2"]) == 1
+    assert state[FEED_URL]["seen"] == ["id-1"]
+    assert "etag" not in state[FEED_URL]
+    assert poll(state) == ["http://news.invalid/2"]
@@ -0,0 +1,95 @@
+import sqlite3
+import time
+
+from data_prep import pipeline
+from data_prep.db_writer import DBWriter, INSERT_DUPLICATE
+from data_prep.dedup import minhash_signature
+from data_prep.matrix_file import build_matrix_file, read_manifest
+from data_prep.vec_db import content_hash, create_db
+
+STORY: str = " ".join(f"word{i}" for i in range(300))
+
+def article(url: str, text: str) -> dict:
+    # An article as `download_article` returns it
+    return {"url": url, "text": text, "source": "BBC News", "authors": ["A Reporter"], "title": "A story",
+            "publication_date": "2024-06-19 12:00:00", "content_hash": content_hash(text), "minhash": minhash_signature(text)}
+
+def run(monkeypatch, embedder, articles: dict, synced: int = 0, **options) -> tuple[pipeline.IngestPipeline, dict]:
+    # A pipeline whose feeds list the URLs of `articles` and whose downloads return them (None fails).
+    # The download stage only finishes once `synced` rows showed up in the matrix sidecar (or 10 seconds passed).
+    observed: dict = {"requested": [], "synced": 0}
+
+    def feed_stage(self, feeds, state):
+        self._queue_links([("BBC News", url, "2024-06-19 12:00:00") for url in articles])
+        pipeline._put(self.links, None, self._stop)
+
+    def download_stage(self):
+        while (link := self.links.get()) is not None:
+            observed["requested"].append(link[1])
+            if articles[link[1]] is None:
+                self.stats["failed"] += 1
+                self.failed.append(link[1])
+            else:
+                self.stats["downloaded"] += 1
+                self.articles.put(articles[link[1]])
+
+        deadline: float = time.perf_counter() + 10
+        while observed["synced"] < synced and time.perf_counter() < deadline:
+            time.sleep(0.05)
+            observed["synced"] = int((read_manifest()["ids"] >= 0).sum())
+        self.articles.put(None)
+
+    monkeypatch.setattr(pipeline.IngestPipeline, "_feed_stage", feed_stage)
+    monkeypatch.setattr(pipeline.IngestPipeline, "_download_stage", download_stage)
+
+    ingest: pipeline.IngestPipeline = pipeline.IngestPipeline(embedder, max_wait=0.05, sync_interval=0, **options)
+    ingest.run([])
+
+    return ingest, observed
+
+def test_db_writer_reports_every_commit(workdir):
+    create_db()
+    commits: list[int] = []
+
+    with DBWriter("embeddings.db", sql=INSERT_DUPLICATE, batch_size=2, on_commit=lambda: commits.append(1)) as writer:
+        for n in range(5):
+            writer.put((f"http://b/{n}", "http://a/1", "BBC News", 1.0))
+
+    assert writer.rows == 5
+    assert len(commits) == 3
+
+def test_rows_are_synced_while_the_pipeline_runs(workdir, monkeypatch, embedder):
+    create_db()
+    build_matrix_file()
+
+    ingest, observed = run(monkeypatch, embedder, {"http://a/1": article("http://a/1", STORY),
+                                                   "http://b/1": article("http://b/1", STORY),
+                                                   "http://c/1": article("http://c/1", "an unrelated story " * 20),
+                                                   "http://d/1": None}, synced=2)
+
+    assert (ingest.stats["stored"], ingest.stats["duplicates"], ingest.stats["failed"]) == (2, 1, 1)
+    assert ingest.failed == ["http://d/1"]
+    # Before the last article was handed over, not by a sync after the run
+    assert observed["synced"] == 2
+
+def test_refresh_reembeds_changed_articles_only(workdir, monkeypatch, embedder):
+    create_db()
+    build_matrix_file()
+    original: dict = article("http://a/1", STORY)
+    other: dict = article("http://c/1", "an unrelated story " * 20)
+    run(monkeypatch, embedder, {"http://a/1": original, "http://b/1": article("http://b/1", STORY), "http://c/1": other})
+
+    edited: dict = article("http://a/1", STORY + " correction appended")
+    ingest, observed = run(monkeypatch, embedder, {"http://a/1": edited, "http://b/1": article("http://b/1", STORY),
+                                                   "http://c/1": other}, refresh=True)
+
+    conn: sqlite3.Connection = sqlite3.connect("embeddings.db")
+    stored_hash: str = conn.execute("SELECT content_hash FROM embeddings WHERE url = 'http://a/1'").fetchone()[0]
+    duplicates: list = conn.execute("SELECT url, canonical_url FROM duplicates").fetchall()
+    conn.close()
+
+    # The known near-duplicate is not downloaded again, the unchanged article is not embedded again
+    assert observed["requested"] == ["http://a/1", "http://c/1"]
+    assert (ingest.stats["stored"], ingest.stats["unchanged"], ingest.stats["skipped"]) == (1, 1, 1)
+    assert stored_hash == edited["content_hash"]
+    assert duplicates == [("http://b/1", "http://a/1")]
@@ -1,14 +1,25 @@
 import sqlite3
-from newspaper import Article
-from sentence_transformers import SentenceTransformer
-import torch
 import multiprocessing
-from ast import literal_eval
-from tqdm import tqdm
-import os
-from typing import List, Tuple, Optional
+import hashlib
+import numpy as np
+from typing import List, Tuple, Optional, TYPE_CHECKING
 from datetime import datetime, timedelta
 
+# newspaper and sentence_transformers are only imported where they are used, so that
+# cleaning the database does not load them (and torch) at all
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+from data_prep.codec import encode_embedding, DEFAULT_DTYPE
+from data_prep.schema import ensure_schema, normalize_date, DB_PATH, DATE_FORMAT
+from data_prep.db_writer import DBWriter, connect, INSERT_ARTICLE, INSERT_PASSAGE, DELETE_PASSAGES, INSERT_DUPLICATE, UPDATE_ALT_URLS
+from data_prep.dedup import minhash_signature, load_lsh_index, find_duplicates, DUPLICATE_THRESHOLD
+from data_prep.chunking import chunk_text, CHUNK_OVERLAP
+from data_prep.ann import sync_index
+from inference.bias import get_biases
+from data_prep.matrix_file import sync_matrix_file
+from data_prep.metrics import METRICS, init_worker, span, count, error
+
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
@@ -23,50 +34,77 @@ def create_db() -> None:
 
     The table has the following columns:
         * url (TEXT, PRIMARY KEY): Unique identifier for the article (the URL).
-        * embedding (BLOB): Stores the article's embedding (if it's generated). This column can be null.
+        * embedding (BLOB): Stores the article's embedding as raw little-endian floats (see `data_prep.codec`). This column can be null.
+        * embedding_dtype (TEXT): The dtype the embedding was written with ("float32", "float16" or "int8").
+        * embedding_dim (INTEGER): The number of values in the embedding.
         * text (TEXT): Full text content of the article (if available). This column can be null.
         * source (TEXT): Source of the article (e.g., news website name).
         * authors (TEXT): Comma-separated list of the article's authors (if available). This column can be null.
         * title (TEXT): Title of the article.
         * publication_date (TEXT): Publication date of the article.
+        * content_hash (TEXT): Hash of the article text, to tell whether a re-downloaded article changed.
+        * bias (REAL): Probability that the article is biased, scored at ingest (see `inference.bias`). This column can be null.
 
     This function ensures the table exists using `CREATE TABLE IF NOT EXISTS`, so it can be called repeatedly without creating duplicate tables.
+    Older databases get the missing columns added; run `python -m data_prep.migrate` to convert their text embeddings.
 
     Returns:
         None
     """
-    conn: sqlite3.Connection = sqlite3.connect('embeddings.db')
-    c: sqlite3.Cursor = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS embeddings
-                 (url TEXT PRIMARY KEY, 
-                  text TEXT,
-                  source TEXT,
-                  authors TEXT,
-                  title TEXT,
-                  publication_date TEXT,
-                  bias REAL,
-                  embedding TEXT)''')
-    conn.commit()
+    conn: sqlite3.Connection = connect(DB_PATH)
+    ensure_schema(conn)
     conn.close()
 
-def store_in_db(url: str, embedding: torch.Tensor, text: str, source: str, authors: str, title: str, publication_date: Optional[str]) -> None:
+def store_in_db(url: str, embedding: bytes, text: str, source: str, authors: str, title: str, publication_date: Optional[str],
+                embedding_dtype: str = DEFAULT_DTYPE, embedding_dim: Optional[int] = None, content_hash: Optional[str] = None,
+                minhash: Optional[bytes] = None, bias: Optional[float] = None) -> None:
     """
     Stores information about a scraped article and its embedding (if available) in the 'embeddings' table of a database named 'embeddings.db'.
 
     This function uses `INSERT OR REPLACE` to ensure that if an article with the same URL already exists, its information is updated with the provided data.
+    It commits a single row; the ingest path queues its rows to a `DBWriter` instead.
 
     Returns:
         None
     """
-    conn: sqlite3.Connection = sqlite3.connect('embeddings.db')
-    c: sqlite3.Cursor = conn.cursor()
-    c.execute('''INSERT OR REPLACE INTO embeddings 
-                 (url, text, source, authors, title, publication_date, embedding) 
-                 VALUES (?, ?, ?, ?, ?, ?, ?)''', 
-              (url, text, source, ', '.join(authors), title, publication_date, embedding))
-    conn.commit()
+    conn: sqlite3.Connection = connect(DB_PATH)
+    with conn:
+        conn.execute(INSERT_ARTICLE, (url, text, source, ', '.join(authors), title, publication_date,
+                                      embedding, embedding_dtype, embedding_dim, content_hash, minhash, bias))
+    conn.close()
+
+# What `stored_hashes` returns for a URL recorded as a near-duplicate, which has no row and no hash of its own
+KNOWN_DUPLICATE: str = "duplicate"
+
+def stored_hashes(urls: List[str]) -> dict:
+    """
+    Looks up which of `urls` are already in the database, in one query: the URLs are
+    loaded into a temporary table and joined against the `url` primary key.
+
+    Args:
+        urls: The URLs about to be ingested (List[str]).
+
+    Returns:
+        dict: The content hash (None for rows stored before hashes existed, `KNOWN_DUPLICATE` for known
+        duplicates) of every URL already stored.
+    """
+    conn: sqlite3.Connection = connect(DB_PATH)
+    conn.execute("CREATE TEMP TABLE incoming (url TEXT PRIMARY KEY)")
+    conn.executemany("INSERT OR IGNORE INTO incoming (url) VALUES (?)", ((url,) for url in urls))
+
+    # Known near-duplicates were never stored but must not be downloaded again either (a stored row wins)
+    rows = conn.execute("SELECT d.url, ? FROM duplicates d JOIN incoming i ON d.url = i.url", (KNOWN_DUPLICATE,)).fetchall()
+    rows += conn.execute("SELECT e.url, e.content_hash FROM embeddings e JOIN incoming i ON e.url = i.url").fetchall()
     conn.close()
 
+    return dict(rows)
+
+def content_hash(text: str) -> str:
+    """
+    Hash of an article's text, insensitive to whitespace changes.
+    """
+    return hashlib.sha1(" ".join(text.split()).encode("utf-8")).hexdigest()
+
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
@@ -75,63 +113,147 @@ def store_in_db(url: str, embedding: torch.Tensor, text: str, source: str, autho
 #                                                                              #
 # ---------------------------------------------------------------------------- #
 
-def process_links_chunk(links_chunk: List[Tuple[str, str]], embedder: SentenceTransformer, thread: int) -> None:
+def download_article(link: Tuple[str, str, str]) -> Optional[dict]:
     """
-    Processes a chunk of links from a larger list of scraped links. It iterates over each link, 
-    calls the `process_link` function to handle individual link processing (likely involving 
-    downloading content and generating an embedding), and keeps track of the processed links.
+    Downloads and parses a single link from a list of scraped links. Runs in the download
+    workers, which never see the embedding model.
 
     Args:
-        links_chunk: A list of tuples containing the feed name (str) and the article URL (str).
-        embedder: A Sentence Transformer model used for generating embeddings (SentenceTransformer).
-        thread: The ID of the current thread processing the link chunk (int).
+        link: A tuple containing the feed name (str), the article URL (str) and the publication date (str).
 
-    This function prints progress information every 100 processed links, indicating the number 
-    of links completed and the thread ID.
+    This function handles potential exceptions during download or parsing by printing an error message with the URL and the exception details.
 
     Returns:
-        None
+        Optional[dict]: The article (url, text, source, authors, title, publication_date, content_hash, minhash), or None if it failed.
     """
-    count: int = 0
+    from newspaper import Article
 
-    for link in links_chunk:
-        process_link(link, embedder)
-        count += 1
+    url: str = link[1]
+    article: Article = Article(url)
+    try:
+        with span("download"):
+            article.download()
+        with span("parse"):
+            article.parse()
+
+        count("articles_downloaded")
+        count("article_bytes", len(article.html or ""))
+
+        return {
+            "url": url,
+            "text": article.text,
+            "source": source_map(link[0]),
+            "authors": article.authors,
+            "title": article.title,
+            "publication_date": normalize_date(link[2]),
+            "content_hash": content_hash(article.text),
+            "minhash": minhash_signature(article.text),
+        }
+    except Exception as e:
+        print(f"Failed to process {url}: {e}")
+        error("download", e, url=url)
+        return None
 
-        if count % 50 == 0:
-            print(f"Completed {count} links in thread {thread}")
+def download_in_worker(link: Tuple[str, str, str]) -> Tuple[Optional[dict], Optional[dict]]:
+    # The worker's metrics travel back with every article, None while they are disabled
+    return download_article(link), METRICS.drain()
 
-def process_link(link: Tuple[str, str, str], embedder: SentenceTransformer) -> None:
+def download_articles(links: List[Tuple[str, str, str]], num_workers: int = 4) -> List[dict]:
     """
-    Processes a single link from a list of scraped links. It performs the following steps:
+    Downloads and parses links in a pool of worker processes.
 
     Args:
-        link: A tuple containing the feed name (str) and the article URL (str).
-        embedder: A Sentence Transformer model used for generating embeddings (SentenceTransformer).
+        links: List of tuples containing feed name (str), URL (str) and publication date (str).
+        num_workers: Number of download processes (int).
 
-    This function handles potential exceptions during download or parsing by printing an error message with the URL and the exception details.
+    This function prints progress information every 50 downloaded links.
+
+    Returns:
+        List[dict]: The articles that could be downloaded and parsed, as returned by `download_article`.
+    """
+    articles: List[dict] = []
+
+    with multiprocessing.Pool(num_workers, initializer=init_worker, initargs=(METRICS.worker_config(),)) as pool:
+        for done, (article, metrics) in enumerate(pool.imap_unordered(download_in_worker, links, chunksize=4), 1):
+            METRICS.merge(metrics)
+
+            if article is not None:
+                articles.append(article)
+
+            if done % 50 == 0:
+                print(f"Downloaded {done}/{len(links)} links")
+
+    return articles
+
+def embed_articles(articles: List[dict], embedder: "SentenceTransformer", writer: DBWriter, batch_size: int = 32,
+                   embedding_dtype: str = DEFAULT_DTYPE, chunk_words: Optional[int] = None, chunk_overlap: int = CHUNK_OVERLAP,
+                   embedding_dims: Optional[int] = None, bias_classifier=None) -> None:
+    """
+    Embeds parsed articles in batches and queues the rows to the database writer.
+
+    Articles are sorted by text length first so that every batch holds texts of
+    similar length and little time is spent encoding padding.
+
+    In chunked mode (`chunk_words` set) every article is split into overlapping passages
+    that are embedded and stored in the 'passages' table; the article's own embedding is
+    then the normalised mean of its passages, so nothing past the model's sequence length
+    is lost.
+
+    Args:
+        articles: Articles as returned by `download_article` (List[dict]).
+        embedder: A Sentence Transformer model used for generating embeddings (SentenceTransformer).
+        writer: The writer the rows are handed to (DBWriter).
+        batch_size: Number of articles (or passages, in chunked mode) encoded per forward pass (int).
+        embedding_dtype: The dtype embeddings are stored with, "float32", "float16" or "int8" (str).
+        chunk_words: Words per passage, None to embed every article whole (int).
+        chunk_overlap: Words shared by consecutive passages (int).
+        embedding_dims: Only store the first `embedding_dims` values of every embedding (int).
+        bias_classifier: If given, the bias of every article is scored batch by batch and stored (`get_bias_decector`).
 
     Returns:
         None
     """
-    name: str = source_map(link[0])
-    url: str = link[1]
-    article: Article = Article(url)
-    date = link[2]
-    try:
-        article.download()
-        article.parse()
-        text: str = article.text
-        authors: List[str] = article.authors
-        title: str = article.title
-        publication: str = date
+    articles = sorted(articles, key=lambda article: len(article["text"]), reverse=True)
 
-        embedding = embedder.encode(text, convert_to_tensor=True)
-        embedding_string = '[' + ', '.join([str(value.item()) for value in embedding.flatten()]) + ']'
+    for start in range(0, len(articles), batch_size):
+        batch: List[dict] = articles[start:start + batch_size]
 
-        store_in_db(url, embedding_string, text, name, authors, title, publication) 
-    except Exception as e:
-        print(f"Failed to process {url}: {e}")
+        if chunk_words:
+            chunks: List[list] = [chunk_text(article["text"], chunk_words, chunk_overlap) for article in batch]
+            with span("encode"):
+                passage_embeddings = embedder.encode([text for passages in chunks for _, _, text in passages],
+                                                     batch_size=batch_size, convert_to_numpy=True)
+
+            # Mean of the normalised passage embeddings of every article
+            bounds: np.ndarray = np.cumsum([0] + [len(passages) for passages in chunks])
+            normed: np.ndarray = passage_embeddings / np.maximum(np.linalg.norm(passage_embeddings, axis=1, keepdims=True), 1e-8)
+            embeddings = [normed[bounds[i]:bounds[i + 1]].mean(axis=0) for i in range(len(batch))]
+        else:
+            with span("encode"):
+                embeddings = embedder.encode([article["text"] for article in batch], batch_size=batch_size, convert_to_numpy=True)
+
+        count("articles_encoded", len(batch))
+
+        biases: List[Optional[float]] = [None] * len(batch)
+        if bias_classifier is not None:
+            with span("bias"):
+                biases = get_biases([article["text"] for article in batch], bias_classifier, batch_size)
+
+        for i, (article, embedding, bias) in enumerate(zip(batch, embeddings, biases)):
+            blob, dtype, dim = encode_embedding(embedding, embedding_dtype, embedding_dims)
+
+            writer.put((article["url"], article["text"], article["source"], ', '.join(article["authors"]), article["title"],
+                        article["publication_date"], blob, dtype, dim, article["content_hash"], article.get("minhash"), bias))
+
+            # A re-embedded article must not keep the passages of its previous text
+            writer.put((article["url"],), DELETE_PASSAGES)
+
+            if chunk_words:
+                p_embeddings = passage_embeddings[bounds[i]:bounds[i + 1]]
+
+                for position, ((p_start, p_end, text), p_embedding) in enumerate(zip(chunks[i], p_embeddings)):
+                    p_blob, p_dtype, p_dim = encode_embedding(p_embedding, embedding_dtype, embedding_dims)
+                    writer.put((article["url"], position, p_start, p_end, text, p_blob, p_dtype, p_dim), INSERT_PASSAGE)
 
 # ---------------------------------------------------------------------------- #
 #                                                                              #
@@ -141,15 +263,37 @@ def process_link(link: Tuple[str, str, str], embedder: SentenceTransformer) -> N
 #                                                                              #
 # ---------------------------------------------------------------------------- #
 
-def store_vectors(links: List[Tuple[str, str]], embedding_model: SentenceTransformer) -> None:
+def store_vectors(links: List[Tuple[str, str]], embedding_model: "SentenceTransformer", embedding_dtype: str = DEFAULT_DTYPE,
+                  batch_size: int = 32, num_workers: int = 4, refresh: bool = False, chunk_words: Optional[int] = None,
+                  chunk_overlap: int = CHUNK_OVERLAP, dedup: bool = True, dedup_threshold: float = DUPLICATE_THRESHOLD,
+                  embedding_dims: Optional[int] = None, bias_classifier=None) -> None:
     """
-    Stores embeddings for scraped links using multiprocessing.
+    Stores embeddings for scraped links in two stages: the links are downloaded and parsed
+    by a pool of worker processes, then a single embedding stage encodes the parsed articles
+    in length-sorted batches and writes them to the database.
 
-    Args:
-        links: List of tuples containing feed name (str) and URL (str).
-        embedding_model: Name of pre-trained model or path to custom model (str).
+    Links whose URL is already in the database are dropped before anything is downloaded
+    (the scraping windows of consecutive runs overlap). With `refresh`, they are downloaded
+    again but only re-embedded if the hash of their text changed; URLs recorded as
+    near-duplicates are still skipped.
 
-    Creates a database, loads the embedding model, and processes links in chunks using multiple processes.
+    Args:
+        links: List of tuples containing feed name (str), URL (str) and publication date (str).
+        embedding_model: The loaded Sentence Transformer model (SentenceTransformer).
+        embedding_dtype: The dtype embeddings are stored with, "float32" (default), "float16" for half the size or
+            "int8" (scaled per vector) for a quarter (str).
+        batch_size: Number of articles per encode call (int).
+        num_workers: Number of download processes (int).
+        refresh: Re-download known URLs and re-embed the ones whose text changed (bool).
+        chunk_words: Also embed every article as overlapping passages of this many words (int), see `data_prep.chunking`.
+        chunk_overlap: Words shared by consecutive passages (int).
+        dedup: Skip near-duplicates of stored or already accepted articles, see `data_prep.dedup` (bool).
+        dedup_threshold: Estimated Jaccard similarity above which an article is a duplicate (float).
+        embedding_dims: Only store the first `embedding_dims` values of every embedding, all rows of a database
+            must use the same value (int).
+        bias_classifier: Score the bias of every new article and store it in the 'bias' column (`get_bias_decector`).
+
+    Creates the database if needed, then downloads, embeds and stores the articles.
     """
     create_db()
 
@@ -158,23 +302,59 @@ def store_vectors(links: List[Tuple[str, str]], embedding_model: SentenceTransfo
     if embedding_model is None:
         return
 
-    num_multiprocessers: int = 4
-    chunk_size: int = len(links) // num_multiprocessers + 1
-
-    processes: List[multiprocessing.Process] = []
-    for i in range(num_multiprocessers):
-        start: int = i * chunk_size
-        end: int = min((i + 1) * chunk_size, len(links))
-        chunk: List[Tuple[str, str]] = links[start:end]
-        p: multiprocessing.Process = multiprocessing.Process(target=process_links_chunk, args=(chunk, embedding_model, i+1))
-        processes.append(p)
-        p.start()
-
-    for p in processes:
-        p.join()
+    # The same article is often listed by several feeds
+    links = list({link[1]: link for link in links}.values())
+    known: dict = stored_hashes([link[1] for link in links])
+
+    if not refresh:
+        links = [link for link in links if link[1] not in known]
+    else:
+        # A refresh re-checks the stored articles, a near-duplicate has no text of its own to compare
+        links = [link for link in links if known.get(link[1]) != KNOWN_DUPLICATE]
+    print(f"{len(known)} links already stored, {'re-checking' if refresh else 'skipping'} them")
+
+    articles: List[dict] = download_articles(links, num_workers)
+    download_time: datetime = datetime.now()
+
+    if refresh:
+        articles = [article for article in articles if known.get(article["url"]) != article["content_hash"]]
+
+    # Syndicated copies of the same story are recorded against the first one instead of being embedded again
+    duplicates: list = []
+    if dedup:
+        conn: sqlite3.Connection = connect(DB_PATH)
+        index = load_lsh_index(conn, dedup_threshold)
+        conn.close()
+
+        downloaded: int = len(articles)
+        articles, duplicates = find_duplicates(articles, index)
+        count("articles_duplicate", len(duplicates))
+        print(f"{len(duplicates)} of {downloaded} articles are near-duplicates "
+              f"({len(duplicates) / max(downloaded, 1):.1%}), only their URLs are stored")
+
+    # One writer thread, batched transactions: the encoder never waits on an fsync
+    with DBWriter(DB_PATH) as writer:
+        embed_articles(articles, embedding_model, writer, batch_size, embedding_dtype, chunk_words, chunk_overlap, embedding_dims,
+                       bias_classifier)
+
+        # After the canonical rows, which may have been written just above
+        for url, canonical_url, source, score in duplicates:
+            writer.put((url, canonical_url, source, score), INSERT_DUPLICATE)
+        # A refreshed canonical row was replaced whole and lost its list of URLs too
+        for canonical_url in {duplicate[1] for duplicate in duplicates} | ({article["url"] for article in articles} if refresh else set()):
+            writer.put((canonical_url,), UPDATE_ALT_URLS)
+    embed_time: datetime = datetime.now()
+    print(writer.report())
+
+    # Files the new rows in the ANN index and the memory-mapped matrix, if they were built
+    sync_index(DB_PATH)
+    sync_matrix_file(DB_PATH)
     
     end: datetime = datetime.now()
 
+    embed_seconds: float = max((embed_time - download_time).total_seconds(), 1e-9)
+    print("Time taken to download", len(links), "links:", str(download_time - start_time))
+    print(f"Time taken to embed {len(articles)} Articles: {embed_time - download_time} ({len(articles) / embed_seconds:.1f} articles/sec)")
     print("Time taken to process", len(links), "Articles:", str(end-start_time))
 
 # ---------------------------------------------------------------------------- #
@@ -184,23 +364,60 @@ def store_vectors(links: List[Tuple[str, str]], embedding_model: SentenceTransfo
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
-def clean_database(time_delta: timedelta = timedelta(days=7)) -> None:
+def clean_database(time_delta: timedelta = timedelta(days=7), dry_run: bool = False, vacuum_threshold: float = 0.25) -> List[int]:
+    """
+    Deletes the articles published more than `time_delta` ago.
+
+    The deletion is a single parameterised range delete on the indexed `publication_date`
+    column (stored as '%Y-%m-%d %H:%M:%S', so it compares as a string). The ANN index and the
+    memory-mapped matrix, if they were built, are synced afterwards; in-memory corpora can drop
+    the returned rowids with `Corpus.drop`. Rows without a publication date are kept.
+
+    Args:
+        time_delta: Maximum age of the articles that are kept (timedelta).
+        dry_run: Only report how many rows would be deleted (bool).
+        vacuum_threshold: VACUUM once this fraction of the database file is free pages (float).
+
+    Returns:
+        List[int]: The rowids that were deleted (that would be, for a dry run).
+    """
     t = datetime.now()
+    cutoff: str = (t - time_delta).strftime(DATE_FORMAT)
+
+    conn: sqlite3.Connection = connect(DB_PATH)
+    ensure_schema(conn)
+
+    expired: List[int] = [row[0] for row in conn.execute("SELECT rowid FROM embeddings WHERE publication_date < ?", (cutoff,))]
 
-    # If older than time_delta, delete
-    conn: sqlite3.Connection = sqlite3.connect('embeddings.db')
-    c: sqlite3.Cursor = conn.cursor()
-    c.execute("SELECT url, publication_date FROM embeddings")
-    rows = c.fetchall()
+    if dry_run:
+        total: int = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        conn.close()
+        print(f"Dry run: {len(expired)} of {total} articles are older than {cutoff} and would be deleted")
+        return expired
+
+    with conn:
+        conn.execute("DELETE FROM passages WHERE url IN (SELECT url FROM embeddings WHERE publication_date < ?)", (cutoff,))
+        conn.execute("DELETE FROM duplicates WHERE canonical_url IN (SELECT url FROM embeddings WHERE publication_date < ?)", (cutoff,))
+        conn.execute("DELETE FROM embeddings WHERE publication_date < ?", (cutoff,))
+
+    # Deleted pages are only reused, not returned to the OS, until the file is vacuumed
+    page_count: int = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count: int = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if page_count and freelist_count / page_count > vacuum_threshold:
+        conn.execute("VACUUM")
+        print(f"Vacuumed {freelist_count} free pages of {page_count}")
 
-    for row in rows:
-        if t - datetime.strptime(row[1], "%Y-%m-%d %H:%M:%S") > time_delta:
-            c.execute(f"DELETE FROM embeddings WHERE url = '{row[0]}'")
-    conn.commit()
     conn.close()
 
+    if expired:
+        sync_index(DB_PATH)
+        sync_matrix_file(DB_PATH)
+
+    print(f"Deleted {len(expired)} articles older than {cutoff}")
     print("Database cleaned in", datetime.now() - t)
 
+    return expired
+
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
@@ -0,0 +1,163 @@
+"""
+Political bias classification of articles and reports (newsmediabias/UnBIAS-classification-bert).
+
+Articles are scored once, at ingest (`store_vectors(..., bias_classifier=...)`), in
+batches through the classification pipeline, and the score is stored in the 'bias'
+column; queries then filter or re-rank on that column without running the model.
+Rows stored before that are scored with:
+
+    python -m inference.bias --db embeddings.db
+
+Texts longer than the model's 512 tokens are truncated by the tokenizer itself, on
+the token ids, instead of being detokenized and tokenized again.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import argparse
+import os
+import sqlite3
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+import logging
+logging.getLogger("transformers").setLevel(logging.ERROR)
+
+# torch and transformers are imported when the classifier is loaded, importing this
+# module (queries, the ingest path) does not pay for them
+if TYPE_CHECKING:
+    from transformers import Pipeline
+
+from data_prep.schema import DB_PATH
+
+# Length the classifier was trained with
+MAX_TOKENS: int = 512
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Model                                                                        #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def get_bias_decector():
+    import torch
+    from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipeline
+
+    base_path = os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "hub", "models--newsmediabias--UnBIAS-classification-bert")
+    snapshots_path = os.path.join(base_path, "snapshots")
+
+    # List all directories under snapshots
+    if os.path.exists(snapshots_path):
+        snapshot_dirs = sorted([d for d in os.listdir(snapshots_path) if os.path.isdir(os.path.join(snapshots_path, d))])
+        if snapshot_dirs:
+            latest_snapshot = snapshot_dirs[-1]  # Select the most recent snapshot
+            model_path = os.path.join(snapshots_path, latest_snapshot)
+        else:
+            raise EnvironmentError(f"No snapshot directories found in '{snapshots_path}'.")
+    else:
+        raise EnvironmentError(f"Snapshots path '{snapshots_path}' does not exist.")
+
+    # Check if the necessary files exist in the model_path
+    necessary_files = ["config.json", "pytorch_model.bin", "tokenizer.json", "tokenizer_config.json", "vocab.txt"]
+    if all(os.path.exists(os.path.join(model_path, file)) for file in necessary_files):
+        print(f"Bias model found at '{model_path}'. Loading...")
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model = AutoModelForSequenceClassification.from_pretrained(model_path)
+    else:
+        print(f"Necessary files not found in '{model_path}'. Downloading...\n")
+        tokenizer = AutoTokenizer.from_pretrained("newsmediabias/UnBIAS-classification-bert")
+        model = AutoModelForSequenceClassification.from_pretrained("newsmediabias/UnBIAS-classification-bert")
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    classifier = pipeline("text-classification", model=model, tokenizer=tokenizer, device=0 if device.type == "cuda" else -1)
+
+    return classifier
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Scoring                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def get_biases(texts: list[str], classifier: "Pipeline", batch_size: int = 16) -> list[float]:
+    """
+    Bias scores of many texts, classified in batches.
+
+    Texts are sorted by length so that every batch is padded to similar lengths, and
+    truncated to `MAX_TOKENS` tokens by the tokenizer.
+
+    Args:
+        texts: The texts to score (list[str]).
+        classifier: The pipeline from `get_bias_decector`.
+        batch_size: Number of texts per forward pass (int).
+
+    Returns:
+        list[float]: The probability that every text is biased, in the order of `texts`.
+    """
+    if not texts:
+        return []
+
+    order: list[int] = sorted(range(len(texts)), key=lambda i: len(texts[i] or ""), reverse=True)
+    results: list = classifier([texts[i] or "" for i in order], batch_size=batch_size, truncation=True, max_length=MAX_TOKENS)
+
+    scores: list[float] = [0.0] * len(texts)
+    for i, result in zip(order, results):
+        scores[i] = result['score'] if result['label'] == 'Biased' else 1 - result['score']
+
+    return scores
+
+def get_bias(text, classifier):
+    return get_biases([text], classifier, batch_size=1)[0]
+
+def backfill_bias(db_path: str = DB_PATH, classifier: "Pipeline" = None, batch_size: int = 16, chunk: int = 256) -> int:
+    """
+    Scores the stored articles that have no bias yet.
+
+    Args:
+        db_path: Path to the sqlite database (str).
+        classifier: The pipeline from `get_bias_decector`, loaded if not given.
+        batch_size: Number of texts per forward pass (int).
+        chunk: Number of rows scored and committed at a time (int).
+
+    Returns:
+        int: The number of rows scored.
+    """
+    t: datetime = datetime.now()
+    classifier = classifier or get_bias_decector()
+
+    conn: sqlite3.Connection = sqlite3.connect(db_path)
+    rows: list[tuple] = conn.execute("SELECT rowid, text FROM embeddings WHERE bias IS NULL AND text IS NOT NULL").fetchall()
+
+    for start in range(0, len(rows), chunk):
+        batch: list[tuple] = rows[start:start + chunk]
+        scores: list[float] = get_biases([text for _, text in batch], classifier, batch_size)
+
+        with conn:
+            conn.executemany("UPDATE embeddings SET bias = ? WHERE rowid = ?",
+                             [(score, rowid) for (rowid, _), score in zip(batch, scores)])
+
+    conn.close()
+    print(f"Scored the bias of {len(rows)} articles in {datetime.now() - t}")
+
+    return len(rows)
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Main                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score the bias of the stored articles that have none yet.")
+    parser.add_argument("--db", default=DB_PATH, help="path to the sqlite database")
+    parser.add_argument("--batch-size", type=int, default=16, help="texts per forward pass")
+    args = parser.parse_args()
+
+    backfill_bias(args.db, batch_size=args.batch_size)
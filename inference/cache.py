@@ -0,0 +1,228 @@
+"""
+Two-level cache for repeated questions.
+
+    1. query text -> query embedding, so a popular question is only encoded once
+       by the embedding model (`CachedEmbedder`).
+    2. (query, retrieved sources, length, llm) -> generated report, so the LLM is
+       only called again when something in the answer would change.
+
+The retrieved sources are part of the second key (url and content hash of every
+article), so once ingestion adds, removes or rewrites an article that the query
+retrieves, the key changes and the stale report is simply never hit again; it
+ages out of the cache like any other entry.
+
+Both levels are `TTLCache`s: bounded in size (least recently used entries go
+first), entries expire after `ttl` seconds, and they can be persisted to disk
+with `save` and are read back when created with the same `path`.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import numpy as np
+import pandas as pd
+
+EMBEDDING_CACHE_PATH: str = "cache/query_embeddings.pkl"
+ANSWER_CACHE_PATH: str = "cache/answers.pkl"
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Cache                                                                        #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after `ttl` seconds.
+
+    Args:
+        max_items: Entries kept before the least recently used ones are evicted (int).
+        ttl: Seconds an entry stays valid, None for no expiry (float).
+        path: File the cache is persisted to by `save` and read back from on creation (str).
+
+    Attributes:
+        hits: Number of lookups that found a valid entry (int).
+        misses: Number of lookups that did not (int).
+    """
+    def __init__(self, max_items: int = 1024, ttl: Optional[float] = 3600.0, path: Optional[str] = None):
+        self.max_items: int = max_items
+        self.ttl: Optional[float] = ttl
+        self.path: Optional[str] = path
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+        # key -> (expiry as a unix time, value), least recently used first
+        self._items: OrderedDict = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the value stored under `key`, or `default` if it is missing or expired.
+        """
+        with self._lock:
+            item = self._items.get(key)
+
+            if item is None or (item[0] is not None and item[0] < time.time()):
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                return default
+
+            self._items.move_to_end(key)
+            self.hits += 1
+
+            return item[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Stores `value` under `key`, evicting the least recently used entries beyond `max_items`.
+        """
+        expires: Optional[float] = time.time() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            self._items[key] = (expires, value)
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: {"items", "hits", "misses", "hit_rate"}
+        """
+        lookups: int = self.hits + self.misses
+
+        return {"items": len(self), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0}
+
+    # ------------------------------------------------------------------------ #
+    # Persistence
+    # ------------------------------------------------------------------------ #
+    def save(self, path: Optional[str] = None) -> None:
+        """
+        Writes the entries that have not expired to `path` (defaults to the cache's path), atomically.
+        """
+        path = path or self.path
+        if not path:
+            return
+
+        now: float = time.time()
+        with self._lock:
+            items: list = [(key, expires, value) for key, (expires, value) in self._items.items() if expires is None or expires >= now]
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path: str = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(items, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, path: Optional[str] = None) -> None:
+        """
+        Reads back entries written by `save`, skipping those that expired in the meantime.
+        """
+        path = path or self.path
+
+        try:
+            with open(path, "rb") as f:
+                items: list = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            print(f"Ignoring unreadable cache '{path}': {e}")
+            return
+
+        now: float = time.time()
+        with self._lock:
+            for key, expires, value in items[-self.max_items:]:
+                if expires is None or expires >= now:
+                    self._items[key] = (expires, value)
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Keys                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def normalize_query(text: str) -> str:
+    """
+    Case and whitespace insensitive form of a query, so trivially different spellings share an entry.
+    """
+    return " ".join(str(text).lower().split())
+
+def answer_key(question: str, similar: pd.DataFrame, length: str, llm: str, max_context_tokens: Optional[int] = None) -> tuple:
+    """
+    Key of a generated report: the normalised question, the articles it was written
+    from (url and content hash, in retrieval order), the length, the LLM and the
+    token budget the articles were packed into.
+
+    The `main.py` CLI and the query service share the report cache file; both
+    store {"response": str, "bias": Optional[float]} under this key.
+    """
+    urls: list = list(similar["url"]) if "url" in similar else []
+    hashes: list = list(similar["content_hash"]) if "content_hash" in similar else [None] * len(urls)
+    sources: tuple = tuple((url, None if pd.isna(h) else h) for url, h in zip(urls, hashes))
+
+    return (normalize_query(question), sources, str(length).lower(), llm, max_context_tokens)
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Embedder                                                                     #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+class CachedEmbedder:
+    """
+    Wraps a SentenceTransformer so that `encode` of a single query goes through a `TTLCache`.
+
+    Batches (lists of texts) and every other attribute are passed through to the
+    wrapped model untouched.
+
+    Args:
+        embedder: The SentenceTransformer to wrap.
+        cache: The query -> embedding cache (TTLCache).
+        model_name: Part of every key, so a cache persisted with one model is never read with another (str).
+    """
+    def __init__(self, embedder, cache: TTLCache, model_name: str = ""):
+        self.embedder = embedder
+        self.cache: TTLCache = cache
+        self.model_name: str = model_name
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.embedder, name)
+
+    def encode(self, sentences, *args, **kwargs):
+        if not isinstance(sentences, str) or args or kwargs:
+            return self.embedder.encode(sentences, *args, **kwargs)
+
+        key: tuple = (self.model_name, normalize_query(sentences))
+        embedding: Optional[np.ndarray] = self.cache.get(key)
+
+        if embedding is None:
+            embedding = np.asarray(self.embedder.encode(sentences), dtype=np.float32)
+            embedding.setflags(write=False)
+            self.cache.put(key, embedding)
+
+        return embedding
@@ -0,0 +1,442 @@
+"""
+In-memory corpus used by `get_similar`.
+
+The article embeddings are stacked once into a single contiguous float32 matrix
+whose rows are L2-normalised, so that scoring a query against the whole corpus
+is one matrix-vector product instead of a Python loop of cosine similarities.
+
+`Corpus.quantize` swaps that matrix for a compact float16 or int8 copy, optionally
+keeping only the leading dimensions, and rescores the best candidates with the
+full-precision rows.
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+from data_prep.codec import quantize_int8
+from data_prep.schema import DATE_FORMAT
+
+# Same epsilon torch.nn.functional.cosine_similarity guards the norms with
+EPS: float = 1e-8
+
+# Columns the prompt needs, a corpus without them fetches its hits from sqlite
+ARTICLE_COLUMNS: list[str] = ["url", "text", "title", "authors"]
+
+# Candidates rescored at full precision after a quantized scan
+RERANK: int = 100
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Helpers                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    L2-normalises the rows of a float32 matrix in place (zero rows stay zero) and returns it.
+    """
+    norms: np.ndarray = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    matrix /= np.maximum(norms, EPS)
+
+    return matrix
+
+def fit_query(query: np.ndarray, dim: int) -> np.ndarray:
+    """
+    The query as a normalised float32 vector of the matrix' dimension (embeddings stored
+    truncated are compared on their leading dimensions).
+    """
+    return normalize_rows(np.array(query, dtype=np.float32).reshape(-1)[:dim])
+
+def top_k(scores: np.ndarray, candidates: np.ndarray, k: int) -> np.ndarray:
+    """
+    Picks the `k` best candidates by score with `np.argpartition`.
+
+    The result is ordered by descending score and, among equal scores, by
+    position, which is exactly what a stable `sorted(..., reverse=True)` over the
+    rows in corpus order gives.
+
+    Args:
+        scores: Score of every row of the corpus (np.ndarray).
+        candidates: Positions of the rows allowed in the result (np.ndarray).
+        k: Number of results wanted (int).
+
+    Returns:
+        np.ndarray: Positions of the selected rows, best first.
+    """
+    if k <= 0 or len(candidates) == 0:
+        return candidates[:0]
+
+    cand_scores: np.ndarray = scores[candidates]
+
+    if len(candidates) > k:
+        part: np.ndarray = np.argpartition(-cand_scores, k - 1)[:k]
+        kth: float = cand_scores[part].min()
+
+        # Keep everything tied with the k-th score so ties resolve like a stable sort
+        keep: np.ndarray = np.flatnonzero(cand_scores >= kth)
+        candidates, cand_scores = candidates[keep], cand_scores[keep]
+
+    order: np.ndarray = np.lexsort((candidates, -cand_scores))[:k]
+
+    return candidates[order]
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Corpus                                                                       #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+class Corpus:
+    """
+    The articles of the database (as returned by `sql3_as_pd`) plus their embeddings
+    as one pre-normalised, C-contiguous float32 matrix.
+
+    The matrix can also be handed in ready-made, e.g. the memory-mapped sidecar of
+    `data_prep.matrix_file`, in which case `data` only needs one row per matrix row.
+
+    Attributes:
+        data: The article rows, re-indexed 0..n-1 so positions match the matrix (pd.DataFrame).
+        rowids: The sqlite rowid of every row, if the frame has a 'rowid' column (np.ndarray).
+        matrix: Row-normalised embeddings, shape (n, dim) (np.ndarray).
+        live: False for rows that were dropped since the corpus was loaded (np.ndarray).
+        source_names: The distinct sources, sorted (np.ndarray).
+        source_codes: Index into `source_names` of every row, for vectorised black/whitelisting (np.ndarray).
+        dates: Publication date of every row, NaT if unknown (np.ndarray of datetime64[s]).
+        bias: Bias score of every row stored at ingest, NaN if unscored (np.ndarray).
+        passages: Passage embeddings of the articles stored in chunked mode, if any (Passages).
+        quantized: Compact copy of the matrix that is scored instead of it, see `quantize` (QuantizedMatrix).
+        rerank: Number of best quantized candidates rescored with `matrix` (int).
+    """
+    def __init__(self, data: pd.DataFrame, matrix: np.ndarray = None, live: np.ndarray = None, passages: "Passages" = None):
+        self.data: pd.DataFrame = data.reset_index(drop=True)
+        self.passages: Optional[Passages] = passages
+
+        if matrix is None:
+            if len(self.data):
+                matrix = np.ascontiguousarray(normalize_rows(np.vstack(list(self.data["embedding"])).astype(np.float32)))
+            else:
+                matrix = np.zeros((0, 0), dtype=np.float32)
+
+        self.matrix: np.ndarray = matrix
+        self.live: np.ndarray = np.ones(len(self.data), dtype=bool) if live is None else live
+        self.quantized: Optional[QuantizedMatrix] = None
+        self.rerank: int = 0
+        self._index_rows()
+
+    def _index_rows(self) -> None:
+        # Per-row lookups derived from `data`, rebuilt whenever rows change
+        self.source_names, self.source_codes = np.unique(np.asarray(self.data["source"].fillna("").astype(str), dtype=str), return_inverse=True)
+
+        self.rowids: np.ndarray = self.data["rowid"].to_numpy(dtype=np.int64) if "rowid" in self.data else None
+        self._rowid_order: np.ndarray = np.argsort(self.rowids) if self.rowids is not None else None
+
+        if "publication_date" in self.data:
+            dates = pd.to_datetime(self.data["publication_date"], format=DATE_FORMAT, errors="coerce")
+            self.dates: np.ndarray = dates.to_numpy(dtype="datetime64[s]")
+        else:
+            self.dates = np.full(len(self.data), np.datetime64("NaT"), dtype="datetime64[s]")
+
+        self.bias: np.ndarray = pd.to_numeric(self.data["bias"], errors="coerce").to_numpy(dtype=np.float32) \
+            if "bias" in self.data else np.full(len(self.data), np.nan, dtype=np.float32)
+
+        # Sorted once so a date range is two binary searches, NaT sorts last
+        self._date_order: np.ndarray = np.argsort(self.dates, kind="stable")
+        self._sorted_dates: np.ndarray = self.dates[self._date_order]
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def has_articles(self) -> bool:
+        """
+        Whether the frame holds everything needed to build a prompt from its rows.
+        """
+        return all(column in self.data for column in ARTICLE_COLUMNS)
+
+    def drop(self, rowids) -> int:
+        """
+        Removes rows (e.g. the ones `clean_database` deleted) from the corpus, in place.
+
+        Rows are only masked out through `live`, so nothing is copied and a
+        memory-mapped matrix stays mapped.
+
+        Args:
+            rowids: The sqlite rowids to remove, unknown ones are ignored.
+
+        Returns:
+            int: The number of rows removed.
+        """
+        if self.rowids is None:
+            raise ValueError("This corpus was built without a 'rowid' column")
+
+        dropped: np.ndarray = np.isin(self.rowids, np.asarray(rowids, dtype=np.int64)) & self.live
+        self.live = self.live & ~dropped
+
+        return int(dropped.sum())
+
+    def source_mask(self, sources: list[str]) -> np.ndarray:
+        """
+        Boolean mask of the rows whose source is in `sources`.
+        """
+        wanted: np.ndarray = np.isin(self.source_names, list(sources))
+
+        return wanted[self.source_codes]
+
+    def date_mask(self, start: np.datetime64 = None, end: np.datetime64 = None) -> np.ndarray:
+        """
+        Boolean mask of the rows published between `start` and `end` (both inclusive, either
+        can be None). Rows without a date never match.
+        """
+        lo: int = int(np.searchsorted(self._sorted_dates, start, "left")) if start is not None else 0
+        # Up to the first NaT, not past it
+        hi: int = int(np.searchsorted(self._sorted_dates, end if end is not None else np.datetime64("NaT"),
+                                      "right" if end is not None else "left"))
+
+        mask: np.ndarray = np.zeros(len(self), dtype=bool)
+        mask[self._date_order[lo:hi]] = True
+
+        return mask
+
+    def filter_mask(self, sources: list[str] = None, exclude: list[str] = None, start: np.datetime64 = None,
+                    end: np.datetime64 = None, max_bias: float = None) -> np.ndarray:
+        """
+        Rows that can be returned at all: live, from one of `sources` (if given), not from
+        one of `exclude`, published within [`start`, `end`] (if given) and with a bias
+        of at most `max_bias` (if given; unscored rows are kept).
+
+        Built from the precomputed source codes and sorted dates, so it costs a few
+        vectorised passes and is applied before any row is scored.
+        """
+        mask: np.ndarray = self.live.copy()
+
+        if sources:
+            mask &= self.source_mask(sources)
+        if exclude:
+            mask &= ~self.source_mask(exclude)
+        if start is not None or end is not None:
+            mask &= self.date_mask(start, end)
+        if max_bias is not None:
+            mask &= ~(self.bias > max_bias)
+
+        return mask
+
+    def positions(self, rowids: np.ndarray) -> np.ndarray:
+        """
+        Maps sqlite rowids to positions in the corpus, dropping rowids it does not hold.
+        """
+        if self.rowids is None:
+            raise ValueError("This corpus was built without a 'rowid' column")
+
+        sorted_ids: np.ndarray = self.rowids[self._rowid_order]
+        found: np.ndarray = np.clip(np.searchsorted(sorted_ids, rowids), 0, max(len(sorted_ids) - 1, 0))
+        valid: np.ndarray = sorted_ids[found] == rowids if len(sorted_ids) else np.zeros(len(rowids), dtype=bool)
+
+        return self._rowid_order[found[valid]]
+
+    def quantize(self, kind: str = "int8", dims: Optional[int] = None, rerank: int = RERANK) -> "Corpus":
+        """
+        Scores the corpus on a compact copy of the matrix from now on.
+
+        The `rerank` best rows of every quantized scan are rescored with the full-precision
+        matrix, which is then only read at those rows. A memory-mapped matrix stays mapped
+        for that (its pages are only loaded when touched); an in-memory one is released
+        when `rerank` is 0, which is where the memory is saved.
+
+        Args:
+            kind: "int8" (a byte per value plus a scale per row), "float16" or "float32" (str).
+            dims: Keep only the leading `dims` dimensions (int).
+            rerank: Number of candidates rescored at full precision, 0 to keep the quantized scores (int).
+
+        Returns:
+            Corpus: self.
+        """
+        self.quantized = QuantizedMatrix(self.matrix, kind, dims)
+        self.rerank = rerank
+
+        if not rerank and not isinstance(self.matrix, np.memmap):
+            self.matrix = None
+
+        return self
+
+    def score(self, query: np.ndarray, positions: np.ndarray = None) -> np.ndarray:
+        """
+        Cosine similarity of `query` against every article, as a single matmul.
+
+        Args:
+            query: The query embedding (np.ndarray).
+            positions: Only score these rows, the others get -inf (np.ndarray).
+
+        Returns:
+            np.ndarray: One float32 score per row of the corpus.
+        """
+        if self.quantized is not None:
+            return self._score_quantized(query, positions)
+
+        query = fit_query(query, self.matrix.shape[1])
+
+        if positions is None:
+            return self.matrix @ query
+
+        sims: np.ndarray = np.full(len(self), -np.inf, dtype=np.float32)
+        sims[positions] = self.matrix[positions] @ query
+
+        return sims
+
+    def _score_quantized(self, query: np.ndarray, positions: np.ndarray = None) -> np.ndarray:
+        # Approximate scores from the compact matrix, exact ones for the best live rows
+        if positions is None:
+            sims: np.ndarray = self.quantized.score(query)
+            scored: np.ndarray = np.flatnonzero(self.live)
+        else:
+            sims = np.full(len(self), -np.inf, dtype=np.float32)
+            sims[positions] = self.quantized.score(query, positions)
+            scored = positions[self.live[positions]]
+
+        n: int = min(self.rerank, len(scored))
+        if n and self.matrix is not None:
+            best: np.ndarray = np.sort(scored[np.argpartition(-sims[scored], n - 1)[:n]])
+            sims[best] = self.matrix[best] @ fit_query(query, self.matrix.shape[1])
+
+        return sims
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Passages                                                                     #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+class Passages:
+    """
+    Embeddings of the passages of chunked articles (the 'passages' table), scored
+    alongside a `Corpus`: an article's score is the score of its best passage.
+
+    Attributes:
+        ids: Id of every passage in the 'passages' table (np.ndarray).
+        articles: Position in the corpus of the article every passage belongs to (np.ndarray).
+        matrix: Row-normalised passage embeddings, shape (n, dim) (np.ndarray).
+    """
+    def __init__(self, ids: np.ndarray, articles: np.ndarray, matrix: np.ndarray):
+        self.ids: np.ndarray = np.asarray(ids, dtype=np.int64)
+        self.articles: np.ndarray = np.asarray(articles, dtype=np.int64)
+        self.matrix: np.ndarray = matrix
+
+        # Passages grouped by article, for `of`
+        self._order: np.ndarray = np.argsort(self.articles, kind="stable")
+        self._sorted_articles: np.ndarray = self.articles[self._order]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def score(self, query: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        """
+        Cosine similarity of `query` against every passage, or only the passages at `rows` (the others get -inf).
+        """
+        query = fit_query(query, self.matrix.shape[1])
+
+        if rows is None:
+            return self.matrix @ query
+
+        sims: np.ndarray = np.full(len(self), -np.inf, dtype=np.float32)
+        sims[rows] = self.matrix[rows] @ query
+
+        return sims
+
+    def best_per_article(self, scores: np.ndarray, n_articles: int) -> np.ndarray:
+        """
+        Score of the best passage of every article of the corpus, -inf for articles without passages.
+        """
+        best: np.ndarray = np.full(n_articles, -np.inf, dtype=np.float32)
+        np.maximum.at(best, self.articles, scores)
+
+        return best
+
+    def of(self, position: int) -> np.ndarray:
+        """
+        Indices of the passages of the article at `position` in the corpus.
+        """
+        lo, hi = np.searchsorted(self._sorted_articles, [position, position + 1])
+
+        return self._order[lo:hi]
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Quantized matrix                                                             #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+class QuantizedMatrix:
+    """
+    Compact copy of a row-normalised embedding matrix.
+
+    "float16" halves the matrix; "int8" stores every row as bytes plus one float32
+    scale, a quarter of the size. Either can also keep only the leading `dims`
+    dimensions, renormalised. Scoring upcasts one cache-sized block of rows at a
+    time, so the float32 matrix is never materialised again. numpy's float16 to
+    float32 conversion is not vectorised, so float16 saves memory but scans several
+    times slower than float32; int8 scans about as fast as float32 or faster.
+
+    Attributes:
+        kind: "float32", "float16" or "int8" (str).
+        codes: The stored values, shape (n, dims) (np.ndarray).
+        scales: The scale of every int8 row, None otherwise (np.ndarray).
+    """
+    BLOCK_ROWS: int = 256
+
+    def __init__(self, matrix: np.ndarray, kind: str = "int8", dims: Optional[int] = None):
+        if kind not in ("float32", "float16", "int8"):
+            raise ValueError(f"Unsupported quantization '{kind}', expected float32, float16 or int8")
+
+        n: int = matrix.shape[0]
+        dim: int = min(dims or matrix.shape[1], matrix.shape[1])
+
+        self.kind: str = kind
+        self.codes: np.ndarray = np.empty((n, dim), dtype=np.int8 if kind == "int8" else kind)
+        self.scales: Optional[np.ndarray] = np.empty(n, dtype=np.float32) if kind == "int8" else None
+
+        # A block at a time, so a memory-mapped matrix is never loaded whole
+        for start in range(0, n, 16 * self.BLOCK_ROWS):
+            block: np.ndarray = normalize_rows(np.array(matrix[start:start + 16 * self.BLOCK_ROWS, :dim], dtype=np.float32))
+
+            if kind == "int8":
+                self.codes[start:start + len(block)], self.scales[start:start + len(block)] = quantize_int8(block)
+            else:
+                self.codes[start:start + len(block)] = block
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def score(self, query: np.ndarray, positions: np.ndarray = None) -> np.ndarray:
+        """
+        Approximate cosine similarity of `query` against every row, or only the rows at `positions`.
+
+        Returns:
+            np.ndarray: One float32 score per row (per position if given).
+        """
+        query = fit_query(query, self.codes.shape[1])
+        rows: int = len(self) if positions is None else len(positions)
+        sims: np.ndarray = np.empty(rows, dtype=np.float32)
+
+        for start in range(0, rows, self.BLOCK_ROWS):
+            end: int = min(start + self.BLOCK_ROWS, rows)
+            block: np.ndarray = self.codes[start:end] if positions is None else self.codes[positions[start:end]]
+            sims[start:end] = block.astype(np.float32) @ query
+
+        if self.scales is not None:
+            sims *= self.scales if positions is None else self.scales[positions]
+
+        return sims
@@ -7,11 +7,19 @@ package: https://github.com/ollama/ollama-python
 app: https://www.ollama.com/
 
 Available llms through ollama are found at https://www.ollama.com/models
+
+`inference_llm` returns the whole report once it is generated, `stream_llm` yields
+it token by token as the model produces it. Both take an optional `client`
+(e.g. `ollama.Client(host=...)`, the default is the one the `ollama` module uses)
+and fill an optional `stats` dict with time-to-first-token and tokens/sec.
 """
 
 import ollama
-from ollama import _client, _types
 import datetime
+import time
+from typing import Iterator, Optional
+
+from data_prep.metrics import span, observe, count, error
 
 def handle_expection(e, llm) -> bool:
     print(f"Error: {e}")
@@ -25,32 +33,129 @@ def handle_expection(e, llm) -> bool:
         except e:
             print(f"Failed to pull {llm}")
             return False
-        
+
     print("inferece failed")
     return False
 
-def inference_llm(prompt: str, sys_prompt: str = None, llm: str = "llama3") -> str:
+def get_messages(prompt: str, sys_prompt: str = None) -> list[dict]:
+    if not sys_prompt:
+        return [{'role': 'user', 'content': prompt}]
+
+    return [{'role': 'system', 'content': sys_prompt}, {'role': 'user', 'content': prompt}]
+
+def _field(response, name: str):
+    # Ollama answers are dicts or subscriptable response models depending on the client version
+    try:
+        return response[name]
+    except (KeyError, TypeError):
+        return None
+
+def generation_stats(final, tokens: int, started: float, first_token: Optional[float], finished: float) -> dict:
+    """
+    Latency and throughput of one generation.
+
+    Ollama's own counters from the final message (`eval_count` tokens generated in
+    `eval_duration` nanoseconds) are used when it sends them, otherwise tokens are
+    the number of chunks received and the rate is measured from the first one.
+
+    Returns:
+        dict: {"ttft": seconds to the first token, "total": seconds, "tokens": int, "tokens_per_sec": float}
+    """
+    eval_count = _field(final, 'eval_count') if final is not None else None
+    eval_duration = _field(final, 'eval_duration') if final is not None else None
+
+    if eval_count and eval_duration:
+        tokens = int(eval_count)
+        tokens_per_sec: float = tokens / (eval_duration / 1e9)
+    else:
+        generating: float = finished - (first_token if first_token is not None else started)
+        tokens_per_sec = tokens / generating if generating > 0 else 0.0
+
+    return {
+        "ttft": (first_token if first_token is not None else finished) - started,
+        "total": finished - started,
+        "tokens": tokens,
+        "tokens_per_sec": tokens_per_sec,
+    }
+
+def inference_llm(prompt: str, sys_prompt: str = None, llm: str = "llama3", client=None, stats: dict = None) -> str:
     try_inference = True
+    client = client or ollama
 
     while try_inference:
         inference_dt = datetime.datetime.now()
-        if  not sys_prompt:
-            try:
-                response = ollama.chat(
-                model=llm,
-                messages=[{'role': 'user', 'content': prompt}])
-                try_inference = False
-            except _types.ResponseError as e:
-                try_inference = handle_expection(e, llm)
-        else:
-            try:
-                response = ollama.chat(
+        started = time.perf_counter()
+        try:
+            with span("llm", model=llm):
+                response = client.chat(
                 model=llm,
-                messages=[{'role': 'system', 'content': sys_prompt}, {'role': 'user', 'content': prompt}])
-                try_inference = False
-            except _types.ResponseError as e:
-                try_inference = handle_expection(e, llm)
+                messages=get_messages(prompt, sys_prompt))
+            try_inference = False
+        except ollama.ResponseError as e:
+            error("llm", e, model=llm)
+            try_inference = handle_expection(e, llm)
         print(f"Inference complete in {datetime.datetime.now() - inference_dt}\n\n")
 
-            
-    return response['message']['content']
\ No newline at end of file
+    count("llm_tokens", _field(response, 'eval_count') or 0, model=llm)
+
+    if stats is not None:
+        # Nothing is seen before the whole report is there
+        finished = time.perf_counter()
+        stats.update(generation_stats(response, 0, started, finished, finished))
+
+    return response['message']['content']
+
+def stream_llm(prompt: str, sys_prompt: str = None, llm: str = "llama3", client=None, stats: dict = None) -> Iterator[str]:
+    """
+    Streams the report of the llm, yielding every piece of text as soon as it is generated.
+
+    Args:
+        prompt: The user prompt (str).
+        sys_prompt: Optional system prompt (str).
+        llm: The ollama model (str).
+        client: Client to talk to, e.g. `ollama.Client(host=...)` (defaults to the `ollama` module).
+        stats: Filled with "ttft", "total", "tokens" and "tokens_per_sec" once the stream is done (dict).
+
+    Yields:
+        str: The report, piece by piece.
+    """
+    client = client or ollama
+
+    while True:
+        inference_dt = datetime.datetime.now()
+        started: float = time.perf_counter()
+        first_token: Optional[float] = None
+        tokens: int = 0
+        final = None
+
+        try:
+            for chunk in client.chat(model=llm, messages=get_messages(prompt, sys_prompt), stream=True):
+                content: str = _field(_field(chunk, 'message'), 'content') or ""
+
+                if content:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    tokens += 1
+                    yield content
+
+                if _field(chunk, 'done'):
+                    final = chunk
+            break
+        except ollama.ResponseError as e:
+            error("llm", e, model=llm)
+            # A missing model fails before anything is generated, pull it and start over
+            if first_token is not None or not handle_expection(e, llm):
+                raise
+
+    finished: float = time.perf_counter()
+    summary: dict = generation_stats(final, tokens, started, first_token, finished)
+
+    if stats is not None:
+        stats.update(summary)
+
+    observe("llm", summary["total"], model=llm)
+    observe("llm_ttft", summary["ttft"], model=llm)
+    count("llm_tokens", summary["tokens"], model=llm)
+
+    print(f"Inference complete in {datetime.datetime.now() - inference_dt} "
+          f"(first token after {summary['ttft']:.2f}s, {summary['tokens_per_sec']:.1f} tokens/sec)\n\n")
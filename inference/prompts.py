@@ -1,6 +1,122 @@
 
 
-def get_news_report_prompt(data, question, length="short"):
+import re
+
+# Token budget of the article context, so prefill time stays bounded whatever was retrieved
+CONTEXT_TOKENS = 3000
+
+# A passage is only cut down if at least this many of its tokens fit, otherwise it is left out
+MIN_PASSAGE_TOKENS = 32
+
+def estimate_tokens(text):
+    # About 4 characters per token for English text with the BPE tokenizers ollama models use
+    return (len(text) + 3) // 4
+
+def split_passages(text):
+    # A list is already split, e.g. the matching passages of a chunked article
+    pieces = text if isinstance(text, list) else re.split(r"\n+", str(text))
+
+    return [p.strip() for p in pieces if p.strip()]
+
+def truncate_to_tokens(text, budget, count_tokens=estimate_tokens):
+    # Longest prefix of whole words that fits the budget (binary search, few token counts)
+    words = text.split()
+    lo, hi = 0, len(words)
+
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(" ".join(words[:mid]) + " ...") <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return " ".join(words[:lo]) + " ..." if lo else ""
+
+def pack_context(titles, texts, max_tokens=CONTEXT_TOKENS, count_tokens=estimate_tokens):
+    """
+    Builds the article context within a token budget.
+
+    Articles are taken in retrieval order (best first). Every article first gets its
+    title and opening passage, then the remaining budget goes to the following
+    passages of the best articles, so it is the tails of the lower-ranked articles
+    that get truncated or dropped.
+
+    Args:
+        titles: Title of every article, best first (list).
+        texts: Text of every article, or the list of its passages (list).
+        max_tokens: Token budget of the context, None for no limit (int).
+        count_tokens: Function counting the tokens of a string, e.g. `lambda s: len(tokenizer.encode(s))`.
+
+    Returns:
+        tuple: The context (str), the positions of the articles it holds (list[int]) and
+        {"context_tokens", "budget", "articles", "truncated", "dropped"} (dict).
+    """
+    headers = [f"Title: {titles[i]}\n\nText: " for i in range(len(texts))]
+    footer = "\n------------------\n"
+
+    passages = [split_passages(text) or [""] for text in texts]
+
+    if max_tokens is None:
+        chosen = {i: passages[i] for i in range(len(texts))}
+    else:
+        chosen = {}
+        left = max_tokens
+
+        # Title and opening passage of every article that fits, best first
+        for i in range(len(texts)):
+            overhead = count_tokens(headers[i] + footer)
+            first = passages[i][0]
+            cost = overhead + count_tokens(first)
+
+            if cost <= left:
+                chosen[i] = [first]
+            elif left - overhead >= MIN_PASSAGE_TOKENS:
+                chosen[i] = [truncate_to_tokens(first, left - overhead, count_tokens)]
+                cost = overhead + count_tokens(chosen[i][0])
+            else:
+                continue
+
+            left -= cost
+
+        # Then the rest of the best articles, until the budget runs out
+        for i in sorted(chosen):
+            for passage in passages[i][1:]:
+                cost = count_tokens("\n\n" + passage)
+
+                if cost <= left:
+                    chosen[i].append(passage)
+                    left -= cost
+                    continue
+
+                if left >= MIN_PASSAGE_TOKENS:
+                    cut = truncate_to_tokens(passage, left, count_tokens)
+                    chosen[i].append(cut)
+                    left -= count_tokens("\n\n" + cut)
+                left = 0
+                break
+
+            if left == 0:
+                break
+
+    complete = {i for i in chosen if chosen[i] == passages[i]}
+
+    context = ""
+    for i in sorted(chosen):
+        text = "\n\n".join(chosen[i])
+        context += f"{headers[i]}{text}{footer}"
+
+    stats = {
+        "context_tokens": count_tokens(context),
+        "budget": max_tokens,
+        "articles": len(chosen),
+        "truncated": len(chosen) - len(complete),
+        "dropped": len(texts) - len(chosen),
+    }
+
+    return context, sorted(chosen), stats
+
+def get_news_report_prompt(data, question, length="short", max_context_tokens=CONTEXT_TOKENS, count_tokens=estimate_tokens,
+                           stats=None):
     text = list(data["text"])
     titles = list(data["title"])
     authors = list(data["authors"])
@@ -8,10 +124,17 @@ def get_news_report_prompt(data, question, length="short"):
 
     length_dict = {"short": "three bullet points", "medium": "6-7 sentences", "long": "as many as you need to flesh out the topic"}
     reponse_length = length_dict[length]
-    
-    context = ""
-    for i in range(len(text)):
-        context += f"Title: {titles[i]}\n\nText: {text[i]}\n------------------\n"
+
+    # Chunked articles only bring the passages that matched the question
+    if "passages" in data:
+        text = [p if isinstance(p, list) else t for p, t in zip(data["passages"], text)]
+
+    # Only the articles that made it into the context are cited
+    context, used, packing = pack_context(titles, text, max_context_tokens, count_tokens)
+    titles, authors, urls = [titles[i] for i in used], [authors[i] for i in used], [urls[i] for i in used]
+
+    if stats is not None:
+        stats.update(packing)
 
     prompt = f"""Here is what you will report on: {question}
     
@@ -1,111 +1,162 @@
-import torch
 import pandas as pd
 import sqlite3
-from ast import literal_eval
-import os
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipeline, Pipeline
-import logging
-logging.getLogger("transformers").setLevel(logging.ERROR)
+import numpy as np
+import re
+import time
+from data_prep.codec import decode_embedding
+from inference.corpus import Corpus, Passages, top_k, normalize_rows, RERANK
+from data_prep.chunking import merge_passages
+from data_prep.ann import IVFIndex
+from data_prep.matrix_file import open_matrix
+from data_prep.metrics import observe
+# The bias classifier lives in `inference.bias`, these names are kept importable from here
+from inference.bias import get_bias_decector, get_bias, get_biases
+
+# Below this fraction of rows left by the filters, gathering the rows beats the full matmul
+SUBSET_SCORING: float = 0.5
 
 
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
-# Bias                                                                         #
+# Get similar                                                                  #                       
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
-def get_bias_decector():
-    base_path = os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "hub", "models--newsmediabias--UnBIAS-classification-bert")
-    snapshots_path = os.path.join(base_path, "snapshots")
-
-    # List all directories under snapshots
-    if os.path.exists(snapshots_path):
-        snapshot_dirs = sorted([d for d in os.listdir(snapshots_path) if os.path.isdir(os.path.join(snapshots_path, d))])
-        if snapshot_dirs:
-            latest_snapshot = snapshot_dirs[-1]  # Select the most recent snapshot
-            model_path = os.path.join(snapshots_path, latest_snapshot)
-        else:
-            raise EnvironmentError(f"No snapshot directories found in '{snapshots_path}'.")
-    else:
-        raise EnvironmentError(f"Snapshots path '{snapshots_path}' does not exist.")
-
-    # Check if the necessary files exist in the model_path
-    necessary_files = ["config.json", "pytorch_model.bin", "tokenizer.json", "tokenizer_config.json", "vocab.txt"]
-    if all(os.path.exists(os.path.join(model_path, file)) for file in necessary_files):
-        print(f"Bias model found at '{model_path}'. Loading...")
-        tokenizer = AutoTokenizer.from_pretrained(model_path)
-        model = AutoModelForSequenceClassification.from_pretrained(model_path)
-    else:
-        print(f"Necessary files not found in '{model_path}'. Downloading...\n")
-        tokenizer = AutoTokenizer.from_pretrained("newsmediabias/UnBIAS-classification-bert")
-        model = AutoModelForSequenceClassification.from_pretrained("newsmediabias/UnBIAS-classification-bert")
+def get_similar(text, data, embedder, top_n=3, threshold=0.5, sql_path = "embeddings.db",\
+                 blacklist: list[str] = [], whitelist: list[str] = [], wl_boost: dict = [], \
+                    date_filter:dict = None, index: IVFIndex = None, n_probe: int = 8, timings: dict = None, \
+                            max_passages: int = 3, mode: str = "vector", fts_prefilter: bool = False, fts_limit: int = 200, \
+                                rrf_k: int = 60, sources: list[str] = None, max_bias: float = None, \
+                                    bias_penalty: float = 0.0) -> pd.DataFrame:
+    """
+    Finds the `top_n` articles most similar to `text`.
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    classifier = pipeline("text-classification", model=model, tokenizer=tokenizer, device=0 if device.type == "cuda" else -1)
+    The source and date constraints (`sources`, `blacklist`, `date_filter`) are
+    resolved first into a mask from the corpus' precomputed source codes and sorted
+    dates; when they leave out a good part of the corpus only the surviving rows
+    are scored, otherwise the query is scored against the whole corpus with one
+    matmul on the pre-normalised embedding matrix and the mask is applied after.
+    Then the threshold is applied, whitelist boosts are added (capped at 1), the
+    stored bias of every row times `bias_penalty` is subtracted and the best rows
+    are picked with `np.argpartition`. Bias scores come from the 'bias' column
+    filled at ingest (`inference.bias`), nothing is classified at query time.
 
-    return classifier
+    If the corpus has passages (articles stored in chunked mode), those articles
+    are scored by their best passage instead, and the hits get a 'passages'
+    column with their best matching passages (None for unchunked articles),
+    which the prompt uses instead of the whole text.
 
-def get_bias(text, classifier):
-    tokenizer = classifier.tokenizer
+    In "hybrid" mode the BM25 ranking of the full-text index (`fts_search`) is
+    fused with the cosine ranking by reciprocal rank fusion, so exact names and
+    places that the embedding misses still make it in. With `fts_prefilter`,
+    only the rows matching the keywords are scored at all (if any match).
 
-    tokens = tokenizer.tokenize(text)
-    if len(tokens) > 512:
-        tokens = tokens[:509]
+    Args:
+        text: The query (str).
+        data: A `Corpus`, or the DataFrame from `sql3_as_pd` (the matrix is then built on every call).
+        embedder: The SentenceTransformer used to embed the query.
+        top_n: Number of articles to return (int).
+        threshold: Minimum cosine similarity before boosting (float).
+        sql_path: Path to the database the hits are read from, when the corpus does not hold the article text (str).
+        blacklist: Sources to exclude (list[str]).
+        whitelist: Sources whose score is boosted by `wl_boost[source]` (list[str]).
+        wl_boost: Boost per whitelisted source (dict).
+        date_filter: Optional {"start": ..., "end": ...} inclusive bounds on the publication date, as datetimes
+            or ISO strings (a bare "YYYY-MM-DD" end bound covers that whole day) (dict).
+        index: Optional IVF index (`data_prep.ann.load_index`), only the rows of its `n_probe` closest lists are scored.
+        n_probe: Number of index lists to scan, the recall vs. latency knob (int).
+        timings: If given, the seconds spent embedding, searching and fetching are stored in it under "embed", "search" and "fetch" (dict).
+        max_passages: Number of passages kept per hit, for chunked articles (int).
+        mode: "vector" (cosine only) or "hybrid" (cosine and BM25 fused) (str).
+        fts_prefilter: Only score the rows the full-text index matches (bool).
+        fts_limit: Number of full-text matches considered (int).
+        rrf_k: Constant of reciprocal rank fusion, higher flattens the ranks (int).
+        sources: If given, only articles from these sources are returned (list[str]).
+        max_bias: If given, articles scored as more biased are left out (unscored articles are kept) (float).
+        bias_penalty: Subtracted from the score of every article, times its bias (float).
 
-    truncated_text = tokenizer.convert_tokens_to_string(tokens)
+    Returns:
+        pd.DataFrame: The matching rows of the database, best first.
+    """
+    corpus: Corpus = data if isinstance(data, Corpus) else Corpus(data)
+    data = corpus.data
 
-    # Classify the truncated text
-    result = classifier(truncated_text)
+    if len(corpus) == 0:
+        return pd.DataFrame([], columns=data.columns)
 
-    if result[0]['label'] == 'Biased':
-        return result[0]['score']
-    else:
-        return 1 - result[0]['score']
+    t: float = time.perf_counter()
+    query: np.ndarray = embedder.encode(text)
+    t = _lap(timings, "embed", t)
 
-# ---------------------------------------------------------------------------- #
-#                                                                              #
-# ---------------------------------------------------------------------------- #
-# Get similar                                                                  #                       
-# ---------------------------------------------------------------------------- #
-#                                                                              #
-# ---------------------------------------------------------------------------- #
-def get_similar(text, data, embedder, top_n=3, threshold=0.5, sql_path = "embeddings.db",\
-                 blacklist: list[str] = [], whitelist: list[str] = [], wl_boost: dict = [], \
-                    date_filter:dict = None) -> pd.DataFrame:
-    text_vetor = torch.Tensor(embedder.encode(text))
+    if mode not in ("vector", "hybrid"):
+        raise ValueError(f"Unknown retrieval mode '{mode}', expected 'vector' or 'hybrid'")
 
-    if date_filter:
-        data = data[data["date"] >= date_filter["start"]] if "start" in date_filter else data
-        data = data[data["date"] <= date_filter["end"]]  if "end" in date_filter else data
+    # Source and date constraints, before anything is scored
+    date_filter = date_filter or {}
+    allowed: np.ndarray = corpus.filter_mask(sources, blacklist, date_bound(date_filter.get("start")),
+                                             date_bound(date_filter.get("end"), end=True), max_bias)
+    filtered: bool = not allowed.all()
 
-    sims = []
-    for i in range(len(data)):
-        data_vector = torch.Tensor(data.iloc[i]["embedding"]) # is it the best idea to have there as a tensor?
+    # Keyword matches, best BM25 first
+    keyword: np.ndarray = None
+    if mode == "hybrid" or fts_prefilter:
+        keyword = corpus.positions(fts_search(text, sql_path, fts_limit)[0])
 
-        sim = torch.nn.functional.cosine_similarity(text_vetor, data_vector, dim=0).item()
-        if sim > threshold and data.iloc[i]["source"] not in blacklist:
+    candidates: np.ndarray = corpus.positions(index.probe(query, n_probe)) if index is not None else None
 
-            if data.iloc[i]["source"] in whitelist:
-                sims.append((data.iloc[i]["embedding"], max(sim + wl_boost[data.iloc[i]["source"]]), 1))
-            else:
-                sims.append((data.iloc[i]["embedding"], sim))
-            
+    if fts_prefilter and len(keyword):
+        candidates = keyword if candidates is None else np.intersect1d(candidates, keyword)
 
-    top_n_sims = sorted(sims, key=lambda x: x[1], reverse=True)[:top_n]
+    if candidates is not None:
+        candidates = candidates[allowed[candidates]]
+    elif filtered and allowed.mean() < SUBSET_SCORING:
+        candidates = np.flatnonzero(allowed)
 
-    con = sqlite3.connect(sql_path)
-    cur = con.cursor()
+    sims: np.ndarray = corpus.score(query, candidates)
 
-    rows = []
+    passages: Passages = corpus.passages if corpus.passages is not None and len(corpus.passages) else None
+    if passages is not None:
+        passage_sims: np.ndarray = passages.score(query, np.flatnonzero(allowed[passages.articles]) if filtered else None)
+        best: np.ndarray = passages.best_per_article(passage_sims, len(corpus))
+        # Rows the index did not probe stay out
+        sims = np.where(np.isfinite(best) & np.isfinite(sims), best, sims)
 
-    for tup in top_n_sims:
-        vector, sim = tup
+    keep: np.ndarray = sims > threshold
 
-        cur.execute(f"SELECT * FROM embeddings WHERE embedding = '{vector}'")
-        rows.append(cur.fetchone())
-    
-    posts_df = pd.DataFrame(rows, columns=data.columns)
+    # A keyword match gets in on its BM25 rank even when its cosine is low
+    if mode == "hybrid":
+        keep[keyword] = True
+
+    keep &= allowed
+
+    if whitelist:
+        boost = dict(wl_boost or {})
+        per_source: np.ndarray = np.array([boost.get(name, 0.0) if name in whitelist else 0.0 for name in corpus.source_names], dtype=np.float32)
+        boosts: np.ndarray = per_source[corpus.source_codes]
+        sims = np.where(corpus.source_mask(whitelist), np.minimum(sims + boosts, 1.0), sims)
+
+    if bias_penalty:
+        sims = sims - bias_penalty * np.nan_to_num(corpus.bias, nan=0.0)
+
+    if mode == "hybrid":
+        kept: np.ndarray = np.flatnonzero(keep & np.isfinite(sims))
+        vector_ranking: np.ndarray = kept[np.lexsort((kept, -sims[kept]))]
+        fused: np.ndarray = reciprocal_rank_fusion([vector_ranking, keyword[keep[keyword]]], len(corpus), rrf_k)
+        top_n_sims: np.ndarray = top_k(fused, np.flatnonzero(keep), top_n)
+    else:
+        top_n_sims: np.ndarray = top_k(sims, np.flatnonzero(keep), top_n)
+    t = _lap(timings, "search", t)
+
+    # The loaded frame already holds the articles, only a slim corpus goes back to sqlite
+    if corpus.has_articles:
+        posts_df = data.iloc[top_n_sims].reset_index(drop=True)
+    else:
+        posts_df = fetch_rows(corpus.rowids[top_n_sims], sql_path)
+
+    if passages is not None:
+        posts_df["passages"] = matching_passages(passages, passage_sims, top_n_sims, threshold, max_passages, sql_path)
+    _lap(timings, "fetch", t)
 
     # get bias of each post and add it to the dataframe
     # classifier = get_bias_decector()
@@ -114,6 +165,271 @@ def get_similar(text, data, embedder, top_n=3, threshold=0.5, sql_path = "embedd
     return posts_df
 
 
+def date_bound(value, end: bool = False) -> np.datetime64:
+    """
+    A `date_filter` bound as a datetime64 (None stays None). A bare date as the end
+    bound means the end of that day.
+    """
+    if value is None or value == "":
+        return None
+
+    bound: pd.Timestamp = pd.Timestamp(value)
+    if bound.tzinfo is not None:
+        bound = bound.tz_convert("UTC").tz_localize(None)
+
+    if end and isinstance(value, str) and len(value.strip()) == 10:
+        bound += pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
+
+    return np.datetime64(bound.to_pydatetime(), "s")
+
+def search_filters(sources: list[str] = None, exclude_sources: list[str] = None, since=None, until=None,
+                   max_bias: float = None) -> dict:
+    """
+    Keyword arguments of `get_similar` for source and date constraints, leaving out the unset ones.
+
+    Args:
+        sources: Only return articles from these sources (list[str]).
+        exclude_sources: Never return articles from these sources (list[str]).
+        since: Earliest publication date, inclusive (str or datetime).
+        until: Latest publication date, inclusive (str or datetime).
+        max_bias: Highest stored bias score allowed (float).
+
+    Returns:
+        dict: Some of "sources", "blacklist", "date_filter" and "max_bias".
+
+    Raises:
+        ValueError: If a date cannot be parsed.
+    """
+    filters: dict = {}
+
+    if sources:
+        filters["sources"] = list(sources)
+    if exclude_sources:
+        filters["blacklist"] = list(exclude_sources)
+
+    date_filter: dict = {key: value for key, value in (("start", since), ("end", until)) if value}
+    for key, value in date_filter.items():
+        date_bound(value, end=key == "end")
+    if date_filter:
+        filters["date_filter"] = date_filter
+    if max_bias is not None:
+        filters["max_bias"] = float(max_bias)
+
+    return filters
+
+
+# Words that match almost every article and would only slow the full-text query down
+STOPWORDS: set = {"a", "an", "and", "are", "as", "at", "be", "by", "did", "do", "does", "for", "from", "has", "have", "how",
+                  "in", "is", "it", "its", "of", "on", "or", "that", "the", "this", "to", "up", "was", "were", "what", "when",
+                  "where", "which", "who", "why", "will", "with", "about", "latest", "news", "tell", "me"}
+
+def fts_query(text: str) -> str:
+    """
+    FTS5 query matching any of the words of `text`. Every word is quoted, so the
+    user's text can never be read as FTS5 syntax.
+    """
+    words: list[str] = [word for word in dict.fromkeys(re.findall(r"\w+", text.lower())) if word not in STOPWORDS]
+
+    return " OR ".join(f'"{word}"' for word in words)
+
+
+def fts_search(text: str, sql_path: str = "embeddings.db", limit: int = 200) -> tuple:
+    """
+    Full-text search of the title and text of the articles, ranked by BM25 (title matches weigh double).
+
+    Args:
+        text: The query (str).
+        sql_path: Path to the sqlite database (str).
+        limit: Maximum number of matches (int).
+
+    Returns:
+        tuple: The rowids of the matches, best first, and their BM25 scores (lower is better) (np.ndarray, np.ndarray).
+    """
+    query: str = fts_query(text)
+    if not query:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    sql = sqlite3.connect(sql_path)
+    try:
+        rows = sql.execute('''SELECT rowid, bm25(embeddings_fts, 2.0, 1.0) AS score FROM embeddings_fts
+                              WHERE embeddings_fts MATCH ? ORDER BY score LIMIT ?''', (query, limit)).fetchall()
+    except sqlite3.OperationalError:
+        # Database without the full-text index (it is created by `ensure_schema`)
+        rows = []
+    sql.close()
+
+    return np.array([row[0] for row in rows], dtype=np.int64), np.array([row[1] for row in rows])
+
+
+def reciprocal_rank_fusion(rankings: list, n: int, k: int = 60) -> np.ndarray:
+    """
+    Fuses rankings by summing 1 / (k + rank) over the rankings every row appears in.
+
+    Args:
+        rankings: Corpus positions, best first, one array per ranking (list[np.ndarray]).
+        n: Number of rows of the corpus (int).
+        k: Damping constant, 60 is the usual choice (int).
+
+    Returns:
+        np.ndarray: The fused score of every row (0 for rows in no ranking).
+    """
+    fused: np.ndarray = np.zeros(n, dtype=np.float64)
+
+    for ranking in rankings:
+        fused[ranking] += 1.0 / (k + np.arange(1, len(ranking) + 1))
+
+    return fused
+
+
+def matching_passages(passages: Passages, scores: np.ndarray, positions: np.ndarray, threshold: float,
+                      max_passages: int = 3, sql_path: str = "embeddings.db") -> list:
+    """
+    The best passages of every hit, read with a single query.
+
+    Args:
+        passages: The passages of the corpus (Passages).
+        scores: Score of every passage (np.ndarray).
+        positions: Corpus positions of the hits (np.ndarray).
+        threshold: Passages scoring below it are left out (float).
+        max_passages: Passages kept per hit (int).
+        sql_path: Path to the sqlite database (str).
+
+    Returns:
+        list: For every hit, its passages in document order with overlaps merged, or None if it was not chunked.
+    """
+    chosen: list = []
+    for position in positions:
+        own: np.ndarray = passages.of(int(position))
+        own = own[scores[own] > threshold]
+        chosen.append(own[np.argsort(-scores[own], kind="stable")[:max_passages]] if len(own) else None)
+
+    ids: list[int] = [int(passages.ids[i]) for own in chosen if own is not None for i in own]
+    rows: dict = {}
+
+    if ids:
+        sql = sqlite3.connect(sql_path)
+        query: str = f"SELECT id, start, end, text FROM passages WHERE id IN ({', '.join('?' * len(ids))})"
+        rows = {row[0]: row[1:] for row in sql.execute(query, ids)}
+        sql.close()
+
+    return [None if own is None else merge_passages([rows[int(passages.ids[i])] for i in own if int(passages.ids[i]) in rows])
+            for own in chosen]
+
+
+def _lap(timings: dict, stage: str, start: float) -> float:
+    # Records the time since `start` under `stage` (if timings are wanted, and as a metrics span) and starts the next lap
+    now: float = time.perf_counter()
+    if timings is not None:
+        timings[stage] = now - start
+
+    observe("query_" + stage, now - start)
+
+    return now
+
+
+def fetch_rows(rowids, sql_path: str = "embeddings.db") -> pd.DataFrame:
+    """
+    Reads articles by rowid with a single `WHERE rowid IN (...)` query.
+
+    Args:
+        rowids: The rowids to read, in the order the rows should be returned.
+        sql_path: Path to the sqlite database (str).
+
+    Returns:
+        pd.DataFrame: The rows (with a 'rowid' column and decoded embeddings), in the order of `rowids`.
+    """
+    rowids = [int(rowid) for rowid in rowids]
+
+    sql = sqlite3.connect(sql_path)
+    temp = pd.read_sql_query(f"SELECT rowid, * FROM embeddings WHERE rowid IN ({', '.join('?' * len(rowids))})", sql, params=rowids)
+    sql.close()
+
+    order: dict = {rowid: i for i, rowid in enumerate(rowids)}
+    temp = temp.iloc[np.argsort(temp["rowid"].map(order).to_numpy(), kind="stable")].reset_index(drop=True)
+    temp["embedding"] = [decode_embedding(blob, dtype) for blob, dtype in zip(temp["embedding"], temp["embedding_dtype"])]
+
+    return temp
+
+
+def load_corpus(path: str = "embeddings.db", quantize: str = None, dims: int = None, rerank: int = RERANK) -> Corpus:
+    """
+    Loads the corpus the fastest way available.
+
+    If the memory-mapped sidecar was built (`python -m data_prep.matrix_file`), the matrix is
+    mapped straight from it and only the url/source/date of every article is read from sqlite;
+    the text of the final hits is fetched per query. Otherwise the whole table is loaded with
+    `sql3_as_pd`.
+
+    With `quantize` (or `dims`) the corpus is scored on a compact copy of the matrix, see
+    `Corpus.quantize`; with the sidecar the full-precision rows used for reranking stay on disk.
+
+    Args:
+        path: Path to the sqlite database (str).
+        quantize: "int8", "float16" or None for the full float32 matrix (str).
+        dims: Only score the leading `dims` dimensions (int).
+        rerank: Quantized candidates rescored at full precision (int).
+
+    Returns:
+        Corpus: The corpus to pass to `get_similar`.
+    """
+    mapped = open_matrix(path)
+    if mapped is None:
+        corpus = Corpus(sql3_as_pd(path))
+        corpus.passages = load_passages(path, corpus)
+    else:
+        corpus = load_mapped_corpus(path, *mapped)
+        corpus.passages = load_passages(path, corpus)
+
+    if quantize or dims:
+        corpus.quantize(quantize or "float32", dims, rerank)
+
+    return corpus
+
+
+def load_mapped_corpus(path: str, ids: np.ndarray, matrix: np.ndarray) -> Corpus:
+    """
+    Corpus over the memory-mapped sidecar, with only the url/source/date of every article read from sqlite.
+    """
+    sql = sqlite3.connect(path)
+    meta = pd.read_sql_query("SELECT rowid, url, source, publication_date, bias FROM embeddings", sql)
+    sql.close()
+
+    # One frame row per matrix row, tombstoned or missing rows are kept but never live
+    meta = meta.set_index("rowid").reindex(ids)
+    live: np.ndarray = (ids >= 0) & meta["url"].notna().to_numpy()
+    meta = meta.rename_axis("rowid").reset_index()
+    meta["rowid"] = ids
+
+    return Corpus(meta, matrix, live)
+
+
+def load_passages(path: str, corpus: Corpus):
+    """
+    Loads the passage embeddings of the chunked articles of `corpus`.
+
+    Args:
+        path: Path to the sqlite database (str).
+        corpus: The corpus the passages are matched to by url (Corpus).
+
+    Returns:
+        Optional[Passages]: The passages, or None if no article was stored in chunked mode.
+    """
+    sql = sqlite3.connect(path)
+    has_table = sql.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'passages'").fetchone()
+    rows = sql.execute("SELECT id, url, embedding, embedding_dtype FROM passages").fetchall() if has_table else []
+    sql.close()
+
+    positions: dict = {url: i for i, url in enumerate(corpus.data["url"]) if isinstance(url, str)}
+    rows = [row for row in rows if row[1] in positions]
+
+    if not rows:
+        return None
+
+    matrix: np.ndarray = normalize_rows(np.vstack([decode_embedding(blob, dtype) for _, _, blob, dtype in rows]).astype(np.float32))
+
+    return Passages([row[0] for row in rows], [positions[row[1]] for row in rows], matrix)
+
+
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
@@ -124,9 +440,11 @@ def get_similar(text, data, embedder, top_n=3, threshold=0.5, sql_path = "embedd
 def sql3_as_pd(path: str) -> pd.DataFrame:
     sql = sqlite3.connect(path)
 
-    temp = pd.read_sql_query("SELECT * FROM embeddings", sql)
+    temp = pd.read_sql_query("SELECT rowid, * FROM embeddings", sql)
 
-    temp["embedding"] = temp['embedding'].map(lambda x: literal_eval(x))
+    # frombuffer views on the stored BLOBs, no parsing (legacy text rows are still understood)
+    dtypes = temp["embedding_dtype"] if "embedding_dtype" in temp else [None] * len(temp)
+    temp["embedding"] = [decode_embedding(blob, dtype) for blob, dtype in zip(temp["embedding"], dtypes)]
 
     return temp
     
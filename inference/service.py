@@ -0,0 +1,676 @@
+"""
+Long-running query service.
+
+`main.py` reloads the embedder and the corpus for every question it answers. The
+service loads the embedder, the corpus (memory-mapped when the sidecar exists), the
+IVF index and optionally the bias classifier once, then answers requests over HTTP
+(or a Unix socket) until it is stopped:
+
+    POST /query   {"q": "...", "length": "short", "llm": "llama3"}  -> {"response", "sources", "timings_ms"}
+    POST /query/stream  (same body)                                 -> one JSON object per line: the sources, then the tokens
+    POST /search  {"q": "...", "top_n": 5}                          -> {"articles", "timings_ms"}
+
+The retrieval options "top_n", "n_probe", "threshold", "mode" ("vector" or "hybrid"),
+"fts_prefilter", "bias_penalty" and the filters "sources", "exclude_sources",
+"since", "until" (ISO dates) and "max_bias" are accepted by all three POST endpoints;
+"max_context_tokens" by the /query ones. A malformed body or field gets a 400 with an
+{"error"} message.
+    GET  /stats                                                     -> p50/p99 latency of every stage
+    GET  /metrics                                                   -> counters and spans, Prometheus text format
+    POST /reload                                                    -> reload the corpus now
+    GET  /health
+
+Blocking work (embedding, scoring, the LLM call) runs in a thread pool so requests
+are answered concurrently. The database files are watched and the corpus and index
+are reloaded in the background when the ingest path writes new rows, so freshly
+scraped articles are served without a restart. Query embeddings and reports are
+cached (`inference.cache`) and the caches are written to disk on shutdown. The LLM
+is reached through the `ollama` module, OLLAMA_HOST points it at another server.
+
+Usage:
+    python -m inference.service --port 8080 [--bias] [--socket /tmp/news.sock]
+"""
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Imports                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Iterator, Optional
+
+import numpy as np
+from aiohttp import web
+
+from data_prep.ann import index_path, load_index, IVFIndex
+from data_prep.matrix_file import manifest_path
+from data_prep.metrics import METRICS, configure
+from data_prep.schema import DB_PATH
+from inference.cache import TTLCache, CachedEmbedder, answer_key, EMBEDDING_CACHE_PATH, ANSWER_CACHE_PATH
+from inference.corpus import Corpus, RERANK
+from inference.llm import inference_llm, stream_llm
+from inference.prompts import get_news_report_prompt, CONTEXT_TOKENS
+from inference.queries import load_corpus, get_similar, get_bias_decector, get_bias, search_filters
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Latency                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+class LatencyStats:
+    """
+    Keeps the most recent latencies of every stage and reports their percentiles.
+
+    Attributes:
+        window: Number of samples kept per stage (int).
+        counts: Number of samples ever recorded per stage (dict[str, int]).
+    """
+    def __init__(self, window: int = 10000):
+        self.window: int = window
+        self.counts: dict[str, int] = {}
+        self._samples: dict[str, deque] = {}
+
+    def record(self, stage: str, seconds: float) -> None:
+        """
+        Adds one latency sample to a stage.
+        """
+        self._samples.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def record_all(self, timings: dict) -> None:
+        """
+        Adds the samples of a {stage: seconds} dict.
+        """
+        for stage, seconds in timings.items():
+            self.record(stage, seconds)
+
+    def summary(self) -> dict:
+        """
+        Returns:
+            dict: {stage: {"count", "p50_ms", "p99_ms", "max_ms"}} over the kept samples.
+        """
+        summary: dict = {}
+
+        for stage, samples in list(self._samples.items()):
+            ms: np.ndarray = 1000 * np.fromiter(samples, dtype=np.float64)
+            summary[stage] = {
+                "count": self.counts[stage],
+                "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                "p99_ms": round(float(np.percentile(ms, 99)), 3),
+                "max_ms": round(float(ms.max()), 3),
+            }
+
+        return summary
+
+def matrix_bytes(corpus: Corpus) -> int:
+    """
+    Resident size of the matrix a corpus is scored on (a memory-mapped matrix is not counted).
+    """
+    if corpus.quantized is not None:
+        return corpus.quantized.nbytes + (corpus.matrix.nbytes if corpus.rerank and not isinstance(corpus.matrix, np.memmap) else 0)
+
+    return 0 if isinstance(corpus.matrix, np.memmap) else corpus.matrix.nbytes
+
+async def read_body(request: web.Request) -> dict:
+    """
+    The JSON object a request was sent with.
+
+    Raises:
+        ValueError: If the body is not valid JSON or not an object.
+    """
+    try:
+        body = await request.json()
+    except ValueError:  # json.JSONDecodeError, or bytes that are not UTF-8
+        raise ValueError("the request body must be a JSON object")
+
+    if not isinstance(body, dict):
+        raise ValueError("the request body must be a JSON object")
+
+    return body
+
+def retrieval_options(body: dict) -> dict:
+    """
+    Retrieval options of a request body, as keyword arguments of `QueryService.search`.
+
+    Raises:
+        ValueError: On an unknown "mode", a malformed source list, an unreadable date or
+            a number that is not one.
+    """
+    mode: str = str(body.get("mode", "vector")).lower()
+    if mode not in ("vector", "hybrid"):
+        raise ValueError("'mode' must be vector or hybrid")
+
+    for key in ("sources", "exclude_sources"):
+        value = body.get(key, [])
+        if not isinstance(value, list) or not all(isinstance(source, str) for source in value):
+            raise ValueError(f"'{key}' must be a list of source names")
+
+    try:
+        filters: dict = search_filters(body.get("sources"), body.get("exclude_sources"), body.get("since"), body.get("until"),
+                                       body.get("max_bias"))
+    except (TypeError, ValueError):
+        raise ValueError("'since' and 'until' must be ISO dates and 'max_bias' a number")
+
+    try:
+        top_n: int = int(body.get("top_n", 5))
+        n_probe: int = int(body.get("n_probe", 8))
+        threshold: float = float(body.get("threshold", 0.5))
+        bias_penalty: float = float(body.get("bias_penalty", 0.0))
+    except (TypeError, ValueError):
+        raise ValueError("'top_n' and 'n_probe' must be integers, 'threshold' and 'bias_penalty' numbers")
+
+    if top_n < 1 or n_probe < 1:
+        raise ValueError("'top_n' and 'n_probe' must be at least 1")
+
+    return {
+        "top_n": top_n,
+        "n_probe": n_probe,
+        "threshold": threshold,
+        "mode": mode,
+        "fts_prefilter": bool(body.get("fts_prefilter", False)),
+        "bias_penalty": bias_penalty,
+        **filters,
+    }
+
+def request_options(body: dict, report: bool = False) -> dict:
+    """
+    Validated options of a /search body, or of a /query body with `report`, as keyword
+    arguments of `QueryService.search` (or `QueryService.answer`): the question, the
+    `retrieval_options` and, for a report, its length, LLM and context budget.
+
+    Raises:
+        ValueError: On a missing or non-string "q", or any malformed field.
+    """
+    q = body.get("q")
+    if q is None or q == "":
+        raise ValueError("'q' is required")
+    if not isinstance(q, str) or not q.strip():
+        raise ValueError("'q' must be a non-empty string")
+
+    options: dict = {"q": q, **retrieval_options(body)}
+    if not report:
+        return options
+
+    length: str = str(body.get("length", "short")).lower()
+    if length not in ("short", "medium", "long"):
+        raise ValueError("'length' must be short, medium or long")
+
+    llm = body.get("llm", "llama3")
+    if not isinstance(llm, str) or not llm:
+        raise ValueError("'llm' must be a model name")
+
+    try:
+        max_context_tokens: int = int(body.get("max_context_tokens", CONTEXT_TOKENS))
+    except (TypeError, ValueError):
+        raise ValueError("'max_context_tokens' must be an integer")
+    if max_context_tokens < 1:
+        raise ValueError("'max_context_tokens' must be at least 1")
+
+    return {**options, "length": length, "llm": llm, "max_context_tokens": max_context_tokens}
+
+def ms(timings: dict) -> dict:
+    """
+    A {stage: seconds} dict in milliseconds, for the responses.
+    """
+    return {stage: round(1000 * seconds, 3) for stage, seconds in timings.items()}
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Service                                                                      #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+class Snapshot:
+    """
+    A loaded corpus and index. Requests keep the snapshot they started with, a reload
+    swaps in a new one.
+    """
+    def __init__(self, corpus: Corpus, index: Optional[IVFIndex], signature: tuple):
+        self.corpus: Corpus = corpus
+        self.index: Optional[IVFIndex] = index
+        self.signature: tuple = signature
+        self.loaded_at: datetime = datetime.now()
+
+class QueryService:
+    """
+    Holds the resident models and corpus and answers `f_inference`-style requests.
+
+    Args:
+        embedder: The SentenceTransformer used to embed the queries, wrapped in a `CachedEmbedder` to cache query embeddings.
+        db_path: Path to the sqlite database (str).
+        classifier: Optional bias classifier (`get_bias_decector`), the bias of every response is then reported.
+        workers: Number of requests processed at the same time (int).
+        reload_interval: Seconds between two checks of the database files, 0 disables hot reload (float).
+        answer_cache: Report cache, None to always call the LLM (TTLCache).
+        corpus_options: Keyword arguments of `load_corpus`, e.g. {"quantize": "int8", "rerank": 100} (dict).
+    """
+    def __init__(self, embedder, db_path: str = DB_PATH, classifier=None, workers: int = 8, reload_interval: float = 5.0,
+                 answer_cache: Optional[TTLCache] = None, corpus_options: Optional[dict] = None):
+        self.embedder = embedder
+        self.embedding_cache: Optional[TTLCache] = embedder.cache if isinstance(embedder, CachedEmbedder) else None
+        self.answer_cache: Optional[TTLCache] = answer_cache
+        self.db_path: str = db_path
+        self.classifier = classifier
+        self.reload_interval: float = reload_interval
+        self.corpus_options: dict = corpus_options or {}
+
+        self.stats: LatencyStats = LatencyStats()
+        self.reloads: int = 0
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="query")
+
+        self.snapshot: Snapshot = self.load()
+        self._reloading: asyncio.Lock = asyncio.Lock()
+        self._watcher: Optional[asyncio.Task] = None
+
+    # ------------------------------------------------------------------------ #
+    # Loading
+    # ------------------------------------------------------------------------ #
+    def signature(self) -> tuple:
+        """
+        Size and modification time of the files the corpus is loaded from.
+
+        With the sidecar, `store_vectors`, `clean_database` and the streaming ingest
+        rewrite its manifest whenever rows come or go, so only the manifest (and the
+        index) are watched.
+        Without it, the database and its write-ahead log are.
+        """
+        watched: list[str] = [manifest_path(self.db_path), index_path(self.db_path)]
+        if not os.path.exists(watched[0]):
+            watched += [self.db_path, self.db_path + "-wal"]
+
+        signature: list = []
+        for path in watched:
+            try:
+                stat: os.stat_result = os.stat(path)
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append((path, None, None))
+
+        return tuple(signature)
+
+    def load(self) -> Snapshot:
+        """
+        Loads the corpus and the index (blocking).
+        """
+        t: float = time.perf_counter()
+        signature: tuple = self.signature()
+
+        snapshot: Snapshot = Snapshot(load_corpus(self.db_path, **self.corpus_options), load_index(self.db_path), signature)
+
+        self.stats.record("reload", time.perf_counter() - t)
+        print(f"Loaded {int(snapshot.corpus.live.sum())} articles in {time.perf_counter() - t:.3f}s")
+
+        return snapshot
+
+    async def reload(self, force: bool = False) -> bool:
+        """
+        Reloads the corpus in the background if the database files changed (or if `force`).
+
+        Returns:
+            bool: Whether a new snapshot was swapped in.
+        """
+        async with self._reloading:
+            if not force and self.signature() == self.snapshot.signature:
+                return False
+
+            loop = asyncio.get_running_loop()
+            self.snapshot = await loop.run_in_executor(self.executor, self.load)
+            self.reloads += 1
+
+        return True
+
+    async def watch(self) -> None:
+        # Polls the database files, a failed reload keeps serving the previous snapshot
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                print(f"Reload failed, keeping the loaded corpus: {e}")
+
+    # ------------------------------------------------------------------------ #
+    # Stages
+    # ------------------------------------------------------------------------ #
+    def search(self, q: str, top_n: int = 5, threshold: float = 0.5, n_probe: int = 8, mode: str = "vector",
+               fts_prefilter: bool = False, timings: dict = None, **filters):
+        """
+        Retrieval only: the `top_n` articles most similar to `q` (blocking). `mode` and
+        `fts_prefilter` select keyword retrieval and `filters` are the source, date and
+        bias options (`search_filters`, `bias_penalty`), as in `get_similar`.
+        """
+        snapshot: Snapshot = self.snapshot
+
+        return get_similar(q, snapshot.corpus, self.embedder, top_n=top_n, threshold=threshold, sql_path=self.db_path,
+                           index=snapshot.index, n_probe=n_probe, timings=timings, mode=mode, fts_prefilter=fts_prefilter,
+                           **filters)
+
+    def _prepare(self, q: str, length: str, llm: str, max_context_tokens: int, context: dict, timings: dict,
+                 retrieval: dict) -> tuple:
+        # Retrieval and prompt, shared by the blocking and the streaming answer
+        similar = self.search(q, timings=timings, **retrieval)
+
+        t: float = time.perf_counter()
+        prompt, system_prompt, sources = get_news_report_prompt(similar, q, length, max_context_tokens, stats=context)
+        timings["prompt"] = time.perf_counter() - t
+
+        # The key holds the retrieved articles, a report written from other sources is never reused
+        key: tuple = answer_key(q, similar, length, llm, max_context_tokens)
+        cached: Optional[dict] = self.answer_cache.get(key) if self.answer_cache is not None else None
+        # Reports persisted by older versions were bare strings, they are regenerated
+        if not isinstance(cached, dict):
+            cached = None
+
+        return prompt, system_prompt, sources, key, cached
+
+    def _finish(self, key: tuple, response: str, timings: dict) -> Optional[float]:
+        # Bias of a freshly generated report, which then goes to the cache
+        bias: Optional[float] = None
+        if self.classifier is not None:
+            t: float = time.perf_counter()
+            bias = float(get_bias(response, self.classifier))
+            timings["bias"] = time.perf_counter() - t
+
+        if self.answer_cache is not None:
+            self.answer_cache.put(key, {"response": response, "bias": bias})
+
+        return bias
+
+    def answer(self, q: str, length: str = "short", llm: str = "llama3", max_context_tokens: int = CONTEXT_TOKENS,
+               timings: dict = None, **retrieval) -> dict:
+        """
+        Same pipeline as `f_inference`: retrieval, prompt, LLM and (optionally) bias (blocking).
+        `retrieval` holds the options of `search` (top_n, n_probe, mode, fts_prefilter, filters).
+
+        Returns:
+            dict: {"response": str, "sources": str, "bias": Optional[float], "cached": bool, "context": dict}
+            where "context" is the token usage of the packed articles (`pack_context`).
+        """
+        timings = {} if timings is None else timings
+        context: dict = {}
+
+        prompt, system_prompt, sources, key, cached = self._prepare(q, length, llm, max_context_tokens, context, timings, retrieval)
+        if cached is not None:
+            return {**cached, "sources": sources, "cached": True, "context": context}
+
+        t: float = time.perf_counter()
+        response: str = inference_llm(prompt, system_prompt, llm)
+        timings["llm"] = time.perf_counter() - t
+
+        bias: Optional[float] = self._finish(key, response, timings)
+
+        return {"response": response, "sources": sources, "bias": bias, "cached": False, "context": context}
+
+    def answer_stream(self, q: str, length: str = "short", llm: str = "llama3", max_context_tokens: int = CONTEXT_TOKENS,
+                      timings: dict = None, **retrieval) -> Iterator[dict]:
+        """
+        Streaming version of `answer` (blocking generator).
+
+        Yields:
+            dict: {"sources": str, "context": dict} first, then {"token": str} as the report is
+            generated and finally {"bias", "cached", "tokens", "tokens_per_sec"}.
+        """
+        timings = {} if timings is None else timings
+        context: dict = {}
+
+        prompt, system_prompt, sources, key, cached = self._prepare(q, length, llm, max_context_tokens, context, timings, retrieval)
+        yield {"sources": sources, "context": context}
+
+        if cached is not None:
+            yield {"token": cached["response"]}
+            yield {"bias": cached["bias"], "cached": True}
+            return
+
+        t: float = time.perf_counter()
+        generation: dict = {}
+        parts: list[str] = []
+
+        for token in stream_llm(prompt, system_prompt, llm, stats=generation):
+            parts.append(token)
+            yield {"token": token}
+
+        timings["ttft"] = generation["ttft"]
+        timings["llm"] = time.perf_counter() - t
+
+        bias: Optional[float] = self._finish(key, "".join(parts), timings)
+
+        yield {"bias": bias, "cached": False, "tokens": generation["tokens"], "tokens_per_sec": round(generation["tokens_per_sec"], 2)}
+
+    async def run(self, fn, *args, **kwargs) -> tuple:
+        # Runs a blocking stage in the pool, timing every stage and the request as a whole
+        loop = asyncio.get_running_loop()
+        timings: dict = {}
+        t: float = time.perf_counter()
+
+        result = await loop.run_in_executor(self.executor, lambda: fn(*args, timings=timings, **kwargs))
+
+        timings["total"] = time.perf_counter() - t
+        self.stats.record_all(timings)
+
+        return result, timings
+
+    # ------------------------------------------------------------------------ #
+    # Handlers
+    # ------------------------------------------------------------------------ #
+    async def handle_query(self, request: web.Request) -> web.Response:
+        try:
+            options: dict = request_options(await read_body(request), report=True)
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=400)
+
+        result, timings = await self.run(self.answer, **options)
+
+        return web.json_response({**result, "timings_ms": ms(timings)})
+
+    async def handle_query_stream(self, request: web.Request) -> web.StreamResponse:
+        try:
+            options: dict = request_options(await read_body(request), report=True)
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=400)
+
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+        stopped: threading.Event = threading.Event()
+        timings: dict = {}
+        t: float = time.perf_counter()
+
+        def produce() -> None:
+            # Runs the generator in the pool and hands its events over to the event loop
+            try:
+                for event in self.answer_stream(timings=timings, **options):
+                    if stopped.is_set():
+                        break
+                    loop.call_soon_threadsafe(events.put_nowait, event)
+            except Exception as e:
+                loop.call_soon_threadsafe(events.put_nowait, {"error": str(e)})
+            finally:
+                loop.call_soon_threadsafe(events.put_nowait, None)
+
+        response: web.StreamResponse = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+
+        producer = loop.run_in_executor(self.executor, produce)
+        try:
+            while (event := await events.get()) is not None:
+                await response.write(json.dumps(event).encode("utf-8") + b"\n")
+        finally:
+            # The client went away: stop generating at the next token
+            stopped.set()
+            await producer
+
+        timings["total"] = time.perf_counter() - t
+        self.stats.record_all(timings)
+
+        await response.write(json.dumps({"done": True, "timings_ms": ms(timings)}).encode("utf-8") + b"\n")
+        await response.write_eof()
+
+        return response
+
+    async def handle_search(self, request: web.Request) -> web.Response:
+        try:
+            options: dict = request_options(await read_body(request))
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=400)
+
+        similar, timings = await self.run(self.search, **options)
+
+        columns: list[str] = [column for column in ("url", "title", "source", "publication_date", "bias") if column in similar]
+        articles: list[dict] = similar[columns].astype(object).where(similar[columns].notna(), None).to_dict("records")
+
+        return web.json_response({"articles": articles, "timings_ms": ms(timings)})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        snapshot: Snapshot = self.snapshot
+
+        return web.json_response({
+            "stages": self.stats.summary(),
+            "corpus": {
+                "articles": int(snapshot.corpus.live.sum()),
+                "indexed": snapshot.index is not None,
+                "quantized": snapshot.corpus.quantized.kind if snapshot.corpus.quantized is not None else None,
+                "matrix_mb": round(matrix_bytes(snapshot.corpus) / 1e6, 2),
+                "loaded_at": snapshot.loaded_at.isoformat(timespec="seconds"),
+                "reloads": self.reloads,
+            },
+            "caches": {
+                "embedding": self.embedding_cache.stats() if self.embedding_cache is not None else None,
+                "answer": self.answer_cache.stats() if self.answer_cache is not None else None,
+            },
+        })
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=METRICS.prometheus_text().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def handle_reload(self, request: web.Request) -> web.Response:
+        await self.reload(force=True)
+
+        return web.json_response({"articles": int(self.snapshot.corpus.live.sum()), "reloads": self.reloads})
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    # ------------------------------------------------------------------------ #
+    # App
+    # ------------------------------------------------------------------------ #
+    async def _start(self, app: web.Application) -> None:
+        if self.reload_interval > 0:
+            self._watcher = asyncio.create_task(self.watch())
+
+    async def _stop(self, app: web.Application) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+
+        self.executor.shutdown(wait=False)
+
+        for cache in (self.embedding_cache, self.answer_cache):
+            if cache is not None:
+                cache.save()
+
+        for stage, summary in self.stats.summary().items():
+            print(f"{stage:>8}: n={summary['count']} p50={summary['p50_ms']:.1f} ms p99={summary['p99_ms']:.1f} ms")
+
+    def app(self) -> web.Application:
+        """
+        The aiohttp application serving the endpoints.
+        """
+        app: web.Application = web.Application()
+        app.add_routes([
+            web.post("/query", self.handle_query),
+            web.post("/query/stream", self.handle_query_stream),
+            web.post("/search", self.handle_search),
+            web.get("/stats", self.handle_stats),
+            web.get("/metrics", self.handle_metrics),
+            web.post("/reload", self.handle_reload),
+            web.get("/health", self.handle_health),
+        ])
+        app.on_startup.append(self._start)
+        app.on_cleanup.append(self._stop)
+
+        return app
+
+def serve(embedder, db_path: str = DB_PATH, host: str = "127.0.0.1", port: int = 8080, socket_path: str = None,
+          classifier=None, workers: int = 8, reload_interval: float = 5.0, answer_cache: Optional[TTLCache] = None,
+          corpus_options: Optional[dict] = None) -> None:
+    """
+    Runs the service until interrupted.
+
+    Args:
+        embedder: The SentenceTransformer used to embed the queries (or a `CachedEmbedder`).
+        db_path: Path to the sqlite database (str).
+        host: Interface to listen on (str).
+        port: TCP port to listen on (int).
+        socket_path: Listen on this Unix socket instead of TCP (str).
+        classifier: Optional bias classifier loaded with `get_bias_decector`.
+        workers: Number of requests processed at the same time (int).
+        reload_interval: Seconds between two checks for newly ingested rows, 0 disables hot reload (float).
+        answer_cache: Report cache (TTLCache).
+        corpus_options: How the corpus matrix is held, keyword arguments of `load_corpus` (dict).
+    """
+    # Kept in memory for /metrics even when no metrics file was asked for
+    if not METRICS.enabled:
+        configure()
+
+    async def make_app() -> web.Application:
+        # Created inside the running loop, which the service's lock and watcher belong to
+        return QueryService(embedder, db_path, classifier, workers, reload_interval, answer_cache, corpus_options).app()
+
+    if socket_path:
+        web.run_app(make_app(), path=socket_path)
+    else:
+        web.run_app(make_app(), host=host, port=port)
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Main                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def main(argv: Optional[list[str]] = None) -> None:
+    """
+    Parses the command line (`argv`, defaults to `sys.argv`) and runs the service; `python main.py serve` lands here too.
+    """
+    parser = argparse.ArgumentParser(description="Serve news queries with the models and the corpus kept in memory.")
+    parser.add_argument("--db", default=DB_PATH, help="path to the sqlite database")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--socket", default=None, help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--model", default="Alibaba-NLP_gte-large-en-v1.5", help="SentenceTransformer name or path")
+    parser.add_argument("--bias", action="store_true", help="load the bias classifier and score every response")
+    parser.add_argument("--workers", type=int, default=8, help="requests processed at the same time")
+    parser.add_argument("--reload-interval", type=float, default=5.0, help="seconds between checks for new rows, 0 to disable")
+    parser.add_argument("--cache-size", type=int, default=1024, help="reports kept in the answer cache, 0 disables both caches")
+    parser.add_argument("--cache-ttl", type=float, default=6 * 3600, help="seconds a cached report stays valid")
+    parser.add_argument("--quantize", choices=["int8", "float16"], default=None, help="score a compact copy of the matrix")
+    parser.add_argument("--dims", type=int, default=None, help="score only the leading DIMS dimensions")
+    parser.add_argument("--rerank", type=int, default=RERANK, help="quantized candidates rescored at full precision, 0 to disable")
+    args = parser.parse_args(argv)
+
+    from inference.embedder import load_custom_sentence_transformer
+
+    embedder = load_custom_sentence_transformer(args.model)
+    answer_cache: Optional[TTLCache] = None
+
+    if args.cache_size:
+        # Embeddings of a query never go stale for a given model, they are only bounded in number
+        embedder = CachedEmbedder(embedder, TTLCache(4 * args.cache_size, ttl=None, path=EMBEDDING_CACHE_PATH), args.model)
+        answer_cache = TTLCache(args.cache_size, ttl=args.cache_ttl, path=ANSWER_CACHE_PATH)
+
+    serve(embedder, args.db, args.host, args.port, args.socket,
+          get_bias_decector() if args.bias else None, args.workers, args.reload_interval, answer_cache,
+          {"quantize": args.quantize, "dims": args.dims, "rerank": args.rerank})
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+from data_prep import vec_db
+from data_prep.codec import encode_embedding
+from data_prep.matrix_file import build_matrix_file
+from inference.queries import fts_query, get_similar, load_corpus, reciprocal_rank_fusion, search_filters
+
+def store(embedder, articles: list[tuple[str, str, str, str]]) -> None:
+    # (url, source, publication date, text) rows straight into 'embeddings.db'
+    vec_db.create_db()
+    for url, source, date, text in articles:
+        blob, dtype, dim = encode_embedding(embedder.encode(text))
+        vec_db.store_in_db(url, blob, text, source, ["A Reporter"], text[:40], date, dtype, dim, vec_db.content_hash(text))
+
+def test_rrf_ranks_rows_found_by_both_rankings_first():
+    fused: np.ndarray = reciprocal_rank_fusion([np.array([3, 1, 0]), np.array([1, 2])], n=5, k=60)
+
+    assert fused[1] == pytest.approx(1 / 62 + 1 / 61)
+    assert fused[3] == pytest.approx(1 / 61)
+    assert fused[4] == 0
+    assert list(np.argsort(-fused, kind="stable")) == [1, 3, 2, 0, 4]
+
+def test_rrf_of_one_ranking_keeps_its_order():
+    ranking: np.ndarray = np.array([4, 0, 2])
+    fused: np.ndarray = reciprocal_rank_fusion([ranking], n=5)
+
+    assert list(np.argsort(-fused)[:3]) == list(ranking)
+
+def test_fts_query_quotes_every_word():
+    assert fts_query('What did "Zelenskyy" say about NEAR grain?') == '"zelenskyy" OR "say" OR "near" OR "grain"'
+    assert fts_query("the of and") == ""
+
+def test_hybrid_finds_the_keyword_match_the_vector_misses(workdir, embedder):
+    filler: str = " ".join(f"filler{i}" for i in range(40))
+    store(embedder, [
+        ("http://a/1", "BBC News", "2024-06-19 12:00:00", "harvest grain exports rise in the region " * 3),
+        ("http://a/2", "BBC News", "2024-06-19 12:00:00", f"zelenskyy {filler}"),
+        ("http://a/3", "BBC News", "2024-06-19 12:00:00", "weather today is sunny " * 3),
+    ])
+    corpus = load_corpus()
+
+    vector = get_similar("zelenskyy grain exports", corpus, embedder, top_n=3, threshold=0.3)
+    hybrid = get_similar("zelenskyy grain exports", corpus, embedder, top_n=3, threshold=0.3, mode="hybrid")
+
+    assert list(vector["url"]) == ["http://a/1"]
+    assert list(hybrid["url"]) == ["http://a/1", "http://a/2"]
+
+# Two articles per source over three days, one of them just before midnight
+FILTER_ARTICLES: list[tuple[str, str, str, str]] = [
+    (f"http://{source.split()[0].lower()}/{n}", source, date, f"grain exports story {n} from {source}")
+    for n, (source, date) in enumerate([("BBC News", "2024-06-17 09:00:00"), ("BBC News", "2024-06-18 23:30:00"),
+                                        ("Reuters", "2024-06-17 10:00:00"), ("Reuters", "2024-06-19 08:00:00"),
+                                        ("AP", "2024-06-18 07:00:00"), ("AP", "2024-06-19 09:00:00")])
+]
+
+@pytest.fixture(params=["table", "sidecar"])
+def filter_corpus(request, workdir, embedder):
+    store(embedder, FILTER_ARTICLES)
+    if request.param == "sidecar":
+        build_matrix_file()
+    return load_corpus()
+
+@pytest.mark.parametrize("filters, expected", [
+    # A third of the corpus: only the surviving rows are scored
+    ({"sources": ["Reuters"]}, {"http://reuters/2", "http://reuters/3"}),
+    # Two thirds: scored in full, masked after
+    ({"blacklist": ["AP"]}, {"http://bbc/0", "http://bbc/1", "http://reuters/2", "http://reuters/3"}),
+    # A bare end date covers the whole day
+    ({"date_filter": {"start": "2024-06-18", "end": "2024-06-18"}}, {"http://bbc/1", "http://ap/4"}),
+    ({"sources": ["BBC News", "AP"], "date_filter": {"start": "2024-06-18"}}, {"http://bbc/1", "http://ap/4", "http://ap/5"}),
+    ({"sources": ["Nobody"]}, set()),
+])
+def test_filters_return_only_matching_rows(filter_corpus, embedder, filters, expected):
+    hits = get_similar("grain exports", filter_corpus, embedder, top_n=10, threshold=0.0, **filters)
+
+    assert set(hits["url"]) == expected
+
+def test_filtered_ranking_matches_the_unfiltered_one(filter_corpus, embedder):
+    everything = get_similar("grain exports story 3 from Reuters", filter_corpus, embedder, top_n=10, threshold=0.0)
+    reuters = get_similar("grain exports story 3 from Reuters", filter_corpus, embedder, top_n=10, threshold=0.0,
+                          sources=["Reuters"])
+
+    assert list(reuters["url"]) == [url for url in everything["url"] if url.startswith("http://reuters/")]
+
+def test_max_bias_keeps_unscored_articles(workdir, embedder):
+    store(embedder, FILTER_ARTICLES[:2])
+    blob, dtype, dim = encode_embedding(embedder.encode("grain exports biased"))
+    vec_db.store_in_db("http://biased/1", blob, "grain exports biased", "BBC News", [], "t", "2024-06-19 12:00:00",
+                       dtype, dim, bias=0.9)
+
+    hits = get_similar("grain exports", load_corpus(), embedder, top_n=10, threshold=0.0, max_bias=0.5)
+
+    assert set(hits["url"]) == {"http://bbc/0", "http://bbc/1"}
+
+def test_search_filters_leaves_out_unset_constraints():
+    assert search_filters() == {}
+    assert search_filters(sources=["Reuters"], until="2024-06-19", max_bias=1) == {
+        "sources": ["Reuters"], "date_filter": {"end": "2024-06-19"}, "max_bias": 1.0}
+
+    with pytest.raises(ValueError):
+        search_filters(since="yesterday")
@@ -0,0 +1,87 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("ollama")  # inference.service talks to the LLM through it
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from inference.prompts import CONTEXT_TOKENS
+from inference.service import QueryService, request_options
+
+MALFORMED_FIELDS: list[dict] = [
+    {},
+    {"q": ""},
+    {"q": 123, "mode": "hybrid"},
+    {"q": "   "},
+    {"q": "x", "top_n": None},
+    {"q": "x", "top_n": "five"},
+    {"q": "x", "top_n": 0},
+    {"q": "x", "n_probe": "many"},
+    {"q": "x", "threshold": "abc"},
+    {"q": "x", "bias_penalty": [1]},
+    {"q": "x", "mode": "fuzzy"},
+    {"q": "x", "sources": "BBC News"},
+    {"q": "x", "exclude_sources": [1, 2]},
+    {"q": "x", "since": "yesterday"},
+    {"q": "x", "max_bias": "high"},
+]
+
+MALFORMED_REPORT_FIELDS: list[dict] = [
+    {"q": "x", "max_context_tokens": "abc"},
+    {"q": "x", "max_context_tokens": None},
+    {"q": "x", "max_context_tokens": 0},
+    {"q": "x", "length": "huge"},
+    {"q": "x", "llm": 5},
+]
+
+def post(path: str, data: bytes) -> tuple[int, dict]:
+    # The handlers of a service with nothing loaded: a request that passes validation would fail
+    service: QueryService = QueryService.__new__(QueryService)
+    app: web.Application = web.Application()
+    app.add_routes([web.post("/query", service.handle_query), web.post("/query/stream", service.handle_query_stream),
+                    web.post("/search", service.handle_search)])
+
+    async def send() -> tuple[int, dict]:
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post(path, data=data, headers={"Content-Type": "application/json"})
+            return response.status, await response.json()
+
+    return asyncio.run(send())
+
+@pytest.mark.parametrize("path", ["/query", "/query/stream", "/search"])
+@pytest.mark.parametrize("data", [b"{not json", b"[1, 2]", b"\"q\"", b"\xff\xfe"])
+def test_body_that_is_not_a_json_object_is_a_400(path, data):
+    status, body = post(path, data)
+
+    assert status == 400
+    assert "error" in body
+
+@pytest.mark.parametrize("path", ["/query", "/query/stream", "/search"])
+@pytest.mark.parametrize("fields", MALFORMED_FIELDS)
+def test_malformed_field_is_a_400(path, fields):
+    status, body = post(path, json.dumps(fields).encode())
+
+    assert status == 400
+    assert "error" in body
+
+@pytest.mark.parametrize("path", ["/query", "/query/stream"])
+@pytest.mark.parametrize("fields", MALFORMED_REPORT_FIELDS)
+def test_malformed_report_field_is_a_400(path, fields):
+    status, body = post(path, json.dumps(fields).encode())
+
+    assert status == 400
+    assert "error" in body
+
+def test_request_options_parses_and_defaults():
+    options: dict = request_options({"q": "floods", "top_n": "3", "threshold": 0.4, "sources": ["BBC News"],
+                                     "since": "2024-06-01"}, report=True)
+
+    assert options["q"] == "floods"
+    assert options["top_n"] == 3
+    assert options["threshold"] == 0.4
+    assert options["sources"] == ["BBC News"]
+    assert options["date_filter"] == {"start": "2024-06-01"}
+    assert (options["length"], options["llm"], options["max_context_tokens"]) == ("short", "llama3", CONTEXT_TOKENS)
+    assert "length" not in request_options({"q": "floods"})
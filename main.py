@@ -1,3 +1,15 @@
+"""
+Command line entry point of the news pipeline.
+
+    python main.py scrape [--num-feeds 10]                    # links of the last 48 hours -> data_prep/links.txt
+    python main.py ingest [--scrape] [--bias] [--dtype int8]  # download, embed and store the links
+    python main.py ingest --stream                            # scrape and store in one streaming pass
+    python main.py clean [--days 7] [--dry-run]               # delete old articles
+    python main.py query "What is Biden up to?" [--stream] [--mode hybrid] [--sources "BBC News" NPR --since 2024-06-01]
+    python main.py serve --port 8080 [--bias]                 # the long-running query service
+
+Global options go before the subcommand: --import-time, --metrics-log FILE, --metrics-prom FILE.
+"""
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
@@ -5,60 +17,43 @@
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
-import pandas as pd
-from pandas.core.frame import DataFrame
-from datetime import datetime, timedelta
-
-from data_prep.scrape import scrape
-from data_prep.vec_db import store_vectors, clean_database
-
-from inference.queries import sql3_as_pd, get_similar, get_bias_decector, get_bias
-
-from inference.llm import inference_llm
-from inference.prompts import get_news_report_prompt
-
-from sentence_transformers import SentenceTransformer
-import os
-
-# ---------------------------------------------------------------------------- #
-#                                                                              #
-# ---------------------------------------------------------------------------- #
-# Embedder                                                                     #
-# ---------------------------------------------------------------------------- #
-#                                                                              #
-# ---------------------------------------------------------------------------- #
-def load_custom_sentence_transformer(model_name_or_path: str = "Alibaba-NLP_gte-large-en-v1.5") -> SentenceTransformer:
+import argparse
+import importlib
+import time
+from datetime import timedelta
+from typing import TYPE_CHECKING
+
+from inference.prompts import CONTEXT_TOKENS
+
+# Everything heavy (torch, transformers, sentence_transformers, pandas, newspaper,
+# feedparser, ollama) is imported by the functions that use it: scraping or cleaning
+# the database never loads the models. `COMMAND_MODULES` lists what every subcommand
+# imports, `--import-time` shows what that costs.
+if TYPE_CHECKING:
+    from data_prep.ann import IVFIndex
+    from inference.cache import TTLCache
+    from inference.corpus import Corpus
+
+COMMAND_MODULES: dict[str, list[str]] = {
+    "scrape": ["data_prep.scrape"],
+    "ingest": ["data_prep.scrape", "data_prep.vec_db", "data_prep.pipeline", "inference.embedder"],
+    "clean": ["data_prep.vec_db"],
+    "query": ["inference.queries", "inference.llm", "inference.embedder", "inference.cache", "data_prep.ann"],
+    "serve": ["inference.service", "inference.embedder"],
+}
+
+LINKS_PATH: str = "data_prep/links.txt"
+MODEL: str = "Alibaba-NLP_gte-large-en-v1.5"
+
+def import_command(command: str) -> float:
     """
-    Loads a SentenceTransformer model (pre-trained or custom).
-
-    Args:
-        model_name_or_path: Model name (pre-trained) or path (custom) (str).
-
-    Downloads if missing, then loads the model.
-
-    Returns:
-        Loaded SentenceTransformer model (SentenceTransformer).
+    Imports the modules `command` needs and returns how long that took, in seconds.
     """
-    # Construct the path to the torch cache directory in the user's home directory
-    cache_folder = os.path.join(os.path.expanduser("~"), ".cache", "torch", "sentence_transformers")
-    model_path = os.path.join(cache_folder, model_name_or_path)
-
-    if not os.path.exists(model_path):
-        print(f"Model '{model_name_or_path}' not found at '{model_path}'. Downloading...\n")
-        
-        os.makedirs(cache_folder, exist_ok=True)
-
-        # I have device as cpu because I am running this on a mac - obviously, change this to gpu if you have a gpu
-        model = SentenceTransformer(model_name_or_path, cache_folder=cache_folder, trust_remote_code=True, device="cpu")
-        model.save(model_path)
-
-        print("Downloading Complete, processing links ...\n")
-    else:
-        print(f"Model '{model_name_or_path}' found at '{model_path}'. Loading...")
-        model = SentenceTransformer(model_path, cache_folder=cache_folder, trust_remote_code=True, device="cpu")
-        print("Loading Complete, processing links ...\n")
-    return model
+    t: float = time.perf_counter()
+    for module in COMMAND_MODULES[command]:
+        importlib.import_module(module)
 
+    return time.perf_counter() - t
 
 # ---------------------------------------------------------------------------- #
 #                                                                              #
@@ -67,17 +62,20 @@ def load_custom_sentence_transformer(model_name_or_path: str = "Alibaba-NLP_gte-
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
-def f_scrape(bool, num_feeds = None) -> list[tuple[str, str]]:
+def f_scrape(bool, num_feeds = None, links_path: str = LINKS_PATH, state: dict = None) -> list[tuple[str, str]]:
     if bool:
-        links = scrape(num_feeds)
+        from data_prep.scrape import scrape
+
+        # With a feed state only the new links are returned, the caller saves it once they are stored
+        links = scrape(num_feeds, state)
 
         links = list(set(links))
 
-        with open("data_prep/links.txt", "w") as f:
+        with open(links_path, "w") as f:
             for name, link, date in links:
                 f.write(f"{name}, {link}, {date}\n")
     else:
-        with open("data_prep/links.txt", "r") as f:
+        with open(links_path, "r") as f:
             links = f.readlines()
 
             for i in range(len(links)):
@@ -97,9 +95,12 @@ def f_scrape(bool, num_feeds = None) -> list[tuple[str, str]]:
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
-def f_store(bool, links, embedding_model):
+def f_store(bool, links, embedding_model, bias_classifier = None, **options):
     if bool:
-        store_vectors(links, embedding_model)
+        from data_prep.vec_db import store_vectors
+
+        # With a classifier, every new article's bias is stored for filtering at query time
+        store_vectors(links, embedding_model, bias_classifier=bias_classifier, **options)
 
         print("Vectors Stored\n")
     else:
@@ -112,46 +113,244 @@ def f_store(bool, links, embedding_model):
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
-def f_inference(q, data, embedder, length = "Short", llm = "llama3"):
+def f_inference(q, data, embedder, length = "Short", llm = "llama3", index: "IVFIndex" = None, n_probe: int = 8,
+                cache: "TTLCache" = None, max_context_tokens: int = CONTEXT_TOKENS, mode: str = "vector", filters: dict = None):
+    from inference.queries import get_similar
+    from inference.prompts import get_news_report_prompt
+    from inference.llm import inference_llm
+    from inference.cache import answer_key
+
+    similar = get_similar(q, data, embedder, top_n=5, threshold=0.5, index=index, n_probe=n_probe, mode=mode,
+                          **(filters or {}))
 
-    similar = get_similar(q, data, embedder, top_n=5, threshold=0.5)
+    prompt, system_prompt, sources = get_news_report_prompt(similar, q, length, max_context_tokens)
 
-    prompt, system_prompt, sources = get_news_report_prompt(similar, q, length)
+    # Keyed on the retrieved articles too, so a report is regenerated once ingestion changes them
+    key: tuple = answer_key(q, similar, length, llm, max_context_tokens)
+    cached = cache.get(key) if cache is not None else None
 
-    response = inference_llm(prompt, system_prompt, llm)
+    if isinstance(cached, dict):
+        response = cached["response"]
+    else:
+        response = inference_llm(prompt, system_prompt, llm)
+        # Same entry as the query service writes, the report file is shared with it
+        if cache is not None:
+            cache.put(key, {"response": response, "bias": None})
 
     # bias = get_bias(response, get_bias_decector())
     # response += f"\n\nDetected Bias: {bias}"
 
     return response, sources
 
+def f_inference_stream(q, data, embedder, length = "Short", llm = "llama3", index: "IVFIndex" = None, n_probe: int = 8,
+                       cache: "TTLCache" = None, stats: dict = None, max_context_tokens: int = CONTEXT_TOKENS,
+                       mode: str = "vector", filters: dict = None):
+    """
+    Streaming version of `f_inference`: yields the sources block as soon as retrieval is done,
+    then the report piece by piece as the llm generates it.
+
+    Args:
+        stats: Filled with the time-to-first-token and tokens/sec of the llm call (dict).
+        mode: "vector" or "hybrid" retrieval, see `get_similar` (str).
+        filters: Source and date constraints from `search_filters` (dict).
+    """
+    from inference.queries import get_similar
+    from inference.prompts import get_news_report_prompt
+    from inference.llm import stream_llm
+    from inference.cache import answer_key
+
+    similar = get_similar(q, data, embedder, top_n=5, threshold=0.5, index=index, n_probe=n_probe, mode=mode,
+                          **(filters or {}))
+
+    prompt, system_prompt, sources = get_news_report_prompt(similar, q, length, max_context_tokens)
+
+    yield sources
+
+    key: tuple = answer_key(q, similar, length, llm, max_context_tokens)
+    cached = cache.get(key) if cache is not None else None
+
+    if isinstance(cached, dict):
+        yield cached["response"]
+        return
+
+    parts: list[str] = []
+    for token in stream_llm(prompt, system_prompt, llm, stats=stats):
+        parts.append(token)
+        yield token
+
+    if cache is not None:
+        cache.put(key, {"response": "".join(parts), "bias": None})
+
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
-# Main                                                                         #
+# Commands                                                                     #
 # ---------------------------------------------------------------------------- #
 #                                                                              #
 # ---------------------------------------------------------------------------- #
-if __name__ == "__main__":
-    q_scrape = False
-    q_store = True
+def cmd_scrape(args: argparse.Namespace) -> None:
+    links: list[tuple[str, str]] = f_scrape(True, args.num_feeds, args.links)
+    print(f"{len(links)} links written to {args.links}")
+
+def cmd_ingest(args: argparse.Namespace) -> None:
+    from inference.embedder import load_custom_sentence_transformer
+
+    classifier = None
+    if args.bias:
+        from inference.bias import get_bias_decector
+        classifier = get_bias_decector()
+
+    embedder = load_custom_sentence_transformer(args.model)
+    options: dict = {"embedding_dtype": args.dtype, "embedding_dims": args.dims, "batch_size": args.batch_size,
+                     "num_workers": args.workers, "refresh": args.refresh, "chunk_words": args.chunk_words,
+                     "dedup": not args.no_dedup}
+
+    if args.stream:
+        from data_prep.pipeline import stream_ingest
+
+        # Feeds, downloads, embedding and writes overlap, the first articles are stored within seconds
+        stream_ingest(embedder, args.num_feeds, bias_classifier=classifier, **options)
+        return
+
+    from data_prep.feed_state import load_state, save_state, settle_entries, STATE_PATH
+
+    # Links already read from a feed are skipped, so the state is only saved once they are in the database
+    state: dict = load_state(STATE_PATH) if args.scrape else None
+
+    links: list[tuple[str, str]] = f_scrape(args.scrape, args.num_feeds, args.links, state)
+    f_store(True, links, embedder, classifier, **options)
+
+    if state is not None:
+        from data_prep.vec_db import stored_hashes
 
-    links: list[tuple[str, str]] = f_scrape(q_scrape, num_feeds=10)
+        # Links that are neither stored nor known duplicates failed, the next poll offers them again
+        stored: dict = stored_hashes([link[1] for link in links])
+        settle_entries(state, [link[1] for link in links if link[1] not in stored])
+        save_state(state, STATE_PATH)
 
-    embedder = load_custom_sentence_transformer()
-    f_store(q_store, links, embedder)
+def cmd_clean(args: argparse.Namespace) -> None:
+    from data_prep.vec_db import clean_database
 
-    data: DataFrame = sql3_as_pd("embeddings.db")
+    clean_database(time_delta=timedelta(days=args.days), dry_run=args.dry_run)
 
-    clean_database(time_delta=timedelta(days=7))
+def cmd_query(args: argparse.Namespace) -> None:
+    from inference.queries import load_corpus, search_filters
+    from inference.embedder import load_custom_sentence_transformer
+    from inference.cache import TTLCache, CachedEmbedder, EMBEDDING_CACHE_PATH, ANSWER_CACHE_PATH
+    from data_prep.ann import load_index
 
-    # q = "What is Biden up to?"
-    # length = "medium" # "medium", "long"
-    # llm = "llama3"
+    filters: dict = search_filters(args.sources, args.exclude_sources, args.since, args.until, args.max_bias)
 
-    # response, sources = f_inference(q, data, embedder, length=length, llm=llm)
+    embedder = load_custom_sentence_transformer(args.model)
+    answers: "TTLCache" = None
+    if not args.no_cache:
+        # Repeated questions skip the embedding model and the LLM, both caches persist between runs
+        embedder = CachedEmbedder(embedder, TTLCache(4096, ttl=7 * 24 * 3600, path=EMBEDDING_CACHE_PATH), args.model)
+        answers = TTLCache(1024, ttl=6 * 3600, path=ANSWER_CACHE_PATH)
 
-    # word_count = len(response.split())
+    # Stacked and normalised once (or memory-mapped from the sidecar), every query is then a single matmul
+    data: "Corpus" = load_corpus(args.db)
 
-    # print(response, "\n\n", sources, "\n\n", f"Word Count: {word_count}")
+    # None unless built with `python -m data_prep.ann`
+    index: "IVFIndex" = load_index(args.db)
 
+    if args.stream:
+        stats: dict = {}
+        for piece in f_inference_stream(args.q, data, embedder, length=args.length, llm=args.llm, index=index, cache=answers,
+                                        stats=stats, mode=args.mode, filters=filters):
+            print(piece, end="", flush=True)
+        print(f"\n\nFirst token after {stats.get('ttft', 0):.2f}s, {stats.get('tokens_per_sec', 0):.1f} tokens/sec")
+    else:
+        response, sources = f_inference(args.q, data, embedder, length=args.length, llm=args.llm, index=index, cache=answers,
+                                        mode=args.mode, filters=filters)
+        print(response, "\n\n", sources, "\n\n", f"Word Count: {len(response.split())}")
+
+    if answers is not None:
+        embedder.cache.save()
+        answers.save()
+
+def cmd_serve(args: argparse.Namespace, argv: list[str]) -> None:
+    from inference.service import main as serve_main
+
+    serve_main(argv)
+
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+# Main                                                                         #
+# ---------------------------------------------------------------------------- #
+#                                                                              #
+# ---------------------------------------------------------------------------- #
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Scrape, store and query the news.")
+    parser.add_argument("--import-time", action="store_true", help="print how long the subcommand's imports took")
+    parser.add_argument("--metrics-log", default=None, help="append span and error events to this JSON lines file")
+    parser.add_argument("--metrics-prom", default=None, help="write the metrics to this Prometheus text file at exit")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    scrape = commands.add_parser("scrape", help="collect the links of the last 48 hours from the RSS feeds")
+    scrape.add_argument("--num-feeds", type=int, default=None, help="only scrape this many randomly chosen feeds")
+    scrape.add_argument("--links", default=LINKS_PATH, help="file the links are written to")
+
+    ingest = commands.add_parser("ingest", help="download, embed and store the scraped links")
+    ingest.add_argument("--scrape", action="store_true", help="scrape the feeds first instead of reading --links")
+    ingest.add_argument("--stream", action="store_true", help="scrape and store in one streaming pass (data_prep.pipeline)")
+    ingest.add_argument("--num-feeds", type=int, default=None, help="with --scrape, only scrape this many feeds")
+    ingest.add_argument("--links", default=LINKS_PATH, help="file the links are read from (or written to with --scrape)")
+    ingest.add_argument("--model", default=MODEL, help="SentenceTransformer name or path")
+    ingest.add_argument("--bias", action="store_true", help="score and store the bias of every new article")
+    ingest.add_argument("--dtype", choices=["float32", "float16", "int8"], default="float32", help="dtype the embeddings are stored with")
+    ingest.add_argument("--dims", type=int, default=None, help="only store the leading DIMS values of every embedding")
+    ingest.add_argument("--chunk-words", type=int, default=None, help="also embed overlapping passages of this many words")
+    ingest.add_argument("--batch-size", type=int, default=32, help="articles per encode call")
+    ingest.add_argument("--workers", type=int, default=4, help="download processes")
+    ingest.add_argument("--refresh", action="store_true", help="re-download known links and re-embed the changed ones")
+    ingest.add_argument("--no-dedup", action="store_true", help="embed near-duplicate articles too")
+
+    clean = commands.add_parser("clean", help="delete old articles from the database")
+    clean.add_argument("--days", type=int, default=7, help="maximum age of the articles kept")
+    clean.add_argument("--dry-run", action="store_true", help="only report what would be deleted")
+
+    query = commands.add_parser("query", help="write a news report answering a question")
+    query.add_argument("q", help="the question")
+    query.add_argument("--db", default="embeddings.db", help="path to the sqlite database")
+    query.add_argument("--model", default=MODEL, help="SentenceTransformer name or path")
+    query.add_argument("--length", choices=["short", "medium", "long"], default="short")
+    query.add_argument("--llm", default="llama3", help="ollama model writing the report")
+    query.add_argument("--mode", choices=["vector", "hybrid"], default="vector", help="retrieval mode")
+    query.add_argument("--stream", action="store_true", help="print the report as it is generated")
+    query.add_argument("--no-cache", action="store_true", help="skip the embedding and report caches")
+    query.add_argument("--sources", nargs="+", default=None, help="only use articles of these sources, as stored (e.g. \"BBC News\" CNN NPR)")
+    query.add_argument("--exclude-sources", nargs="+", default=None, help="never use articles of these sources")
+    query.add_argument("--since", default=None, help="only articles published on or after this date (YYYY-MM-DD)")
+    query.add_argument("--until", default=None, help="only articles published on or before this date (YYYY-MM-DD)")
+    query.add_argument("--max-bias", type=float, default=None, help="only articles with a bias score at most this")
+
+    # Everything after `serve` is handed to `python -m inference.service`
+    commands.add_parser("serve", help="run the query service (takes the options of `python -m inference.service`)",
+                        add_help=False)
+
+    return parser
+
+def main(argv: list[str] = None) -> None:
+    parser: argparse.ArgumentParser = build_parser()
+    args, extra = parser.parse_known_args(argv)
+
+    if extra and args.command != "serve":
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+
+    if args.metrics_log or args.metrics_prom:
+        from data_prep.metrics import configure
+        configure(args.metrics_log, args.metrics_prom)
+
+    seconds: float = import_command(args.command)
+    if args.import_time:
+        print(f"Imported the modules of '{args.command}' in {seconds:.2f}s")
+
+    if args.command == "serve":
+        cmd_serve(args, extra)
+    else:
+        {"scrape": cmd_scrape, "ingest": cmd_ingest, "clean": cmd_clean, "query": cmd_query}[args.command](args)
+
+if __name__ == "__main__":
+    main()